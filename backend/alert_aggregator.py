@@ -0,0 +1,197 @@
+"""
+Alert Aggregation & Digests
+===========================
+Keeps alert volume proportional to distinct problems instead of to request
+rate.  During an attack every evaluation of a compromised session used to
+insert a fresh alert and e-mail every admin synchronously.
+
+  - record() keys alerts by (user, severity, reason).  While an open,
+    unacknowledged alert with the same key was last seen within
+    ALERT_DEDUP_WINDOW_SECONDS, a repeat increments its `count` and moves
+    `last_seen` / description / details forward instead of inserting.
+  - queue() collects notifications per key; flush() sends them as one
+    digest e-mail, at most one per ALERT_DIGEST_INTERVAL_SECONDS.  The first
+    notification after a quiet interval goes out right away, repeats wait
+    for the next digest (main.py flushes on a timer).  The digest is handed
+    to mail_queue, so no SMTP work happens on the request path.
+
+The reason defaults to the description with numbers masked, so "Risk
+72/100" and "Risk 75/100" for the same condition share a key.  A db.watch
+hook forgets keys whose alert is acknowledged, resolved or deleted, so the
+next occurrence opens a new alert.
+"""
+
+import asyncio
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+import db
+from email_utils import send_security_alert
+
+ALERT_DEDUP_WINDOW_SECONDS = float(os.getenv("ALERT_DEDUP_WINDOW_SECONDS", "900"))
+ALERT_DIGEST_INTERVAL_SECONDS = float(os.getenv("ALERT_DIGEST_INTERVAL_SECONDS", "300"))
+
+NOTIFY_SEVERITIES = ("high", "critical")
+
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+_lock = threading.Lock()
+_open: dict = {}       # (user_id, severity, reason) -> [alert _id, last_seen]
+_by_id: dict = {}      # alert _id -> key
+_pending: dict = {}    # key -> {"user_name", "description", "count", "score"} since the last digest
+_last_digest = None    # monotonic time of the last digest sent
+_stats = {"alerts_created": 0, "alerts_merged": 0, "notifications_queued": 0, "digests_sent": 0}
+
+
+def reason_for(description: str) -> str:
+    return _NUMBER.sub("#", description or "").strip()
+
+
+# ─── Deduplication ───────────────────────────────────────────────────
+
+def record(user_id, severity, description, details=None, reason=None, source=None):
+    """Insert or merge an alert; returns (alert doc fields, created).
+
+    `source` ({session_id, ip_address, device_fingerprint}) is stored on the
+    alert and, on a merge, moves forward to the latest occurrence.
+    """
+    source = source or {}
+    conn = db.get_db_connection()["alerts"]
+    key = (user_id, severity, reason or reason_for(description))
+    now = datetime.utcnow()
+    with _lock:
+        entry = _open.get(key)
+    if entry is not None and now - entry[1] <= timedelta(seconds=ALERT_DEDUP_WINDOW_SECONDS):
+        merged = conn.update_one(
+            {"_id": entry[0], "status": "open", "acknowledged": False},
+            {"$inc": {"count": 1},
+             "$set": {"last_seen": now, "description": description, "details": details or {}, **source}},
+        )
+        if merged:
+            with _lock:
+                entry[1] = now
+                _stats["alerts_merged"] += 1
+            return {"_id": entry[0], "user_id": user_id, "severity": severity, "reason": key[2],
+                    "description": description, "last_seen": now}, False
+    doc = {
+        "user_id": user_id, "severity": severity, "reason": key[2],
+        "status": "open", "description": description,
+        "details": details or {}, "timestamp": now, "last_seen": now,
+        "count": 1, "acknowledged": False, **source,
+    }
+    doc["_id"] = conn.insert_one(doc).inserted_id
+    with _lock:
+        old = _open.get(key)
+        if old is not None:
+            _by_id.pop(old[0], None)
+        _open[key] = [doc["_id"], now]
+        _by_id[doc["_id"]] = key
+        _stats["alerts_created"] += 1
+    return doc, True
+
+
+# ─── Digests ─────────────────────────────────────────────────────────
+
+def queue(user_id, user_name, severity, description, score=None, reason=None):
+    """Add one notification to the next digest."""
+    key = (user_id, severity, reason or reason_for(description))
+    with _lock:
+        p = _pending.get(key)
+        if p is None:
+            p = _pending[key] = {"user_name": user_name, "description": description, "count": 0, "score": score}
+        p["count"] += 1
+        p["description"] = description
+        if score is not None and (p["score"] is None or score > p["score"]):
+            p["score"] = score
+        _stats["notifications_queued"] += 1
+
+
+def _take_digest(force):
+    global _last_digest
+    with _lock:
+        if not _pending:
+            return None
+        now = time.monotonic()
+        if not force and _last_digest is not None and now - _last_digest < ALERT_DIGEST_INTERVAL_SECONDS:
+            return None
+        items = sorted(_pending.items(), key=lambda kv: (kv[0][1] != "critical", kv[0][0]))
+        _pending.clear()
+        _last_digest = now
+        _stats["digests_sent"] += 1
+    return items
+
+
+def _format(items):
+    users = {p["user_name"] for _, p in items}
+    target = next(iter(users)) if len(users) == 1 else f"{len(users)} users"
+    score = max((p["score"] for _, p in items if p["score"] is not None), default=100)
+    lines = [
+        f"[{severity.upper()}] {p['user_name']}: {p['description']}" + (f" (x{p['count']})" if p["count"] > 1 else "")
+        for (_, severity, _), p in items
+    ]
+    return target, score, "\n    ".join(lines)
+
+
+async def flush(force=False) -> bool:
+    """Send pending notifications as one digest if the rate limit allows; True if sent."""
+    items = _take_digest(force)
+    if not items:
+        return False
+    admins = db.get_db_connection()["users"].find_fields({"role": "admin"}, ("email",))
+    emails = [e for (e,) in admins if e]
+    if emails:
+        target, score, details = _format(items)
+        send_security_alert(admin_emails=emails, target_user=target, risk_score=score, details=details)
+    return True
+
+
+async def digest_loop():
+    while True:
+        await asyncio.sleep(max(1.0, ALERT_DIGEST_INTERVAL_SECONDS / 5))
+        try:
+            await flush()
+        except Exception as e:
+            print(f"[WARN] Alert digest failed: {e}")
+
+
+def status() -> dict:
+    with _lock:
+        return dict(_stats, open_keys=len(_open), pending_notifications=sum(p["count"] for p in _pending.values()),
+                    dedup_window_seconds=ALERT_DEDUP_WINDOW_SECONDS,
+                    digest_interval_seconds=ALERT_DIGEST_INTERVAL_SECONDS)
+
+
+# ─── Write Hooks ─────────────────────────────────────────────────────
+
+def _on_alert_write(before, after):
+    doc = after or before
+    if after is not None and after.get("status") == "open" and not after.get("acknowledged"):
+        return
+    with _lock:
+        key = _by_id.pop(doc.get("_id"), None)
+        if key is not None and _open.get(key, [None])[0] == doc.get("_id"):
+            del _open[key]
+
+
+def rebuild():
+    """Re-index open alerts still inside the dedup window (after snapshot loads)."""
+    since = datetime.utcnow() - timedelta(seconds=ALERT_DEDUP_WINDOW_SECONDS)
+    rows = db.get_db_connection()["alerts"].find_fields(
+        {"status": "open", "acknowledged": False}, ("_id", "user_id", "severity", "reason", "description", "last_seen", "timestamp"))
+    with _lock:
+        _open.clear()
+        _by_id.clear()
+        for aid, uid, severity, reason, description, last_seen, ts in sorted(
+                rows, key=lambda r: r[5] or r[6] or datetime.min):
+            seen = last_seen or ts
+            if isinstance(seen, datetime) and seen >= since:
+                key = (uid, severity, reason or reason_for(description))
+                _open[key] = [aid, seen]
+                _by_id[aid] = key
+
+
+db.watch("alerts", _on_alert_write)
+db.on_reset(rebuild)
@@ -0,0 +1,353 @@
+"""
+Compressed Archival Tier for Behavior & Activity Logs
+======================================================
+Forensic retention keeps months of `behavior_logs` and `user_activity_logs`.
+Instead of holding them as plain dicts, data older than ARCHIVE_AFTER_DAYS
+is sealed into compressed columnar blocks:
+
+  - rows are grouped into day-long time segments, sorted by (user_id,
+    timestamp) inside a segment and cut into blocks of ARCHIVE_BLOCK_ROWS
+  - each column is encoded on its own (timestamps as int64 microseconds,
+    repetitive strings dictionary-encoded, anything else pickled) and the
+    whole block is compressed with zlib or lzma
+  - every block keeps a zone map (min/max timestamp, min/max user_id), so a
+    range query only decompresses blocks that can contain matching rows
+
+Blocks live in the database's cold segment list next to spilled segments
+and are read transparently by find / count_documents / aggregate.
+"""
+
+import lzma
+import os
+import pickle
+import time
+import zlib
+from array import array
+from datetime import datetime, timedelta
+
+import db
+from segments import UserFilter, time_bounds
+
+ARCHIVE_COLLECTIONS = ("behavior_logs", "user_activity_logs")
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_CODEC = os.getenv("ARCHIVE_CODEC", "zlib")   # zlib | lzma
+ARCHIVE_BLOCK_ROWS = 65_536
+ARCHIVE_SEGMENT = timedelta(days=1)
+
+_EPOCH = datetime(1970, 1, 1)
+_MICRO = timedelta(microseconds=1)
+_MISSING = object()
+
+_stats = {"raw_bytes": 0, "compressed_bytes": 0, "rows": 0, "blocks": 0}
+
+
+# ─── Column Encoding ─────────────────────────────────────────────────
+
+def _compress(data):
+    return lzma.compress(data, preset=6) if ARCHIVE_CODEC == "lzma" else zlib.compress(data, 6)
+
+
+def _decompress(codec, data):
+    return lzma.decompress(data) if codec == "lzma" else zlib.decompress(data)
+
+
+def _encode_column(vals):
+    present = None
+    if any(v is _MISSING for v in vals):
+        present = bytes(v is not _MISSING for v in vals)
+        vals = [v for v in vals if v is not _MISSING]
+    if vals and all(type(v) is datetime for v in vals):
+        return ("ts", present, array("q", [(v - _EPOCH) // _MICRO for v in vals]).tobytes())
+    if all(v is None or type(v) is str for v in vals):
+        codes = {}
+        idx = array("I", [codes.setdefault(v, len(codes)) for v in vals])
+        if len(codes) <= len(vals) // 2:
+            return ("dict", present, (list(codes), idx.tobytes()))
+    return ("obj", present, vals)
+
+
+def _decode_column(col, rows=None):
+    """Decode a column, optionally only the given row positions."""
+    kind, present, data = col
+    if present is not None:
+        vals = _decode_column((kind, None, data))
+        it = iter(vals)
+        vals = [next(it) if p else _MISSING for p in present]
+        return vals if rows is None else [vals[i] for i in rows]
+    if kind == "ts":
+        ts = array("q", data)
+        picked = ts if rows is None else (ts[i] for i in rows)
+        return [_EPOCH + timedelta(microseconds=v) for v in picked]
+    if kind == "dict":
+        values, raw = data
+        idx = array("I", raw)
+        return [values[i] for i in idx] if rows is None else [values[idx[i]] for i in rows]
+    return data if rows is None else [data[i] for i in rows]
+
+
+# ─── Blocks ──────────────────────────────────────────────────────────
+
+class ArchiveBlock:
+    """One sealed, compressed block of rows with a (timestamp, user_id) zone map."""
+
+    def __init__(self, collection, field, rows):
+        self.collection = collection
+        self.field = field
+        self.count = len(rows)
+        self.t_min = min(r[field] for r in rows)
+        self.t_max = max(r[field] for r in rows)
+        users = [r["user_id"] for r in rows if isinstance(r.get("user_id"), str)]
+        self.user_min = min(users) if users else None
+        self.user_max = max(users) if users else None
+        self.users = UserFilter(r.get("user_id") for r in rows)
+
+        keys = []
+        seen = set()
+        for r in rows:
+            for k in r:
+                if k not in seen:
+                    seen.add(k)
+                    keys.append(k)
+        columns = [_encode_column([r.get(k, _MISSING) for r in rows]) for k in keys]
+        self.codec = ARCHIVE_CODEC
+        self._data = _compress(pickle.dumps((keys, columns), protocol=5))
+        self.nbytes = len(self._data)
+        self.raw_bytes = sum(db.approx_size(r) for r in rows)
+
+    def _user_may_match(self, query):
+        if self.user_min is None or "user_id" not in query:
+            return True
+        val = query["user_id"]
+        if isinstance(val, str):
+            return self.user_min <= val <= self.user_max and self.users.may_match(query)
+        if isinstance(val, dict) and isinstance(val.get("$in"), (list, tuple, set)):
+            return any(isinstance(u, str) and self.user_min <= u <= self.user_max and self.users.may_contain(u)
+                       for u in val["$in"])
+        return True
+
+    def may_match(self, query):
+        if not query:
+            return True
+        lo, hi = time_bounds(query, self.field)
+        if lo is not None and self.t_max < lo:
+            return False
+        if hi is not None and self.t_min > hi:
+            return False
+        return self._user_may_match(query)
+
+    def _candidate_rows(self, keys, columns, query):
+        """Narrow rows using the raw timestamp / user_id columns before materialising."""
+        rows = range(self.count)
+        lo, hi = time_bounds(query, self.field)
+        if (lo is not None or hi is not None) and self.field in keys:
+            kind, present, data = columns[keys.index(self.field)]
+            if kind == "ts" and present is None:
+                ts = array("q", data)
+                lo_us = (lo - _EPOCH) // _MICRO if lo is not None else None
+                hi_us = (hi - _EPOCH) // _MICRO if hi is not None else None
+                rows = [i for i in rows
+                        if (lo_us is None or ts[i] >= lo_us) and (hi_us is None or ts[i] <= hi_us)]
+        user = query.get("user_id")
+        if isinstance(user, str) and "user_id" in keys:
+            kind, present, data = columns[keys.index("user_id")]
+            if kind == "dict" and present is None:
+                values, raw = data
+                if user not in values:
+                    return []
+                code = values.index(user)
+                idx = array("I", raw)
+                rows = [i for i in rows if idx[i] == code]
+        return rows
+
+    def docs(self, query=None):
+        keys, columns = pickle.loads(_decompress(self.codec, self._data))
+        rows = self._candidate_rows(keys, columns, query) if query else None
+        if rows is not None and len(rows) == self.count:
+            rows = None
+        cols = [_decode_column(c, rows) for c in columns]
+        if all(c[1] is None for c in columns):
+            return [dict(zip(keys, row)) for row in zip(*cols)]
+        return [{k: v for k, v in zip(keys, row) if v is not _MISSING} for row in zip(*cols)]
+
+    def drop(self):
+        self._data = b""
+
+    def stats(self):
+        return {
+            "t_min": self.t_min.isoformat(), "t_max": self.t_max.isoformat(),
+            "user_min": self.user_min, "user_max": self.user_max,
+            "documents": self.count, "compressed_bytes": self.nbytes,
+            "user_filter_bytes": self.users.nbytes,
+            "raw_bytes": self.raw_bytes, "codec": self.codec,
+        }
+
+
+def seal_rows(collection, field, rows):
+    """Split rows into day segments, sort each by (user_id, ts) and seal into blocks."""
+    segments = {}
+    for r in rows:
+        day = r[field].replace(hour=0, minute=0, second=0, microsecond=0)
+        segments.setdefault(day, []).append(r)
+    blocks = []
+    for day in sorted(segments):
+        seg = segments[day]
+        seg.sort(key=lambda r: (str(r.get("user_id", "")), r[field]))
+        for i in range(0, len(seg), ARCHIVE_BLOCK_ROWS):
+            blocks.append(ArchiveBlock(collection, field, seg[i:i + ARCHIVE_BLOCK_ROWS]))
+    return blocks
+
+
+def _record(blocks):
+    for b in blocks:
+        _stats["raw_bytes"] += b.raw_bytes
+        _stats["compressed_bytes"] += b.nbytes
+        _stats["rows"] += b.count
+        _stats["blocks"] += 1
+
+
+def _reset():
+    # db.load drops every cold segment, sealed blocks included
+    for key in _stats:
+        _stats[key] = 0
+
+
+db.on_reset(_reset)
+
+
+# ─── Archival Job ────────────────────────────────────────────────────
+
+def archive_old_logs(now=None):
+    """Seal hot and spilled log data older than ARCHIVE_AFTER_DAYS. Returns rows archived.
+
+    The global db lock is only held to pick the old rows and, briefly, to
+    swap the sealed blocks in; pickling and compression run unlocked so
+    requests keep flowing during a pass.  A collection whose existing rows
+    were updated, removed, spilled or reset in the meantime (db's mutation
+    counter moved) is left for the next pass.
+    """
+    cutoff = (now or datetime.utcnow()) - timedelta(days=ARCHIVE_AFTER_DAYS)
+    archived = 0
+    for name in ARCHIVE_COLLECTIONS:
+        field = db.LOG_COLLECTIONS.get(name, "timestamp")
+        with db._lock:
+            hot = db._store.get(name, [])
+            old = [d for d in hot if isinstance(d.get(field), datetime) and d[field] < cutoff]
+            version = db.mutation_count(name)
+            spilled = [seg for seg in db._segments.get(name, [])
+                       if not isinstance(seg, ArchiveBlock) and seg.t_max < cutoff]
+        if not old and not spilled:
+            continue
+
+        rows = list(old)
+        for seg in spilled:
+            rows.extend(seg.docs())      # spill files are immutable until dropped below
+        try:
+            blocks = seal_rows(name, field, rows)
+        except RuntimeError:
+            # A row was updated mid-pickle ("dict changed size"); the counter check below would reject it anyway
+            print(f"[WARN] {name} changed during archival; retrying next pass")
+            continue
+
+        with db._lock:
+            segments = db._segments.get(name, [])
+            if (db._store.get(name) is not hot
+                    or db.mutation_count(name) != version
+                    or any(seg not in segments for seg in spilled)):
+                print(f"[WARN] {name} changed during archival; retrying next pass")
+                continue
+            db._segments[name] = [seg for seg in segments if seg not in spilled] + blocks
+            moved = {id(d) for d in old}
+            hot[:] = [d for d in hot if id(d) not in moved]
+            for seg in spilled:
+                seg.drop()
+            _record(blocks)
+        archived += len(rows)
+    if archived:
+        print(f"[OK] Archived {archived} log rows into compressed blocks")
+    return archived
+
+
+def archive_stats():
+    ratio = _stats["raw_bytes"] / _stats["compressed_bytes"] if _stats["compressed_bytes"] else 0
+    return {
+        "codec": ARCHIVE_CODEC,
+        "archive_after_days": ARCHIVE_AFTER_DAYS,
+        "rows": _stats["rows"],
+        "blocks": _stats["blocks"],
+        "raw_bytes": _stats["raw_bytes"],
+        "compressed_bytes": _stats["compressed_bytes"],
+        "compression_ratio": round(ratio, 2),
+    }
+
+
+# ─── Standalone Report ───────────────────────────────────────────────
+
+def _synthetic_day(day_start, users, rows_per_user, rnd):
+    """Rows shaped like demo.seed_demo_data's behavior_logs."""
+    svcs = ["CRM Portal", "Email Server", "File Storage"]
+    rows = []
+    for u in range(users):
+        uid = f"user_{u:06d}"
+        ip = f"192.168.{u // 250 % 256}.{u % 250 + 1}"
+        sid = f"hist_{uid}_{day_start:%Y%m%d}"
+        for _ in range(rows_per_user):
+            rows.append({
+                "_id": f"{sid}_{rnd.getrandbits(48):012x}",
+                "user_id": uid, "session_id": sid,
+                "event_type": rnd.choice(["login", "access_resource", "access_resource", "data_export"]),
+                "resource": rnd.choice(svcs),
+                "action": rnd.choice(["read", "read", "write"]),
+                "ip_address": ip,
+                "device_fingerprint": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/120.0",
+                "timestamp": day_start + timedelta(seconds=rnd.randint(8 * 3600, 19 * 3600)),
+            })
+    return rows
+
+
+def report(total_rows, users=2_000, days=90):
+    """Seal `total_rows` synthetic rows day by day and time range queries over them."""
+    import random
+    rnd = random.Random(42)
+    per_user = max(1, total_rows // (users * days))
+    start = datetime(2026, 1, 1)
+    blocks = []
+    t0 = time.perf_counter()
+    for d in range(days):
+        rows = _synthetic_day(start + timedelta(days=d), users, per_user, rnd)
+        blocks.extend(seal_rows("behavior_logs", "timestamp", rows))
+    seal_secs = time.perf_counter() - t0
+    rows = sum(b.count for b in blocks)
+    raw = sum(b.raw_bytes for b in blocks)
+    packed = sum(b.nbytes for b in blocks)
+
+    def query(q):
+        t = time.perf_counter()
+        hits = 0
+        touched = 0
+        for b in blocks:
+            if b.may_match(q):
+                touched += 1
+                hits += sum(1 for r in b.docs(q) if db._match(r, q))
+        return {"ms": round((time.perf_counter() - t) * 1000, 1), "blocks": touched, "rows": hits}
+
+    day = start + timedelta(days=days // 2)
+    return {
+        "rows": rows, "blocks": len(blocks), "codec": ARCHIVE_CODEC,
+        "seal_seconds": round(seal_secs, 1),
+        "raw_bytes": raw, "compressed_bytes": packed,
+        "compression_ratio": round(raw / packed, 2),
+        "one_hour": query({"timestamp": {"$gte": day + timedelta(hours=10), "$lt": day + timedelta(hours=11)}}),
+        "one_day_one_user": query({"user_id": "user_000042", "timestamp": {"$gte": day, "$lt": day + timedelta(days=1)}}),
+        "one_week_one_user": query({"user_id": "user_000042", "timestamp": {"$gte": day, "$lt": day + timedelta(days=7)}}),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(description="Archive compression / range-query report")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=2_000)
+    parser.add_argument("--days", type=int, default=90)
+    args = parser.parse_args()
+    print(json.dumps(report(args.rows, args.users, args.days), indent=2))
@@ -0,0 +1,289 @@
+"""
+Decayed User Behavioral Baselines
+==================================
+Per-user baselines for action count, download count, session duration and
+service switches, kept as exponentially weighted moving averages and
+variances (EWMA / EWMV) with a time-based half-life
+(BASELINE_HALF_LIFE_DAYS).  A session from a year ago counts for far less
+than yesterday's, and each user costs a constant few floats however long
+their history is.
+
+A session is folded in exactly once, in O(1), when it closes (revoked,
+deleted or expired).  Expiry needs no sweeper: open sessions sit in a heap
+by expires_at that is drained lazily on every session write and profile
+read (and by close_expired()), so `_open` stays bounded even with
+continuous evaluation switched off.  While it is open its latest
+session_behavior values are held aside, so the session being evaluated
+never shifts its own baseline.  Behavior for sessions that are already
+closed when written (imports, seeded history) is folded immediately;
+samples older than the user's newest fold are down-weighted by their age
+instead of rewinding the clock.
+
+rebuild() replays the collections from scratch (startup, snapshot loads).
+tests/test_baselines.py replays a synthetic level shift to check
+adaptation speed against the all-time mean.
+"""
+
+import heapq
+import math
+import os
+import threading
+from datetime import datetime
+
+import db
+
+BASELINE_HALF_LIFE_DAYS = float(os.getenv("BASELINE_HALF_LIFE_DAYS", "30"))
+
+METRICS = ("action_count", "download_count", "duration_minutes", "service_switches")
+
+DEFAULT_PROFILE = {
+    "avg_actions": 20, "std_actions": 10,
+    "avg_downloads": 5, "avg_session_duration": 30,
+    "avg_switches": 0, "std_switches": 0,
+}
+
+_EPOCH = datetime(1970, 1, 1)
+
+_lock = threading.Lock()
+_users: dict = {}   # user_id -> UserBaseline
+_open: dict = {}    # session_id -> [expires_at, user_id, values, t] for open sessions
+_expiry: list = []  # heap of (expires_at, session_id); stale when _open's expires_at moved
+_fold_hooks = []
+_reset_hooks = []
+
+
+class DecayedStats:
+    """Exponentially weighted mean / variance (West's weighted update)."""
+
+    __slots__ = ("w", "w2", "mean", "s")
+
+    def __init__(self):
+        self.w = 0.0      # decayed sum of weights
+        self.w2 = 0.0     # decayed sum of squared weights (effective sample size)
+        self.mean = 0.0
+        self.s = 0.0      # decayed sum of squared deviations
+
+    def update(self, x, decay, weight):
+        w = self.w * decay + weight
+        self.w2 = self.w2 * decay * decay + weight * weight
+        delta = x - self.mean
+        self.mean += (weight / w) * delta
+        self.s = self.s * decay + weight * delta * (x - self.mean)
+        self.w = w
+
+    def std(self):
+        return math.sqrt(max(0.0, self.s / self.w)) if self.w else 0.0
+
+    def effective_n(self):
+        return self.w * self.w / self.w2 if self.w2 else 0.0
+
+
+class UserBaseline:
+    __slots__ = ("t", "n", "stats")
+
+    def __init__(self):
+        self.t = None     # time of the newest folded session (seconds)
+        self.n = 0        # sessions folded in
+        self.stats = tuple(DecayedStats() for _ in METRICS)
+
+    def fold(self, values, t, half_life):
+        if self.t is None or t >= self.t:
+            decay = 0.5 ** ((t - self.t) / half_life) if self.t is not None else 1.0
+            weight = 1.0
+            self.t = t
+        else:
+            decay = 1.0
+            weight = 0.5 ** ((self.t - t) / half_life)
+        for s, x in zip(self.stats, values):
+            s.update(x, decay, weight)
+        self.n += 1
+
+
+def _seconds(ts):
+    return (ts - _EPOCH).total_seconds() if isinstance(ts, datetime) else (datetime.utcnow() - _EPOCH).total_seconds()
+
+
+def _values(doc):
+    return [doc.get(m, 0) or 0 for m in METRICS]
+
+
+def on_fold(callback, reset=None):
+    """Register callback(user_id, values), run for every session folded in.
+
+    `reset` (optional) runs when rebuild() starts over, before the replay.
+    """
+    _fold_hooks.append(callback)
+    if reset is not None:
+        _reset_hooks.append(reset)
+
+
+def _fold(user_id, values, t):
+    if user_id is None:
+        return
+    u = _users.get(user_id)
+    if u is None:
+        u = _users[user_id] = UserBaseline()
+    u.fold(values, t, BASELINE_HALF_LIFE_DAYS * 86400)
+    for cb in _fold_hooks:
+        cb(user_id, values)
+
+
+def _close(session_id):
+    entry = _open.pop(session_id, None)
+    if entry is not None and entry[2] is not None:
+        _fold(entry[1], entry[2], entry[3])
+
+
+# ─── Write Hooks ─────────────────────────────────────────────────────
+
+def _is_open(session):
+    exp = session.get("expires_at")
+    return not session.get("revoked") and not (isinstance(exp, datetime) and exp < datetime.utcnow())
+
+
+def _track_expiry(sid, exp):
+    if isinstance(exp, datetime):
+        heapq.heappush(_expiry, (exp, sid))
+
+
+def _close_expired(now):
+    """Fold open sessions whose expires_at has passed (caller holds _lock)."""
+    closed = 0
+    while _expiry and _expiry[0][0] < now:
+        exp, sid = heapq.heappop(_expiry)
+        entry = _open.get(sid)
+        if entry is not None and entry[0] == exp:
+            _close(sid)
+            closed += 1
+    return closed
+
+
+def _on_session_write(before, after):
+    with _lock:
+        _close_expired(datetime.utcnow())
+        if after is None or not _is_open(after):
+            _close((after or before).get("session_id"))
+            return
+        sid = after.get("session_id")
+        entry = _open.get(sid)
+        if entry is None:
+            _open[sid] = [after.get("expires_at"), after.get("user_id"), None, _seconds(after.get("start_time"))]
+            _track_expiry(sid, after.get("expires_at"))
+        elif entry[0] != after.get("expires_at"):
+            entry[0] = after.get("expires_at")
+            _track_expiry(sid, entry[0])
+
+
+def _on_behavior_write(before, after):
+    with _lock:
+        if after is None:
+            entry = _open.get(before.get("session_id"))
+            if entry is not None:
+                entry[2] = None
+            return
+        entry = _open.get(after.get("session_id"))
+        if entry is not None:
+            entry[1] = after.get("user_id")
+            entry[2] = _values(after)
+            if isinstance(after.get("login_timestamp"), datetime):
+                entry[3] = _seconds(after["login_timestamp"])
+        elif before is None:
+            # Session already closed (history import, seed data): fold right away
+            _fold(after.get("user_id"), _values(after), _seconds(after.get("login_timestamp")))
+
+
+def close_expired(now=None) -> int:
+    """Fold sessions that expired without being revoked; returns how many."""
+    with _lock:
+        return _close_expired(now or datetime.utcnow())
+
+
+def rebuild():
+    """Replay every closed session's behavior in time order (backfill job)."""
+    conn = db.get_db_connection()
+    sessions = {
+        sid: (exp, revoked, start)
+        for sid, exp, revoked, start in conn["sessions"].find_fields(
+            {}, ("session_id", "expires_at", "revoked", "start_time"))
+    }
+    rows = conn["session_behavior"].find_fields({}, ("session_id", "user_id", "login_timestamp") + METRICS)
+    now = datetime.utcnow()
+    closed, still_open = [], {}
+    for sid, uid, login_ts, *values in rows:
+        exp, revoked, start = sessions.get(sid, (None, True, None))
+        values = [v or 0 for v in values]
+        t = _seconds(login_ts if isinstance(login_ts, datetime) else start)
+        if revoked or (isinstance(exp, datetime) and exp < now):
+            closed.append((t, uid, values))
+        else:
+            still_open[sid] = [exp, uid, values, t]
+    for sid, (exp, revoked, start) in sessions.items():
+        if sid not in still_open and not revoked and not (isinstance(exp, datetime) and exp < now):
+            still_open[sid] = [exp, None, None, _seconds(start)]
+    closed.sort(key=lambda r: r[0])
+    with _lock:
+        for cb in _reset_hooks:
+            cb()
+        _users.clear()
+        _open.clear()
+        _open.update(still_open)
+        _expiry[:] = [(e[0], sid) for sid, e in still_open.items() if isinstance(e[0], datetime)]
+        heapq.heapify(_expiry)
+        for t, uid, values in closed:
+            _fold(uid, values, t)
+    return len(rows)
+
+
+def user_profile(user_id: str) -> dict:
+    """Decayed baseline profile in the shape risk_engine expects, in O(1)."""
+    with _lock:
+        _close_expired(datetime.utcnow())
+        u = _users.get(user_id)
+        if u is None:
+            return dict(DEFAULT_PROFILE)
+        ac, dl, du, sw = u.stats
+        n_eff = ac.effective_n()
+        return {
+            "avg_actions": ac.mean or 20,
+            "std_actions": 10 if n_eff < 2 else max(1, ac.std()),
+            "avg_downloads": dl.mean or 5,
+            "avg_session_duration": du.mean or 30,
+            "avg_switches": sw.mean,
+            "std_switches": 0 if n_eff < 2 else sw.std(),
+            "total_sessions": u.n,
+            "effective_sessions": round(n_eff, 2),
+        }
+
+
+def decayed_sums(now=None) -> list:
+    """(user_id, sessions, weight, sums, sums of squares) per user, every baseline decayed to `now`.
+
+    Adding these across users gives the same decayed mean / variance as
+    folding all of their closed sessions into one baseline (cohort.refresh).
+    """
+    now = _seconds(now or datetime.utcnow())
+    half_life = BASELINE_HALF_LIFE_DAYS * 86400
+    out = []
+    with _lock:
+        for uid, u in _users.items():
+            if u.t is None:
+                continue
+            d = 0.5 ** (max(0.0, now - u.t) / half_life)
+            w = u.stats[0].w * d    # every metric sees the same weights
+            out.append((uid, u.n, w, [w * s.mean for s in u.stats],
+                        [d * (s.s + s.w * s.mean * s.mean) for s in u.stats]))
+    return out
+
+
+def _memory_report():
+    with _lock:
+        users = len(_users)
+        pending = len(_open) + len(_expiry)
+    return {"entries": users, "approx_bytes": users * (len(METRICS) * 88 + 150) + pending * 200}
+
+
+db.watch("sessions", _on_session_write)
+db.watch("session_behavior", _on_behavior_write)
+db.on_reset(rebuild)
+db.register_index("user_baselines", _memory_report)
+
@@ -0,0 +1,274 @@
+"""
+Vectorized Batch Risk Scoring
+==============================
+Scores many sessions at once (policy changes, incident sweeps) with the
+same rules as risk_engine's scalar path, but as NumPy array operations:
+
+  1. extract_features() makes one pass over the sessions, their
+     session_behavior docs and the cohort-blended per-user baselines, p95 / p99
+     sketch thresholds, risk contexts, shared-IP / device fan-in and GeoIP travel, producing a float64 feature matrix (one row per session)
+  2. score_features() computes the nine component scores, the status
+     counts, the clustering multiplier and the final score column-wise
+
+Each row carries the index of its compiled risk policy (policy.py, chosen
+by user role and session app); score_features() reads per-row weights,
+hour risks, limits and cutoffs from the PolicySet's stacked tables.  It is
+a pure function of the matrix and those tables, so it can run in a worker
+process.  Results match evaluate_session_risk's score, multiplier,
+factor counts, decision and per-component raw risk exactly.  Nothing is
+persisted here — callers decide what to write back.
+"""
+
+from datetime import datetime
+from typing import List
+
+import numpy as np
+
+import cohort
+import geoip
+import ip_trie
+import policy
+import risk_context
+import shared_infra
+import sketches
+import throttle
+from db import get_db_connection
+
+COMPONENTS = policy.COMPONENTS
+
+# Feature matrix columns
+F_HOUR, F_DEVICE, F_IP, F_ACTIONS, F_AVG_ACTIONS, F_STD_ACTIONS, F_SWITCHES, \
+    F_DURATION, F_AVG_DURATION, F_FAILED, F_DOWNLOADS, F_AVG_DOWNLOADS, \
+    F_UNAUTHORIZED, F_LOGIN_ATTEMPTS, F_POLICY, F_AVG_SWITCHES, F_STD_SWITCHES, \
+    F_P95_ACTIONS, F_P99_ACTIONS, F_P95_DOWNLOADS, F_P99_DOWNLOADS, \
+    F_IP_USERS, F_TRAVEL_KM, F_TRAVEL_KMH, F_SOURCE_FAILURES = range(25)
+N_FEATURES = 25
+_NO_QUANTILES = (np.nan, np.nan)
+
+# Categorical codes -> raw risk (see calc_device_risk / calc_ip_risk)
+DEVICE_NO_HISTORY, DEVICE_KNOWN, DEVICE_UNKNOWN = 0, 1, 2
+_DEVICE_RISK = np.array([10.0, 0.0, 80.0])
+_IP_RISK = np.array([10.0, 0.0, 30.0, 85.0, 0.0])   # indexed by ip_trie.IP_* codes
+
+DECISIONS = ("ALLOW", "RE_AUTHENTICATE", "BLOCK")
+
+
+# ─── Feature Extraction ──────────────────────────────────────────────
+
+def extract_features(session_ids: List[str], policies=None):
+    """One pass over sessions + behavior -> (session_ids, user_ids, feature matrix)."""
+    db = get_db_connection()
+    policies = policies or policy.current()
+    wanted = set(session_ids)
+    sessions = db["sessions"].find_fields(
+        {"session_id": {"$in": wanted}},
+        ("session_id", "user_id", "start_time", "device_fingerprint", "ip_address",
+         "login_attempt_count", "app_id", "source_failed_logins"),
+    )
+    behavior = {
+        row[0]: row[1:]
+        for row in db["session_behavior"].find_fields(
+            {"session_id": {"$in": wanted}},
+            ("session_id", "action_count", "service_switches", "duration_minutes",
+             "failed_access_attempts", "download_count", "accessed_services"),
+        )
+    }
+
+    user_ids = {row[1] for row in sessions}
+    contexts = risk_context.warm(user_ids)
+    roles = dict(db["users"].find_fields({"_id": {"$in": user_ids}}, ("_id", "role")))
+    sids, uids, rows = [], [], []
+    per_user = {}
+    policy_index = {}
+    now_hour = datetime.utcnow().hour
+    missing = (None,) * 6
+    for sid, uid, start, device, ip, attempts, app_id, source_failures in sessions:
+        user = per_user.get(uid)
+        if user is None:
+            ctx = contexts[uid]
+            profile = cohort.user_profile(uid, roles.get(uid), ctx.credentials.values())
+            q = sketches.thresholds(uid, profile)
+            allowed = ctx.allowed_services() or ["*"]
+            user = per_user[uid] = (
+                ctx, None if "*" in allowed else set(allowed),
+                profile.get("avg_actions", 20), profile.get("std_actions", 10),
+                profile.get("avg_session_duration", 30), profile.get("avg_downloads", 5),
+                profile.get("avg_switches", 0), profile.get("std_switches", 0),
+                q["action_count"] or _NO_QUANTILES, q["download_count"] or _NO_QUANTILES,
+            )
+        ctx, allowed, avg_a, std_a, avg_d, avg_dl, avg_sw, std_sw, q_a, q_dl = user
+        known_devs = ctx.known_devices(sid)
+        device = device if device is not None else "unknown"
+        actions, switches, duration, failed, downloads, accessed = behavior.get(sid, missing)
+        key = (roles.get(uid), app_id)
+        pidx = policy_index.get(key)
+        if pidx is None:
+            pidx = policy_index[key] = policies.select(*key).index
+
+        sids.append(sid)
+        uids.append(uid)
+        rows.append((
+            start.hour if isinstance(start, datetime) else (12 if start is not None else now_hour),
+            DEVICE_NO_HISTORY if not known_devs else DEVICE_KNOWN if device in known_devs else DEVICE_UNKNOWN,
+            ip_trie.classify(ip if ip is not None else "0.0.0.0", ctx.known_ips(sid)),
+            actions or 0, avg_a, std_a, switches or 0, duration or 0, avg_d, failed or 0,
+            downloads or 0, avg_dl,
+            0 if allowed is None else sum(1 for s in (accessed or ()) if s not in allowed),
+            attempts if attempts is not None else 1,
+            pidx, avg_sw, std_sw, q_a[0], q_a[1], q_dl[0], q_dl[1],
+            shared_infra.fan_in(uid, ip if ip is not None else "0.0.0.0"),
+            *geoip.travel(uid, sid, ip, start),
+            source_failures or 0,
+        ))
+    X = np.array(rows, dtype=np.float64).reshape(len(rows), N_FEATURES)
+    return sids, uids, X
+
+
+# ─── Vectorized Components ───────────────────────────────────────────
+
+def _exceedance(x, p95, p99):
+    # sketches.exceedance, column-wise
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mid = 30 + 30 * (x - p95) / (p99 - p95)
+        high = np.minimum(100, 60 + 40 * (x - p99) / np.maximum(p99, 1))
+    return np.where(x <= p95, 0.0, np.where(x <= p99, mid, high))
+
+
+def _download_spike(current, avg, max_normal, p95, p99):
+    no_baseline = np.where(current > max_normal, 70.0, 0.0)
+    ratio = current / np.maximum(avg, 1)
+    risk = np.where(ratio <= 1.5, 0.0,
+                    np.where(ratio <= 3, 30 + (ratio - 1.5) * 20,
+                             np.minimum(100, 60 + (ratio - 3) * 10)))
+    legacy = np.where(avg == 0, no_baseline, risk)
+    quantile = _exceedance(current, np.maximum(p95, max_normal), np.maximum(p99, max_normal))
+    return np.where(np.isnan(p95), legacy, quantile)
+
+
+def _behavioral_anomaly(X, max_switches):
+    actions, avg_a, std_a = X[:, F_ACTIONS], X[:, F_AVG_ACTIONS], X[:, F_STD_ACTIONS]
+    total = np.zeros(len(X))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = (actions - avg_a) / std_a
+        hit = (std_a > 0) & (actions > avg_a + 2 * std_a)
+        p95, p99 = X[:, F_P95_ACTIONS], X[:, F_P99_ACTIONS]
+        total = total + np.where(p99 > p95,
+                                 _exceedance(actions, p95, p99) * 0.4,
+                                 np.where(hit, np.minimum(100, z * 20) * 0.4, 0.0))
+
+        sw = X[:, F_SWITCHES]
+        limit = np.maximum(max_switches, X[:, F_AVG_SWITCHES] + 2 * X[:, F_STD_SWITCHES])
+        hit = sw > limit
+        total = total + np.where(hit, np.minimum(100, (sw / limit) * 40) * 0.3, 0.0)
+
+        dur, avg_d = X[:, F_DURATION], X[:, F_AVG_DURATION]
+        hit = (avg_d > 0) & (dur > avg_d * 3)
+        total = total + np.where(hit, np.minimum(100, (dur / avg_d) * 20) * 0.3, 0.0)
+
+    failed = X[:, F_FAILED]
+    total = total + np.where(failed > 0, np.minimum(100, failed * 15) * 0.2, 0.0)
+    return np.minimum(100, total)
+
+
+def _login_attempts(count, source_failures):
+    own = np.where(count <= 1, 0.0,
+                   np.where(count == 2, 40.0, np.minimum(100, 40 + (count - 2) * 25)))
+    # throttle.spray_risk, column-wise
+    floor = throttle.THROTTLE_SPRAY_MIN
+    spray = np.where(source_failures < floor, 0.0, np.minimum(100.0, 30.0 + 5.0 * (source_failures - floor)))
+    return np.maximum(own, spray)
+
+
+def _shared_infrastructure(ip_users):
+    # shared_infra.risk, column-wise
+    minimum = shared_infra.SHARED_IP_MIN_USERS
+    return np.where(ip_users < minimum, 0.0, np.minimum(100.0, 30.0 + 15.0 * (ip_users - minimum)))
+
+
+def _impossible_travel(km, kmh):
+    # geoip.risk, column-wise
+    top = geoip.GEOIP_MAX_SPEED_KMH
+    fast = 0.8 * top
+    impossible = np.minimum(100.0, 60 + 40 * (kmh - top) / (4 * top))
+    risk = np.where(kmh <= fast, 0.0, np.where(kmh <= top, 30 + 30 * (kmh - fast) / (top - fast), impossible))
+    return np.where(km < geoip.GEOIP_TRAVEL_MIN_KM, 0.0, risk)
+
+
+def component_matrix(X, tables):
+    """Raw 0-100 component risks, columns in COMPONENTS order."""
+    pidx = X[:, F_POLICY].astype(np.intp)
+    cols = {
+        "time_deviation":       tables["hour_risk"][pidx, X[:, F_HOUR].astype(np.intp)],
+        "device_mismatch":      _DEVICE_RISK[X[:, F_DEVICE].astype(np.intp)],
+        "ip_location":          _IP_RISK[X[:, F_IP].astype(np.intp)],
+        "behavioral_anomaly":   _behavioral_anomaly(X, tables["max_switches"][pidx]),
+        "download_spike":       _download_spike(X[:, F_DOWNLOADS], X[:, F_AVG_DOWNLOADS], tables["max_downloads"][pidx],
+                                                X[:, F_P95_DOWNLOADS], X[:, F_P99_DOWNLOADS]),
+        "unauthorized_service": np.minimum(100, X[:, F_UNAUTHORIZED] * 30),
+        "login_attempts":       _login_attempts(X[:, F_LOGIN_ATTEMPTS], X[:, F_SOURCE_FAILURES]),
+        "shared_infrastructure": _shared_infrastructure(X[:, F_IP_USERS]),
+        "impossible_travel":    _impossible_travel(X[:, F_TRAVEL_KM], X[:, F_TRAVEL_KMH]),
+    }
+    return np.column_stack([cols[name] for name in COMPONENTS])
+
+
+def score_features(X, tables=None):
+    """Pure NumPy scoring of a feature matrix (safe to run in another process)."""
+    tables = tables if tables is not None else policy.current().tables()
+    pidx = X[:, F_POLICY].astype(np.intp)
+    raw = component_matrix(X, tables)
+    W = tables["weights"][pidx]
+    weighted = np.zeros(len(X))
+    for j in range(len(COMPONENTS)):
+        weighted = weighted + raw[:, j] * W[:, j]
+
+    crits = (raw >= 60).sum(axis=1)
+    warns = ((raw >= 30) & (raw < 60)).sum(axis=1)
+    mult = np.where(crits >= 3, 1.5,
+                    np.where(crits >= 2, 1.3,
+                             np.where((crits >= 1) & (warns >= 2), 1.2, 1.0)))
+    score = np.minimum(100, weighted * mult)
+    decision = np.where(score <= tables["allow"][pidx], 0,
+                        np.where(score <= tables["re_authenticate"][pidx], 1, 2))
+    return {
+        "raw": raw, "score": score, "multiplier": mult,
+        "critical_factors": crits, "warning_factors": warns, "decision": decision,
+        "policy": pidx,
+    }
+
+
+# ─── Public Entry Point ──────────────────────────────────────────────
+
+def evaluate_sessions_batch(session_ids: List[str]) -> List[dict]:
+    """Score many sessions in one vectorized pass. Unknown session ids are skipped."""
+    policies = policy.current()
+    sids, uids, X = extract_features(session_ids, policies)
+    if not sids:
+        return []
+    return format_results(sids, uids, score_features(X, policies.tables()), policies)
+
+
+def format_results(sids, uids, scored, policies=None):
+    policies = policies or policy.current()
+    names = [p.name for p in policies.policies]
+    scores = scored["score"].tolist()
+    mults = scored["multiplier"].tolist()
+    crits = scored["critical_factors"].tolist()
+    warns = scored["warning_factors"].tolist()
+    decisions = scored["decision"].tolist()
+    raw = scored["raw"].tolist()
+    pidx = scored["policy"].tolist()
+    return [
+        {
+            "session_id": sids[i], "user_id": uids[i],
+            "score": round(scores[i], 1),
+            "decision": DECISIONS[decisions[i]],
+            "multiplier": mults[i],
+            "critical_factors": crits[i],
+            "warning_factors": warns[i],
+            "policy": names[pidx[i]],
+            "components": {name: round(raw[i][j], 1) for j, name in enumerate(COMPONENTS)},
+        }
+        for i in range(len(sids))
+    ]
@@ -0,0 +1,380 @@
+"""
+Risk Engine Benchmark
+=====================
+Latency / throughput harness for the risk engine at production-like scale:
+
+    python benchmark.py run --users 1000 10000 100000 --out bench.json
+    python benchmark.py compare baseline.json bench.json --threshold 0.15
+
+`run` generates deterministic synthetic data (same --seed, same documents)
+in the shapes demo.seed_demo_data writes — users, app credentials,
+sessions, session_behavior, behavior_logs and risk_score_history — for
+--days of history with --sessions-per-day sessions per user and
+--logs-per-session behavior logs each.  Today's sessions stay open; the
+rest are closed history.  About --anomaly-rate of them come from attack
+IPs / devices at odd hours with download spikes, so the alerting paths
+run too.  Timestamps are offsets from today's midnight (UTC), so hours of
+day are the same on every run.
+
+Each scale runs in a fresh interpreter so caches and memory do not leak
+between sizes, and measures per-call latency (p50 / p95 / p99 / mean / max)
+and throughput of:
+
+  - evaluate_session_risk   full evaluation of sampled open sessions
+                            (risk contexts of sampled users pre-warmed)
+  - build_user_profile      baseline + cohort blend + sketch thresholds
+  - composite_risk          weighting / clustering of precomputed components
+  - calculate_all_risks     the admin dashboard aggregate
+
+`compare` matches results by scale and benchmark and flags a p50 / p95 /
+p99 that grew by more than --threshold (relative) and by at least
+--min-delta-ms as a regression; the exit status is 1 when any regression
+is found.  E-mail is forced into
+simulation mode while benchmarking.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+DEFAULT_SCALES = (1000, 10000, 100000)
+PASSWORD_HASH = "$2b$12$benchmark.benchmark.benchmark.benchmark.benchmark.bench"
+METRICS = ("p50_ms", "p95_ms", "p99_ms")
+
+
+# ─── Synthetic Data ──────────────────────────────────────────────────
+
+def generate(users, days, sessions_per_day, logs_per_session, anomaly_rate=0.05, seed=42):
+    """Insert the synthetic dataset into the (empty) store; returns document counts."""
+    from db import get_db_connection
+    from demo import ATTACK_DEVICES, ATTACK_IPS, DEMO_APPS, NORMAL_DEVICE
+
+    rnd = random.Random(seed)
+    db = get_db_connection()
+    midnight = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    apps = [dict(a, created_at=midnight) for a in DEMO_APPS]
+    db["apps"].insert_many(apps)
+    app_ids = [a["_id"] for a in apps if a["_id"] != "app_admin"]
+    names = {a["_id"]: a["name"] for a in apps}
+
+    user_docs, cred_docs = [], []
+    assigned, home_ips = {}, {}
+    for i in range(users):
+        uid = f"bench_user_{i:06d}"
+        role = "admin" if i % 200 == 0 else "user"
+        user_docs.append({
+            "_id": uid, "email": f"{uid}@bench.zerotrust.io", "password": PASSWORD_HASH,
+            "name": f"Bench User {i}", "role": role, "risk_score": round(rnd.uniform(0.02, 0.3), 3),
+            "access_level": "full", "is_active": True, "is_under_investigation": False,
+            "created_at": midnight - timedelta(days=days + 30),
+        })
+        assigned[uid] = rnd.sample(app_ids, k=rnd.randint(2, 4))
+        home_ips[uid] = f"10.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.{rnd.randint(1, 254)}"
+        for aid in assigned[uid]:
+            cred_docs.append({
+                "user_id": uid, "app_id": aid, "username": uid,
+                "password_hash": PASSWORD_HASH, "created_at": midnight,
+            })
+    db["users"].insert_many(user_docs)
+    db["user_credentials"].insert_many(cred_docs)
+
+    counts = {"users": len(user_docs), "user_credentials": len(cred_docs)}
+    open_sessions = []
+    for day in range(days - 1, -1, -1):
+        sessions, behavior, logs, history = [], [], [], []
+        for uid in assigned:
+            svc_pool = [names[a] for a in assigned[uid]]
+            for k in range(sessions_per_day):
+                sid = f"bench_{uid}_{day}_{k}"
+                anomalous = rnd.random() < anomaly_rate
+                hour = rnd.choice([0, 1, 2, 3, 23]) if anomalous else rnd.randint(8, 18)
+                start = midnight - timedelta(days=day) + timedelta(hours=hour, minutes=rnd.randint(0, 59))
+                dur = rnd.randint(15, 120)
+                ip = rnd.choice(ATTACK_IPS) if anomalous else home_ips[uid]
+                device = rnd.choice(ATTACK_DEVICES) if anomalous else NORMAL_DEVICE
+                svcs = rnd.sample(svc_pool, k=rnd.randint(1, len(svc_pool)))
+                if anomalous:
+                    svcs.append("Admin Console")
+                ac = rnd.randint(80, 200) if anomalous else rnd.randint(5, 30)
+                dl = rnd.randint(30, 120) if anomalous else rnd.randint(0, 8)
+                is_open = day == 0
+                sessions.append({
+                    "session_id": sid, "user_id": uid, "ip_address": ip,
+                    "device_fingerprint": device, "user_agent": device,
+                    "start_time": start, "last_activity": start + timedelta(minutes=dur),
+                    "expires_at": (datetime.utcnow() + timedelta(hours=24)) if is_open else start + timedelta(hours=24),
+                    "mfa_verified": False, "risk_at_login": rnd.uniform(0.02, 0.15),
+                    "login_attempt_count": rnd.choice([1, 1, 1, 2, 5]) if anomalous else 1,
+                    "revoked": not is_open,
+                })
+                behavior.append({
+                    "session_id": sid, "user_id": uid, "login_timestamp": start,
+                    "ip_address": ip, "device_info": device, "location": "Office - New York",
+                    "accessed_services": svcs, "action_count": ac,
+                    "download_count": dl, "duration_minutes": dur,
+                    "service_switches": max(0, len(svcs) - 1),
+                    "failed_access_attempts": rnd.randint(1, 6) if anomalous else 0,
+                })
+                for _ in range(logs_per_session):
+                    logs.append({
+                        "user_id": uid, "session_id": sid,
+                        "event_type": rnd.choice(["login", "access_resource", "access_resource", "data_export"]),
+                        "resource": rnd.choice(svcs), "action": rnd.choice(["read", "read", "write"]),
+                        "ip_address": ip, "device_fingerprint": device,
+                        "timestamp": start + timedelta(minutes=rnd.randint(0, dur)),
+                    })
+                score = rnd.uniform(0.02, 0.18)
+                history.append({
+                    "user_id": uid, "session_id": sid,
+                    "old_score": max(0, score - 0.03), "new_score": score, "delta": 0.03,
+                    "factors": [], "timestamp": start, "triggered_by": "session_evaluation",
+                })
+                if is_open:
+                    open_sessions.append((uid, sid))
+        for name, docs in (("sessions", sessions), ("session_behavior", behavior),
+                           ("behavior_logs", logs), ("risk_score_history", history)):
+            db[name].insert_many(docs)
+            counts[name] = counts.get(name, 0) + len(docs)
+    return counts, open_sessions
+
+
+# ─── Measurement ─────────────────────────────────────────────────────
+
+def _summary(samples_ns):
+    xs = sorted(samples_ns)
+    n = len(xs)
+    if not n:
+        return {"calls": 0}
+
+    def pct(q):
+        return round(xs[min(n - 1, int(q * n))] / 1e6, 4)
+
+    total = sum(xs)
+    return {
+        "calls": n, "p50_ms": pct(0.50), "p95_ms": pct(0.95), "p99_ms": pct(0.99),
+        "mean_ms": round(total / n / 1e6, 4), "max_ms": round(xs[-1] / 1e6, 4),
+        "throughput_per_s": round(n / (total / 1e9), 1) if total else None,
+    }
+
+
+def _time_sync(fn, args_list):
+    out = []
+    for args in args_list:
+        t = time.perf_counter_ns()
+        fn(*args)
+        out.append(time.perf_counter_ns() - t)
+    return out
+
+
+async def _time_async(fn, args_list):
+    out = []
+    for args in args_list:
+        t = time.perf_counter_ns()
+        await fn(*args)
+        out.append(time.perf_counter_ns() - t)
+    return out
+
+
+def run_scale(users, days, sessions_per_day, logs_per_session, anomaly_rate, seed,
+              evaluations, profiles, composites, dashboards):
+    """Generate one dataset and benchmark it (call in a fresh process)."""
+    import logging
+    logging.disable(logging.INFO)
+    import cohort
+    import policy
+    import risk_context
+    import risk_engine
+    from db import get_db_connection
+
+    t = time.perf_counter()
+    counts, open_sessions = generate(users, days, sessions_per_day, logs_per_session, anomaly_rate, seed)
+    cohort.refresh()
+    setup_s = time.perf_counter() - t
+
+    rnd = random.Random(seed + 1)
+    db = get_db_connection()
+    roles = dict(db["users"].find_fields({}, ("_id", "role")))
+    eval_args = [rnd.choice(open_sessions) for _ in range(min(evaluations, len(open_sessions)))]
+    profile_users = [rnd.choice(list(roles)) for _ in range(profiles)]
+    comp_sample = rnd.sample(open_sessions, min(200, len(open_sessions)))
+    # Measure steady state: risk contexts for every sampled user built up front in one pass
+    contexts = risk_context.warm({u for u, _ in eval_args} | set(profile_users) | {u for u, _ in comp_sample})
+    profile_args = [(uid, roles[uid], tuple(contexts[uid].credentials.values())) for uid in profile_users]
+
+    # Components for composite_risk, built once from real sessions
+    pol = policy.current().default
+    wanted = {sid for _, sid in comp_sample}
+    sessions = {d["session_id"]: d for d in db["sessions"].find({"session_id": {"$in": wanted}})}
+    behavior = {d["session_id"]: d for d in db["session_behavior"].find({"session_id": {"$in": wanted}})}
+    comp_args = []
+    for uid, sid in comp_sample:
+        s, sb = sessions[sid], behavior.get(sid, {})
+        ctx = contexts[uid]
+        profile = risk_engine.build_user_profile(uid, roles[uid], ctx.credentials.values())
+        components = {
+            "time_deviation": risk_engine.calc_time_deviation(s["start_time"].hour, pol),
+            "device_mismatch": risk_engine.calc_device_risk(s["device_fingerprint"], ctx.known_devices(sid)),
+            "ip_location": risk_engine.calc_ip_risk(s["ip_address"], ctx.known_ips(sid)),
+            "behavioral_anomaly": risk_engine.calc_behavioral_anomaly(sb, profile, pol),
+            "download_spike": risk_engine.calc_download_spike(sb.get("download_count", 0), profile["avg_downloads"],
+                                                              pol, profile.get("q_downloads")),
+            "unauthorized_service": risk_engine.calc_unauthorized_service(
+                sb.get("accessed_services", []), ctx.allowed_services() or ["*"]),
+            "login_attempts": risk_engine.calc_login_attempt_risk(s.get("login_attempt_count", 1),
+                                                                  s.get("source_failed_logins", 0)),
+            "shared_infrastructure": risk_engine.calc_shared_infrastructure(s["ip_address"], uid),
+            "impossible_travel": risk_engine.calc_impossible_travel(uid, sid, s["ip_address"], s["start_time"]),
+        }
+        comp_args.append((components, pol))
+    comp_args = [comp_args[i % len(comp_args)] for i in range(composites)] if comp_args else []
+
+    results = {}
+    results["build_user_profile"] = _summary(_time_sync(risk_engine.build_user_profile, profile_args))
+    results["composite_risk"] = _summary(_time_sync(risk_engine.composite_risk, comp_args))
+
+    async def timed_async():
+        ev = await _time_async(risk_engine.evaluate_session_risk, eval_args)
+        dash = await _time_async(risk_engine.calculate_all_risks, [()] * dashboards)
+        return ev, dash
+
+    ev, dash = asyncio.run(timed_async())
+    results["evaluate_session_risk"] = _summary(ev)
+    results["calculate_all_risks"] = _summary(dash)
+    return {"users": users, "setup_seconds": round(setup_s, 2), "documents": counts, "benchmarks": results}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(args):
+    params = {
+        "days": args.days, "sessions_per_day": args.sessions_per_day,
+        "logs_per_session": args.logs_per_session, "anomaly_rate": args.anomaly_rate, "seed": args.seed,
+        "evaluations": args.evaluations, "profiles": args.profiles,
+        "composites": args.composites, "dashboards": args.dashboards,
+    }
+    report = {
+        "meta": {
+            "started": datetime.utcnow().isoformat(), "commit": _git_commit(),
+            "python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count(), "params": params,
+        },
+        "scales": {},
+    }
+    for users in args.users:
+        print(f"Benchmarking {users} users...", file=sys.stderr)
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "_scale", json.dumps(dict(params, users=users))],
+            capture_output=True, text=True,
+        )
+        if proc.returncode != 0:
+            print(f"[WARN] {users} users failed:\n{proc.stderr[-2000:]}", file=sys.stderr)
+            report["scales"][str(users)] = {"users": users, "error": proc.stderr.strip().splitlines()[-1:]}
+            continue
+        scale = json.loads(proc.stdout.strip().splitlines()[-1])
+        report["scales"][str(users)] = scale
+        for name, r in scale["benchmarks"].items():
+            print(f"[OK] {users:>7} users  {name:<22} p50 {r.get('p50_ms')} ms  p95 {r.get('p95_ms')} ms  "
+                  f"p99 {r.get('p99_ms')} ms  {r.get('throughput_per_s')}/s", file=sys.stderr)
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"[OK] Wrote {args.out}", file=sys.stderr)
+    return 0
+
+
+# ─── Compare ─────────────────────────────────────────────────────────
+
+def compare(baseline, current, threshold=0.15, min_delta_ms=0.02):
+    """Rows of (scale, benchmark, metric, old, new, ratio, verdict) for every shared measurement."""
+    rows = []
+    for scale, cur in sorted(current.get("scales", {}).items(), key=lambda kv: int(kv[0])):
+        base = baseline.get("scales", {}).get(scale)
+        if not base or "benchmarks" not in base or "benchmarks" not in cur:
+            continue
+        for name, new in cur["benchmarks"].items():
+            old = base["benchmarks"].get(name)
+            if not old:
+                continue
+            for metric in METRICS:
+                a, b = old.get(metric), new.get(metric)
+                if a is None or b is None:
+                    continue
+                ratio = b / a if a else float("inf")
+                if abs(b - a) < min_delta_ms:
+                    verdict = "ok"      # below timer noise
+                elif ratio > 1 + threshold:
+                    verdict = "REGRESSION"
+                elif ratio < 1 - threshold:
+                    verdict = "improved"
+                else:
+                    verdict = "ok"
+                rows.append((int(scale), name, metric, a, b, ratio, verdict))
+    return rows
+
+
+def run_compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    rows = compare(baseline, current, args.threshold, args.min_delta_ms)
+    print(f"{'users':>7}  {'benchmark':<22} {'metric':<7} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for scale, name, metric, a, b, ratio, verdict in rows:
+        print(f"{scale:>7}  {name:<22} {metric:<7} {a:>10.4f} {b:>10.4f} {ratio:>7.2f}  {verdict}")
+    regressions = sum(1 for r in rows if r[-1] == "REGRESSION")
+    print(f"{regressions} regression(s) over {len(rows)} measurements (threshold {args.threshold:.0%})")
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Risk engine benchmark suite")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("run", help="generate synthetic data and measure")
+    p.add_argument("--users", type=int, nargs="+", default=list(DEFAULT_SCALES))
+    p.add_argument("--days", type=int, default=7)
+    p.add_argument("--sessions-per-day", type=int, default=1)
+    p.add_argument("--logs-per-session", type=int, default=2)
+    p.add_argument("--anomaly-rate", type=float, default=0.05)
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--evaluations", type=int, default=500, help="evaluate_session_risk calls per scale")
+    p.add_argument("--profiles", type=int, default=2000, help="build_user_profile calls per scale")
+    p.add_argument("--composites", type=int, default=20000, help="composite_risk calls per scale")
+    p.add_argument("--dashboards", type=int, default=5, help="calculate_all_risks calls per scale")
+    p.add_argument("--out", default="benchmark_results.json")
+
+    c = sub.add_parser("compare", help="flag regressions between two result files")
+    c.add_argument("baseline")
+    c.add_argument("current")
+    c.add_argument("--threshold", type=float, default=0.15, help="relative slowdown that counts as a regression")
+    c.add_argument("--min-delta-ms", type=float, default=0.02, help="ignore changes smaller than this (timer noise)")
+
+    s = sub.add_parser("_scale")
+    s.add_argument("params")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        return run(args)
+    if args.command == "compare":
+        return run_compare(args)
+    print(json.dumps(run_scale(**json.loads(args.params)), default=str))
+    return 0
+
+
+if __name__ == "__main__":
+    # Never send real e-mail from a benchmark
+    os.environ["SMTP_USER"] = ""
+    os.environ["SMTP_PASSWORD"] = ""
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""
+Peer-Group (Cohort) Baselines
+=============================
+A user with little or no history used to be scored against fixed defaults
+(20 ± 10 actions, 5 downloads, ...), which flags most new users right after
+onboarding.  Instead, a periodic batch job computes baselines for peer
+groups:
+
+  - apps:<a,b,...>  users holding exactly the same set of app credentials
+  - role:<role>     users with the same role
+
+Cohorts pool the members' own decayed baselines (baselines.decayed_sums),
+so they cover the same population as the user side of the blend: closed
+sessions only, none of the open or all-zero rows created at login, each
+weighted by BASELINE_HALF_LIFE_DAYS decay up to the refresh time.
+refresh() is one bincount per metric per cohort kind from users into
+groups; the result is swapped in as a single dict, and is refreshed on
+startup / snapshot loads and from the continuous evaluation sweep every
+COHORT_REFRESH_SECONDS.
+
+user_profile() blends a user's own decayed baseline with their cohort's by
+sample size: the user's weight is n / (n + COHORT_PRIOR_SESSIONS), where n
+is their effective session count.  Means blend linearly, standard
+deviations through their variances.  The credential-set cohort is used when
+it has at least COHORT_MIN_USERS members, then the role cohort, then the
+built-in defaults.  The p95 / p99 sketch thresholds follow the same choice
+and weight (sketches.thresholds reads the profile's cohort and members()).
+"""
+
+import math
+import os
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+import baselines
+import db
+
+COHORT_REFRESH_SECONDS = float(os.getenv("COHORT_REFRESH_SECONDS", "600"))
+COHORT_PRIOR_SESSIONS = float(os.getenv("COHORT_PRIOR_SESSIONS", "10"))
+COHORT_MIN_USERS = int(os.getenv("COHORT_MIN_USERS", "3"))
+
+METRICS = baselines.METRICS
+
+_lock = threading.Lock()
+_cohorts: dict = {}       # "role:<r>" / "apps:<a,b>" -> cohort baseline dict
+_members: dict = {}       # cohort name -> [user_id] pooled into it
+_status = {"refreshes": 0, "last_refresh": None, "last_seconds": 0.0, "sessions": 0, "users": 0}
+_next_refresh = 0.0
+_refresh_hooks = []
+
+
+def on_refresh(callback):
+    """Register callback(), run after every refresh swaps in new cohorts."""
+    _refresh_hooks.append(callback)
+
+
+def apps_key(app_ids) -> str:
+    """Cohort key for a credential set ('' for no credentials)."""
+    return ",".join(sorted({a for a in app_ids if a}))
+
+
+# ─── Batch Job ───────────────────────────────────────────────────────
+
+def _group_stats(kind, keys, sessions, n, s, ss):
+    """Sum per-user decayed aggregates into one baseline per distinct key (None keys skipped)."""
+    index = {}
+    codes = np.fromiter((index.setdefault(k, len(index)) if k else -1 for k in keys),
+                        dtype=np.int64, count=len(keys))
+    keep = (codes >= 0) & (n > 0)
+    codes, sessions, n, s, ss = codes[keep], sessions[keep], n[keep], s[keep], ss[keep]
+    size = len(index)
+    gn = np.bincount(codes, weights=n, minlength=size)
+    gsessions = np.bincount(codes, weights=sessions, minlength=size)
+    gu = np.bincount(codes, minlength=size)
+    gs = np.stack([np.bincount(codes, weights=s[:, m], minlength=size) for m in range(len(METRICS))], axis=1)
+    gss = np.stack([np.bincount(codes, weights=ss[:, m], minlength=size) for m in range(len(METRICS))], axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = gs / gn[:, None]
+        std = np.sqrt(np.maximum(gss / gn[:, None] - mean * mean, 0.0))
+    ac, dl, du, sw = range(len(METRICS))
+    out = {}
+    for key, i in index.items():
+        if gn[i] <= 0:
+            continue
+        out[f"{kind}:{key}"] = {
+            "avg_actions": float(mean[i, ac]), "std_actions": float(std[i, ac]),
+            "avg_downloads": float(mean[i, dl]),
+            "avg_session_duration": float(mean[i, du]),
+            "avg_switches": float(mean[i, sw]), "std_switches": float(std[i, sw]),
+            "sessions": int(gsessions[i]), "effective_sessions": round(float(gn[i]), 2), "users": int(gu[i]),
+        }
+    return out
+
+
+def refresh() -> dict:
+    """Recompute every cohort baseline from the members' decayed baselines and swap them in."""
+    global _next_refresh
+    started = time.perf_counter()
+    conn = db.get_db_connection()
+    per_user = baselines.decayed_sums()
+    roles = dict(conn["users"].find_fields({}, ("_id", "role")))
+    creds = {}
+    for uid, app_id in conn["user_credentials"].find_fields({}, ("user_id", "app_id")):
+        creds.setdefault(uid, []).append(app_id)
+
+    size = len(per_user)
+    uids = [row[0] for row in per_user]
+    sessions = np.fromiter((row[1] for row in per_user), dtype=np.float64, count=size)
+    n = np.fromiter((row[2] for row in per_user), dtype=np.float64, count=size)
+    s = np.array([row[3] for row in per_user], dtype=np.float64).reshape(size, len(METRICS))
+    ss = np.array([row[4] for row in per_user], dtype=np.float64).reshape(size, len(METRICS))
+
+    role_keys = [roles.get(u) for u in uids]
+    apps_keys = [apps_key(creds.get(u, ())) for u in uids]
+    cohorts = _group_stats("role", role_keys, sessions, n, s, ss)
+    cohorts.update(_group_stats("apps", apps_keys, sessions, n, s, ss))
+    members = {}
+    for kind, keys in (("role", role_keys), ("apps", apps_keys)):
+        for uid, key, weight in zip(uids, keys, n):
+            if key and weight > 0:
+                members.setdefault(f"{kind}:{key}", []).append(uid)
+
+    with _lock:
+        _cohorts.clear()
+        _cohorts.update(cohorts)
+        _members.clear()
+        _members.update(members)
+        _status.update(
+            refreshes=_status["refreshes"] + 1, last_refresh=datetime.utcnow(),
+            last_seconds=round(time.perf_counter() - started, 3), sessions=int(sessions.sum()), users=size,
+        )
+        _next_refresh = time.monotonic() + COHORT_REFRESH_SECONDS
+    for cb in _refresh_hooks:
+        cb()
+    return cohorts
+
+
+def due() -> bool:
+    return time.monotonic() >= _next_refresh
+
+
+# ─── Blending ────────────────────────────────────────────────────────
+
+def cohort_for(role, app_ids=()) -> tuple:
+    """(name, baseline) of the most specific cohort with enough members, or (None, None)."""
+    with _lock:
+        for name in (f"apps:{apps_key(app_ids)}", f"role:{role}"):
+            c = _cohorts.get(name)
+            if c is not None and c["users"] >= COHORT_MIN_USERS:
+                return name, c
+    return None, None
+
+
+def members(name) -> tuple:
+    """User ids pooled into a cohort at the last refresh."""
+    with _lock:
+        return tuple(_members.get(name, ()))
+
+
+def own_weight(effective_sessions) -> float:
+    """The user's share of a blend with their cohort: n / (n + COHORT_PRIOR_SESSIONS)."""
+    if COHORT_PRIOR_SESSIONS <= 0:
+        return 1.0
+    return effective_sessions / (effective_sessions + COHORT_PRIOR_SESSIONS)
+
+
+def _blend_std(w, own, peer):
+    return math.sqrt(w * own * own + (1 - w) * peer * peer)
+
+
+def user_profile(user_id: str, role=None, app_ids=()) -> dict:
+    """The user's decayed baseline blended with their cohort's by sample size."""
+    profile = baselines.user_profile(user_id)
+    name, c = cohort_for(role, app_ids)
+    if c is None:
+        return profile
+    n = profile.get("effective_sessions", 0)
+    w = own_weight(n)
+    thin = n < 2   # the user's own std is a placeholder until then
+    for key in ("avg_actions", "avg_downloads", "avg_session_duration", "avg_switches"):
+        profile[key] = w * profile[key] + (1 - w) * c[key]
+    for key in ("std_actions", "std_switches"):
+        own = c[key] if thin else profile[key]
+        profile[key] = _blend_std(w, own, c[key])
+    profile["std_actions"] = max(1, profile["std_actions"])
+    profile["cohort"] = name
+    profile["cohort_weight"] = round(1 - w, 3)
+    return profile
+
+
+def status() -> dict:
+    with _lock:
+        cohorts = {name: dict(c) for name, c in sorted(_cohorts.items())}
+        return dict(_status, refresh_seconds=COHORT_REFRESH_SECONDS,
+                    prior_sessions=COHORT_PRIOR_SESSIONS, cohorts=cohorts)
+
+
+def _memory_report():
+    with _lock:
+        ids = sum(len(m) for m in _members.values())
+        return {"entries": len(_cohorts), "approx_bytes": len(_cohorts) * 900 + ids * 60}
+
+
+db.on_reset(refresh)
+db.register_index("cohort_baselines", _memory_report)
@@ -0,0 +1,211 @@
+"""
+Continuous Evaluation Worker
+=============================
+Scores active sessions on a schedule, so an idle but compromised session
+is caught even when no request happens to trigger evaluate_session_risk.
+
+Every CONTINUOUS_EVAL_INTERVAL_SECONDS a sweep:
+  1. lists active, non-revoked, unexpired sessions
+  2. picks the CONTINUOUS_EVAL_BATCH most urgent ones, where urgency is
+     staleness (time since the session was last scored) scaled by its last
+     known risk; never-scored sessions come first
+  3. extracts the feature matrix in a worker thread and scores it with
+     batch_risk.score_features in a spawned process pool
+     (CONTINUOUS_EVAL_WORKERS; 0 scores in-process)
+  4. writes results back in bulk: user risk scores and one insert_many of
+     the history rows risk_timeseries.observe() lets through.  Sessions whose decision is not ALLOW are handed to the
+     full evaluate_session_risk path so blocking, incidents and alerts
+     behave exactly as they do on the request path.
+"""
+
+import asyncio
+import heapq
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+import baselines
+import batch_risk
+import cohort
+import db
+import policy
+import risk_timeseries
+from db import get_db_connection
+from risk_engine import evaluate_session_risk
+
+CONTINUOUS_EVAL_INTERVAL_SECONDS = float(os.getenv("CONTINUOUS_EVAL_INTERVAL_SECONDS", "60"))
+CONTINUOUS_EVAL_BATCH = int(os.getenv("CONTINUOUS_EVAL_BATCH", "5000"))
+CONTINUOUS_EVAL_WORKERS = int(os.getenv("CONTINUOUS_EVAL_WORKERS", str(min(4, os.cpu_count() or 1))))
+CHUNK_ROWS = 20_000
+
+_last_scored: dict = {}   # session_id -> (monotonic time, score 0-100)
+_pool = None
+_task = None
+_status = {"sweeps": 0, "last_sweep": None, "last_evaluated": 0, "last_flagged": 0, "last_seconds": 0.0}
+
+
+# ─── Prioritisation ──────────────────────────────────────────────────
+
+def _pick(now):
+    rows = get_db_connection()["sessions"].find_fields(
+        {"revoked": False}, ("session_id", "expires_at"))
+    wall = datetime.utcnow()
+    active = [sid for sid, exp in rows if not (isinstance(exp, datetime) and exp < wall)]
+    live = set(active)
+    for sid in [s for s in _last_scored if s not in live]:
+        del _last_scored[sid]
+
+    def urgency(sid):
+        seen = _last_scored.get(sid)
+        if seen is None:
+            return float("inf")
+        ts, score = seen
+        return (now - ts) * (1 + score / 100)
+    return heapq.nlargest(CONTINUOUS_EVAL_BATCH, active, key=urgency)
+
+
+# ─── Scoring ─────────────────────────────────────────────────────────
+
+async def _score(X, tables):
+    if CONTINUOUS_EVAL_WORKERS <= 0 or len(X) <= CHUNK_ROWS:
+        return batch_risk.score_features(X, tables)
+    global _pool
+    if _pool is None:
+        # Spawn, not fork: forking this multithreaded process could copy a lock held by another thread
+        _pool = ProcessPoolExecutor(max_workers=CONTINUOUS_EVAL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    loop = asyncio.get_running_loop()
+    chunks = [X[i:i + CHUNK_ROWS] for i in range(0, len(X), CHUNK_ROWS)]
+    parts = await asyncio.gather(*(loop.run_in_executor(_pool, batch_risk.score_features, c, tables) for c in chunks))
+    return {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+
+
+def _factors(components, weights):
+    out = []
+    for name, raw in components.items():
+        w = weights.get(name, 0.1)
+        out.append({
+            "factor": name, "raw_risk": raw, "weight": w,
+            "weighted_risk": round(raw * w, 1), "explanation": "Continuous evaluation",
+            "status": "normal" if raw < 30 else "warning" if raw < 60 else "critical",
+        })
+    return out
+
+
+async def _write_back(results, policies):
+    conn = get_db_connection()
+    users = {u["_id"]: u for u in conn["users"].find({"_id": {"$in": {r["user_id"] for r in results}}})}
+    now = datetime.utcnow()
+    mono = time.monotonic()
+
+    history = []
+    user_updates = {}
+    flagged = []
+    for r in results:
+        _last_scored[r["session_id"]] = (mono, r["score"])
+        user = users.get(r["user_id"])
+        if user is None:
+            continue
+        if r["decision"] != "ALLOW":
+            flagged.append(r)
+            continue
+        new = r["score"] / 100.0
+        prev = user_updates.get(r["user_id"])
+        if prev is not None and prev["risk_score"] >= new:
+            continue
+        old = user.get("risk_score", 0)
+        fields = {"risk_score": new, "last_risk_recalc": now}
+        if user.get("access_level") == "restricted":
+            fields["access_level"] = "full"
+        user_updates[r["user_id"]] = fields
+        point = {
+            "user_id": r["user_id"], "session_id": r["session_id"],
+            "old_score": old, "new_score": new, "delta": round(new - old, 4),
+            "timestamp": now, "triggered_by": "continuous_evaluation", "decision": "ALLOW",
+        }
+        if risk_timeseries.observe(point, "ALLOW"):
+            point["factors"] = _factors(r["components"], policies.by_name[r["policy"]].weight_map)
+            history.append(point)
+
+    if user_updates:
+        conn["users"].bulk_set("_id", user_updates)
+    if history:
+        conn["risk_score_history"].insert_many(history)
+    # Escalations go through the full path (explanations, blocking, incidents, alerts)
+    for r in flagged:
+        await evaluate_session_risk(r["user_id"], r["session_id"])
+    return len(flagged)
+
+
+# ─── Sweep Loop ──────────────────────────────────────────────────────
+
+async def sweep():
+    started = time.perf_counter()
+    # Sessions that simply ran out fold into the decayed baselines here
+    baselines.close_expired()
+    if cohort.due():
+        await asyncio.to_thread(cohort.refresh)
+    sids = _pick(time.monotonic())
+    if not sids:
+        return 0
+    policies = policy.current()
+    sids, uids, X = await asyncio.to_thread(batch_risk.extract_features, sids, policies)
+    if not sids:
+        return 0
+    scored = await _score(X, policies.tables())
+    results = batch_risk.format_results(sids, uids, scored, policies)
+    flagged = await _write_back(results, policies)
+
+    _status["sweeps"] += 1
+    _status["last_sweep"] = datetime.utcnow()
+    _status["last_evaluated"] = len(results)
+    _status["last_flagged"] = flagged
+    _status["last_seconds"] = round(time.perf_counter() - started, 3)
+    return len(results)
+
+
+async def _loop():
+    while True:
+        await asyncio.sleep(CONTINUOUS_EVAL_INTERVAL_SECONDS)
+        try:
+            await sweep()
+        except Exception as e:
+            print(f"[WARN] Continuous evaluation sweep failed: {e}")
+
+
+def start():
+    global _task
+    if CONTINUOUS_EVAL_INTERVAL_SECONDS > 0 and _task is None:
+        _task = asyncio.create_task(_loop())
+
+
+def stop():
+    global _task, _pool
+    if _task is not None:
+        _task.cancel()
+        _task = None
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def status():
+    return dict(_status, tracked_sessions=len(_last_scored), interval_seconds=CONTINUOUS_EVAL_INTERVAL_SECONDS)
+
+
+def _on_history_write(before, after):
+    # Any evaluation (request path included) refreshes the session's staleness
+    if after is not None and after.get("session_id") and before is None:
+        _last_scored[after["session_id"]] = (time.monotonic(), after.get("new_score", 0) * 100)
+
+
+def _on_session_write(before, after):
+    if after is None or after.get("revoked"):
+        _last_scored.pop((after or before).get("session_id"), None)
+
+
+db.watch("risk_score_history", _on_history_write)
+db.watch("sessions", _on_session_write)
@@ -0,0 +1,182 @@
+"""
+Incident Correlation
+====================
+create_incident writes one isolated incident per BLOCK decision, so a
+credential-stuffing wave from one IP across 200 users reads as 200
+unrelated incidents.  campaigns() folds recent incidents and alerts into
+campaign-level groups:
+
+  - every incident / alert last seen inside CORRELATION_WINDOW_HOURS becomes a node
+    keyed by user, source IP and device fingerprint (from the fields
+    create_incident / create_alert store, or the session they reference)
+  - time is cut into CORRELATION_BUCKET_MINUTES buckets; each
+    (key, bucket) pair remembers its first node, and a node is unioned with
+    the first node of each of its keys in its own and the previous bucket
+  - a union-find with path halving and union by size merges the groups, so
+    the pass is O(n α(n)) plus one sort, rather than pairwise comparison
+
+Placeholder values ("unknown", "0.0.0.0", empty) are never join keys.
+Results are cached until an incident or alert is written or the window
+start moves into the next bucket: the window start is rounded down to a
+CORRELATION_BUCKET_MINUTES boundary and is part of the cache key, so
+groups that have aged out stop being served within one bucket.
+"""
+
+import heapq
+import os
+import threading
+from datetime import datetime, timedelta
+
+import db
+
+CORRELATION_WINDOW_HOURS = float(os.getenv("CORRELATION_WINDOW_HOURS", "72"))
+CORRELATION_BUCKET_MINUTES = float(os.getenv("CORRELATION_BUCKET_MINUTES", "15"))
+
+_IGNORED = {None, "", "unknown", "Unknown", "0.0.0.0"}
+_LEVELS = {"low": 0, "medium": 1, "high": 2, "critical": 3}
+
+_lock = threading.Lock()
+_version = 0
+_cache = None          # (version, window start, limit, result)
+
+
+class UnionFind:
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+
+
+def _nodes(since):
+    conn = db.get_db_connection()
+    nodes = []   # [timestamp, kind, id, user_id, session_id, ip, device, level, label]
+    for kind, coll, level_field, label_field in (("incident", "incidents", "risk_level", "incident_type"),
+                                                 ("alert", "alerts", "severity", "description")):
+        fields = ("_id", "timestamp", "last_seen", "user_id", "session_id", "ip_address",
+                  "device_fingerprint", level_field, label_field)
+        # Window on the time nodes are ordered by: an aggregated alert first raised before `since`
+        # but still recurring belongs in its campaign.  Documents without last_seen use timestamp.
+        rows = conn[coll].find_fields({"last_seen": {"$gte": since}}, fields)
+        rows += conn[coll].find_fields({"last_seen": None, "timestamp": {"$gte": since}}, fields)
+        for _id, ts, last_seen, uid, sid, ip, dev, level, label in rows:
+            nodes.append([last_seen or ts, kind, _id, uid, sid, ip, dev, level, label])
+
+    # Older documents only carry the session id (or nothing); resolve IP / device from the session
+    missing = {n[4] for n in nodes if n[4] and n[5] is None and n[6] is None}
+    if missing:
+        by_sid = {sid: (ip, dev) for sid, ip, dev in conn["sessions"].find_fields(
+            {"session_id": {"$in": list(missing)}}, ("session_id", "ip_address", "device_fingerprint"))}
+        for n in nodes:
+            if n[4] in by_sid and n[5] is None and n[6] is None:
+                n[5], n[6] = by_sid[n[4]]
+    nodes.sort(key=lambda n: n[0])
+    return nodes
+
+
+def _correlate(nodes):
+    bucket_seconds = CORRELATION_BUCKET_MINUTES * 60
+    uf = UnionFind(len(nodes))
+    first = {}   # (key kind, value, bucket) -> first node index
+    for i, (ts, _, _, uid, _, ip, dev, _, _) in enumerate(nodes):
+        bucket = int(ts.timestamp() // bucket_seconds)
+        for key in (("user", uid), ("ip", ip), ("device", dev)):
+            if key[1] in _IGNORED:
+                continue
+            for b in (bucket - 1, bucket):
+                j = first.get((key[0], key[1], b))
+                if j is not None:
+                    uf.union(i, j)
+            first.setdefault((key[0], key[1], bucket), i)
+    groups = {}
+    for i in range(len(nodes)):
+        groups.setdefault(uf.find(i), []).append(i)
+    return groups.values()
+
+
+def _summarize(nodes, members):
+    items = [nodes[i] for i in members]
+    users = sorted({n[3] for n in items if n[3] is not None})
+    ips = sorted({n[5] for n in items if n[5] not in _IGNORED})
+    devices = sorted({n[6] for n in items if n[6] not in _IGNORED})
+    incidents = [str(n[2]) for n in items if n[1] == "incident"]
+    alerts = [str(n[2]) for n in items if n[1] == "alert"]
+    level = max((n[7] for n in items if n[7] in _LEVELS), key=_LEVELS.get, default="medium")
+    labels = {}
+    for n in items:
+        if n[1] == "incident" and n[8]:
+            labels[n[8]] = labels.get(n[8], 0) + 1
+    if len(users) > 1 and (ips or devices):
+        pattern = "shared_infrastructure"   # one IP / device behind incidents on many accounts
+    elif len(users) > 1:
+        pattern = "concurrent_users"
+    else:
+        pattern = "single_user"
+    return {
+        "id": f"campaign-{incidents[0] if incidents else alerts[0]}",
+        "pattern": pattern,
+        "risk_level": level,
+        "users": users,
+        "ip_addresses": ips,
+        "devices": devices,
+        "incident_types": labels,
+        "incident_count": len(incidents),
+        "alert_count": len(alerts),
+        "first_seen": items[0][0],
+        "last_seen": items[-1][0],
+        "incident_ids": incidents,
+        "alert_ids": alerts,
+    }
+
+
+def _rank(nodes, members):
+    users = {nodes[i][3] for i in members}
+    level = max((_LEVELS.get(nodes[i][7], 0) for i in members), default=0)
+    return len(users), level, len(members), nodes[members[-1]][0]
+
+
+def campaigns(window_hours: float = None, limit: int = 100) -> list:
+    """Recent incidents and alerts merged into campaigns; the `limit` widest / most severe first."""
+    window_hours = CORRELATION_WINDOW_HOURS if window_hours is None else window_hours
+    bucket_seconds = CORRELATION_BUCKET_MINUTES * 60
+    since = datetime.utcnow() - timedelta(hours=window_hours)
+    since = datetime.fromtimestamp(since.timestamp() // bucket_seconds * bucket_seconds)
+    global _cache
+    with _lock:
+        if _cache is not None and _cache[:3] == (_version, since, limit):
+            return _cache[3]
+        version = _version
+    nodes = _nodes(since)
+    groups = list(_correlate(nodes))   # members are in time order
+    top = heapq.nlargest(limit, groups, key=lambda m: _rank(nodes, m))
+    result = [_summarize(nodes, members) for members in top]
+    with _lock:
+        if version == _version:
+            _cache = (version, since, limit, result)
+    return result
+
+
+def _invalidate(before, after):
+    global _version, _cache
+    with _lock:
+        _version += 1
+        _cache = None
+
+
+db.watch("incidents", _invalidate)
+db.watch("alerts", _invalidate)
+db.on_reset(lambda: _invalidate(None, None))
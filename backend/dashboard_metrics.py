@@ -0,0 +1,225 @@
+"""
+Dashboard Metrics
+=================
+The admin dashboard polls every 5 seconds per open tab, and each poll used
+to scan users, sessions, alerts, incidents and audit_trail in full.  This
+module keeps every dashboard number current from db.watch hooks instead, so
+snapshot() costs the same at 5 users or 5 million:
+
+  - plain counters: total / blocked / critical users, the risk score sum
+    (for the average), suspicious open sessions, attack incidents and
+    resolving admin actions; each write applies (new contribution - old)
+  - RingCounter: fixed-width buckets over a sliding window for "active in
+    the last 30 minutes" (session last_activity, 10 s buckets) and "in the
+    last 24 hours" (alert and incident timestamps, 1 min buckets); expired
+    buckets are subtracted as the ring advances, so reads are O(1)
+    amortized.  Counts are exact except for up to one bucket's worth of
+    events at the trailing edge of the window.
+
+The top-risk list comes from risk_index, which keeps users ordered by score.
+
+rebuild() recounts from the collections (import time and snapshot loads).
+"""
+
+import threading
+from datetime import datetime
+
+import db
+
+ACTIVE_WINDOW_SECONDS = 30 * 60
+RECENT_WINDOW_SECONDS = 24 * 3600
+ACTIVE_BUCKET_SECONDS = 10
+RECENT_BUCKET_SECONDS = 60
+
+CRITICAL_RISK = 0.6
+SUSPICIOUS_LOGIN_RISK = 0.3
+ATTACK_INCIDENTS = ("simulated_attack", "high_risk_session")
+RESOLVING_ACTIONS = ("mark_safe", "unblock", "dismiss_alert", "resolve_incident")
+
+_lock = threading.Lock()
+
+
+def _epoch(ts):
+    # Timestamps are naive UTC; compare them with utcnow() on the same scale
+    return ts.timestamp() if isinstance(ts, datetime) else None
+
+
+def _now():
+    return datetime.utcnow().timestamp()
+
+
+class RingCounter:
+    """Event count over the trailing `window` seconds in `bucket`-second slots."""
+
+    def __init__(self, window, bucket):
+        self.bucket = bucket
+        self.n = int(window // bucket) + 1
+        self.ids = [None] * self.n
+        self.counts = [0] * self.n
+        self.head = int(_now() // bucket)
+        self.total = 0
+
+    def _advance(self, b):
+        if b <= self.head:
+            return
+        if b - self.head >= self.n:
+            self.ids = [None] * self.n
+            self.counts = [0] * self.n
+            self.total = 0
+        else:
+            for old in range(self.head + 1 - self.n, b + 1 - self.n):
+                slot = old % self.n
+                if self.ids[slot] == old:
+                    self.total -= self.counts[slot]
+                    self.ids[slot], self.counts[slot] = None, 0
+        self.head = b
+
+    def add(self, ts, delta=1):
+        if ts is None:
+            return
+        b = int(ts // self.bucket)
+        self._advance(b)
+        if b <= self.head - self.n:
+            return          # already expired (or never counted)
+        slot = b % self.n
+        if self.ids[slot] != b:
+            self.ids[slot], self.counts[slot] = b, 0
+        self.counts[slot] += delta
+        self.total += delta
+
+    def count(self, now=None):
+        self._advance(int((_now() if now is None else now) // self.bucket))
+        return self.total
+
+
+_counts = {}
+_active = RingCounter(ACTIVE_WINDOW_SECONDS, ACTIVE_BUCKET_SECONDS)
+_recent_alerts = RingCounter(RECENT_WINDOW_SECONDS, RECENT_BUCKET_SECONDS)
+_recent_incidents = RingCounter(RECENT_WINDOW_SECONDS, RECENT_BUCKET_SECONDS)
+
+
+def _reset_state():
+    global _active, _recent_alerts, _recent_incidents
+    _counts.clear()
+    _counts.update(total_users=0, blocked_accounts=0, critical_risks=0, risk_sum=0.0,
+                   suspicious_sessions=0, attack_attempts=0, resolved_by_admin=0)
+    _active = RingCounter(ACTIVE_WINDOW_SECONDS, ACTIVE_BUCKET_SECONDS)
+    _recent_alerts = RingCounter(RECENT_WINDOW_SECONDS, RECENT_BUCKET_SECONDS)
+    _recent_incidents = RingCounter(RECENT_WINDOW_SECONDS, RECENT_BUCKET_SECONDS)
+
+
+# ─── Write Hooks ─────────────────────────────────────────────────────
+
+def _apply_user(doc, sign):
+    score = doc.get("risk_score", 0)
+    _counts["total_users"] += sign
+    _counts["risk_sum"] += sign * score
+    if score > CRITICAL_RISK:
+        _counts["critical_risks"] += sign
+    if doc.get("access_level") == "blocked" or not doc.get("is_active", True):
+        _counts["blocked_accounts"] += sign
+
+
+def _on_user_write(before, after):
+    with _lock:
+        if before is not None:
+            _apply_user(before, -1)
+        if after is not None:
+            _apply_user(after, 1)
+
+
+def _apply_session(doc, sign):
+    if doc.get("revoked") is not False:
+        return      # same as the {"revoked": False} query: unset counts as not open
+    if doc.get("risk_at_login", 0) >= SUSPICIOUS_LOGIN_RISK:
+        _counts["suspicious_sessions"] += sign
+    _active.add(_epoch(doc.get("last_activity")), sign)
+
+
+def _on_session_write(before, after):
+    with _lock:
+        if before is not None:
+            _apply_session(before, -1)
+        if after is not None:
+            _apply_session(after, 1)
+
+
+def _on_alert_write(before, after):
+    with _lock:
+        if before is not None:
+            _recent_alerts.add(_epoch(before.get("timestamp")), -1)
+        if after is not None:
+            _recent_alerts.add(_epoch(after.get("timestamp")), 1)
+
+
+def _apply_incident(doc, sign):
+    _recent_incidents.add(_epoch(doc.get("timestamp")), sign)
+    if doc.get("incident_type") in ATTACK_INCIDENTS:
+        _counts["attack_attempts"] += sign
+
+
+def _on_incident_write(before, after):
+    with _lock:
+        if before is not None:
+            _apply_incident(before, -1)
+        if after is not None:
+            _apply_incident(after, 1)
+
+
+def _on_audit_write(before, after):
+    with _lock:
+        if before is not None and before.get("action") in RESOLVING_ACTIONS:
+            _counts["resolved_by_admin"] -= 1
+        if after is not None and after.get("action") in RESOLVING_ACTIONS:
+            _counts["resolved_by_admin"] += 1
+
+
+def rebuild():
+    """Recount everything from the collections."""
+    conn = db.get_db_connection()
+    users = conn["users"].find_fields({}, ("risk_score", "access_level", "is_active"))
+    sessions = conn["sessions"].find_fields({"revoked": False}, ("risk_at_login", "last_activity"))
+    alerts = conn["alerts"].find_fields({}, ("timestamp",))
+    incidents = conn["incidents"].find_fields({}, ("timestamp", "incident_type"))
+    resolved = conn["audit_trail"].count_documents({"action": {"$in": list(RESOLVING_ACTIONS)}})
+    with _lock:
+        _reset_state()
+        for score, access, active in users:
+            _apply_user({"risk_score": score or 0, "access_level": access,
+                         "is_active": True if active is None else active}, 1)
+        for risk, last_activity in sessions:
+            _apply_session({"revoked": False, "risk_at_login": risk or 0, "last_activity": last_activity}, 1)
+        for (ts,) in alerts:
+            _recent_alerts.add(_epoch(ts))
+        for ts, kind in incidents:
+            _apply_incident({"timestamp": ts, "incident_type": kind}, 1)
+        _counts["resolved_by_admin"] = resolved
+
+
+# ─── Reads ───────────────────────────────────────────────────────────
+
+def snapshot() -> dict:
+    with _lock:
+        total = _counts["total_users"]
+        return {
+            "total_users": total,
+            "active_users": _active.count(),
+            "critical_risks": _counts["critical_risks"],
+            "suspicious_sessions": _counts["suspicious_sessions"],
+            "blocked_accounts": _counts["blocked_accounts"],
+            "recent_alerts": _recent_alerts.count(),
+            "incidents_24h": _recent_incidents.count(),
+            "avg_risk_score": round(_counts["risk_sum"] / total, 4) if total else 0,
+            "attack_attempts": _counts["attack_attempts"],
+            "resolved_by_admin": _counts["resolved_by_admin"],
+        }
+
+
+_reset_state()
+db.watch("users", _on_user_write)
+db.watch("sessions", _on_session_write)
+db.watch("alerts", _on_alert_write)
+db.watch("incidents", _on_incident_write)
+db.watch("audit_trail", _on_audit_write)
+db.on_reset(rebuild)
+rebuild()
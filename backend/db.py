@@ -3,14 +3,44 @@ In-Memory Database Engine for Zero Trust Security Platform
 MongoDB-compatible API backed by Python dicts - no external DB required.
 """
 
+import os
+import pickle
+import sys
+import tempfile
 import threading
 import uuid
 import random
 from datetime import datetime, timedelta
 from copy import deepcopy
+from segments import SpillSegment
 
 _lock = threading.Lock()
 _store: dict = {}
+_segments: dict = {}        # collection -> cold segments (SpillSegment / ArchiveBlock)
+_index_reporters: dict = {}  # name -> callable returning {"entries", "approx_bytes"}
+_watchers: dict = {}         # collection -> [callback(before, after)]
+_reset_hooks: list = []      # called after the whole store is replaced
+_mutations: dict = {}        # collection -> count of in-place updates / removals (bumped under _lock)
+_op_observer = None          # callback(collection, op, docs_scanned), set while tracing is on
+
+# Append-only log collections and the timestamp field their cold data is
+# partitioned on.  Only these are ever spilled; spilled documents are
+# read-only (updates and deletes only see the hot store).
+LOG_COLLECTIONS = {
+    "behavior_logs": "timestamp",
+    "user_activity_logs": "timestamp",
+    "risk_score_history": "timestamp",
+    "audit_trail": "timestamp",
+    "mfa_logs": "timestamp",
+}
+MEMORY_BUDGET_MB = float(os.getenv("DB_MEMORY_BUDGET_MB", "0"))   # 0 = unbounded
+SPILL_DIR = os.getenv("DB_SPILL_DIR", os.path.join(tempfile.gettempdir(), "zerotrust_spill"))
+SPILL_HOT_HOURS = float(os.getenv("DB_SPILL_HOT_HOURS", "24"))   # never spill newer data
+SPILL_SEGMENT_DOCS = 50_000
+SPILL_CHECK_EVERY = 5_000
+ACCOUNTING_SAMPLE = 256
+_inserts_since_check = 0
+_spill_lock = threading.Lock()   # one spill pass at a time; never acquired while holding _lock
 
 
 class InsertResult:
@@ -97,6 +127,58 @@ def _apply_update(doc, update):
             doc[k].append(v)
 
 
+def watch(collection, callback):
+    """Call `callback(before, after)` after every write to `collection`.
+
+    `before` is None for inserts and `after` is None for deletes.  Both are
+    the stored documents themselves (before is a shallow copy), so callbacks
+    must treat them as read-only.  Callbacks run outside the store lock.
+    """
+    _watchers.setdefault(collection, []).append(callback)
+
+
+def on_reset(callback):
+    """Call `callback()` after the store has been replaced wholesale (load)."""
+    _reset_hooks.append(callback)
+
+
+def set_op_observer(callback):
+    """Call `callback(collection, op, docs_scanned)` after every collection operation.
+
+    Pass None to remove it.  Used by tracing.py; unset, each operation pays
+    a single global lookup.
+    """
+    global _op_observer
+    _op_observer = callback
+
+
+def _notify(name, changes):
+    callbacks = _watchers.get(name)
+    if not callbacks or not changes:
+        return
+    for before, after in changes:
+        for cb in callbacks:
+            cb(before, after)
+
+
+def _mutated(name):
+    _mutations[name] = _mutations.get(name, 0) + 1
+
+
+def mutation_count(name):
+    """Changes to existing documents of `name` so far; compare two reads (under _lock) to detect them."""
+    return _mutations.get(name, 0)
+
+
+def _cold_docs(name, query):
+    """Page in cold segments whose zone maps (time range, user_id filter) can match the query (caller holds _lock)."""
+    out = []
+    for seg in _segments.get(name, ()):
+        if seg.may_match(query):
+            out.extend(d for d in seg.docs(query) if _match(d, query))
+    return out
+
+
 class Collection:
     def __init__(self, name):
         self.name = name
@@ -106,14 +188,43 @@ class Collection:
     def find(self, query=None, projection=None):
         with _lock:
             docs = _store.get(self.name, [])
-            return Cursor([deepcopy(d) for d in docs if _match(d, query)])
+            hot = [deepcopy(d) for d in docs if _match(d, query)]
+            cold = _cold_docs(self.name, query)
+        if _op_observer is not None:
+            _op_observer(self.name, "find", len(docs) + len(cold))
+        return Cursor(cold + hot)
 
     def find_one(self, query):
+        found = None
         with _lock:
-            for doc in _store.get(self.name, []):
+            docs = _store.get(self.name, [])
+            for scanned, doc in enumerate(docs, 1):
                 if _match(doc, query):
-                    return deepcopy(doc)
-            return None
+                    found = deepcopy(doc)
+                    break
+            else:
+                scanned = len(docs)
+                cold = _cold_docs(self.name, query)
+                scanned += len(cold)
+                if cold:
+                    found = cold[0]
+        if _op_observer is not None:
+            _op_observer(self.name, "find_one", scanned)
+        return found
+
+    def find_fields(self, query, fields):
+        """Tuples of `fields` for matching docs, without copying whole documents.
+
+        Meant for bulk read-only passes; mutable values (lists, dicts) are
+        shared with the store and must not be modified.
+        """
+        with _lock:
+            hot = _store.get(self.name, [])
+            docs = _cold_docs(self.name, query) + [d for d in hot if _match(d, query)]
+            rows = [tuple(map(d.get, fields)) for d in docs]
+        if _op_observer is not None:
+            _op_observer(self.name, "find_fields", len(hot) + len(docs))
+        return rows
 
     def insert_one(self, doc):
         with _lock:
@@ -121,35 +232,89 @@ class Collection:
             if "_id" not in doc:
                 doc["_id"] = str(uuid.uuid4())
             _store.setdefault(self.name, []).append(doc)
-            return InsertResult(doc["_id"])
+            spill_due = _note_insert(self.name, 1)
+        if spill_due:
+            _spill()
+        _notify(self.name, [(None, doc)])
+        if _op_observer is not None:
+            _op_observer(self.name, "insert_one", 0)
+        return InsertResult(doc["_id"])
 
     def insert_many(self, docs):
         with _lock:
             ids = []
+            added = []
             for doc in docs:
                 doc = deepcopy(doc)
                 if "_id" not in doc:
                     doc["_id"] = str(uuid.uuid4())
                 _store.setdefault(self.name, []).append(doc)
                 ids.append(doc["_id"])
-            return ids
+                added.append((None, doc))
+            spill_due = _note_insert(self.name, len(ids))
+        if spill_due:
+            _spill()
+        _notify(self.name, added)
+        if _op_observer is not None:
+            _op_observer(self.name, "insert_many", 0)
+        return ids
 
     def update_one(self, query, update):
+        watched = self.name in _watchers
         with _lock:
-            for doc in _store.get(self.name, []):
+            docs = _store.get(self.name, [])
+            for scanned, doc in enumerate(docs, 1):
                 if _match(doc, query):
+                    before = dict(doc) if watched else None
                     _apply_update(doc, update)
-                    return True
-            return False
+                    _mutated(self.name)
+                    break
+            else:
+                if _op_observer is not None:
+                    _op_observer(self.name, "update_one", len(docs))
+                return False
+        if watched:
+            _notify(self.name, [(before, doc)])
+        if _op_observer is not None:
+            _op_observer(self.name, "update_one", scanned)
+        return True
 
     def update_many(self, query, update):
+        watched = self.name in _watchers
+        changes = []
         with _lock:
             count = 0
             for doc in _store.get(self.name, []):
                 if _match(doc, query):
+                    before = dict(doc) if watched else None
                     _apply_update(doc, update)
+                    _mutated(self.name)
+                    if watched:
+                        changes.append((before, doc))
                     count += 1
-            return count
+        _notify(self.name, changes)
+        if _op_observer is not None:
+            _op_observer(self.name, "update_many", len(_store.get(self.name, ())))
+        return count
+
+    def bulk_set(self, field, updates):
+        """Apply {"$set": fields} per doc in one pass; `updates` maps doc[field] -> fields."""
+        watched = self.name in _watchers
+        changes = []
+        with _lock:
+            for doc in _store.get(self.name, []):
+                fields = updates.get(doc.get(field))
+                if fields is None:
+                    continue
+                before = dict(doc) if watched else None
+                doc.update(fields)
+                changes.append((before, doc))
+            if changes:
+                _mutated(self.name)
+        _notify(self.name, changes if watched else [])
+        if _op_observer is not None:
+            _op_observer(self.name, "bulk_set", len(_store.get(self.name, ())))
+        return len(changes)
 
     def delete_one(self, query):
         with _lock:
@@ -157,25 +322,49 @@ class Collection:
             for i, doc in enumerate(docs):
                 if _match(doc, query):
                     docs.pop(i)
-                    return True
-            return False
+                    _mutated(self.name)
+                    break
+            else:
+                if _op_observer is not None:
+                    _op_observer(self.name, "delete_one", len(docs))
+                return False
+        _notify(self.name, [(doc, None)])
+        if _op_observer is not None:
+            _op_observer(self.name, "delete_one", i + 1)
+        return True
 
     def count_documents(self, query=None):
         with _lock:
+            docs = _store.get(self.name, [])
             if not query:
-                return len(_store.get(self.name, []))
-            return sum(1 for d in _store.get(self.name, []) if _match(d, query))
+                scanned = 0
+                count = len(docs) + sum(seg.count for seg in _segments.get(self.name, []))
+            else:
+                cold = len(_cold_docs(self.name, query))
+                scanned = len(docs) + cold
+                count = sum(1 for d in docs if _match(d, query)) + cold
+        if _op_observer is not None:
+            _op_observer(self.name, "count_documents", scanned)
+        return count
 
     def distinct(self, field, query=None):
         with _lock:
             docs = _store.get(self.name, [])
             if query:
                 docs = [d for d in docs if _match(d, query)]
-            return list(set(d.get(field) for d in docs if d.get(field) is not None))
+            scanned = len(_store.get(self.name, []))
+            docs = _cold_docs(self.name, query) + docs
+            values = list(set(d.get(field) for d in docs if d.get(field) is not None))
+        if _op_observer is not None:
+            _op_observer(self.name, "distinct", scanned)
+        return values
 
     def aggregate(self, pipeline):
         with _lock:
-            docs = [deepcopy(d) for d in _store.get(self.name, [])]
+            first_match = pipeline[0].get("$match") if pipeline else None
+            docs = _cold_docs(self.name, first_match) + [deepcopy(d) for d in _store.get(self.name, [])]
+            if _op_observer is not None:
+                _op_observer(self.name, "aggregate", len(docs))
             for stage in pipeline:
                 if "$match" in stage:
                     query = stage["$match"]
@@ -228,6 +417,198 @@ class InMemoryDB:
         if name not in _store:
             _store[name] = []
 
+    def dump(self, path):
+        return dump(path)
+
+    def load(self, path):
+        return load(path)
+
+
+# ─── Snapshots ───────────────────────────────────────────────────────
+# Binary image of the whole store for warm starts and benchmark fixtures.
+# The payload is a single pickle (protocol 5) so the C unpickler rebuilds
+# every collection in one pass; string values shared between documents
+# are written once and come back as shared objects.
+
+SNAPSHOT_MAGIC = b"ZTDB"
+SNAPSHOT_VERSION = 1
+
+
+def _intern_strings(docs, pool):
+    out = []
+    for d in docs:
+        out.append({k: pool.setdefault(v, v) if type(v) is str else v for k, v in d.items()})
+    return out
+
+
+def dump(path):
+    """Write the whole store to `path` atomically. Returns the document count."""
+    with _lock:
+        pool = {}
+        payload = {
+            name: _intern_strings(_cold_docs(name, None) + docs, pool)
+            for name, docs in _store.items()
+        }
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]))
+        pickle.dump(payload, f, protocol=5)
+    os.replace(tmp, path)
+    return sum(len(docs) for docs in payload.values())
+
+
+def load(path):
+    """Replace the store with the snapshot at `path`. Returns the document count."""
+    with open(path, "rb") as f:
+        header = f.read(len(SNAPSHOT_MAGIC) + 1)
+        if header[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a database snapshot")
+        if header[-1] != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {header[-1]}")
+        payload = pickle.load(f)
+    with _lock:
+        for segs in _segments.values():
+            for seg in segs:
+                seg.drop()
+        _segments.clear()
+        _store.clear()
+        _store.update(payload)
+    for hook in _reset_hooks:
+        hook()
+    return sum(len(docs) for docs in payload.values())
+
+
+# ─── Memory Accounting & Cold Spill ──────────────────────────────────
+
+def approx_size(obj):
+    """Rough deep size in bytes. Dict keys are skipped (they are shared literals)."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(approx_size(v) for v in obj.values())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(approx_size(v) for v in obj)
+    return size
+
+
+def _estimate_bytes(docs):
+    if not docs:
+        return sys.getsizeof(docs)
+    step = max(1, len(docs) // ACCOUNTING_SAMPLE)
+    sample = docs[::step]
+    return int(sum(approx_size(d) for d in sample) / len(sample) * len(docs)) + sys.getsizeof(docs)
+
+
+def register_index(name, reporter):
+    """Register an in-memory side structure so it shows up in memory_stats()."""
+    _index_reporters[name] = reporter
+
+
+def memory_stats():
+    with _lock:
+        collections = {}
+        for name, docs in _store.items():
+            segs = _segments.get(name, [])
+            collections[name] = {
+                "documents": len(docs),
+                "approx_bytes": _estimate_bytes(docs),
+                "cold_segments": len(segs),
+                "cold_documents": sum(seg.count for seg in segs),
+                "cold_disk_bytes": sum(seg.nbytes for seg in segs),
+            }
+    indexes = {name: reporter() for name, reporter in _index_reporters.items()}
+    total = sum(c["approx_bytes"] for c in collections.values())
+    total += sum(i.get("approx_bytes", 0) for i in indexes.values())
+    return {
+        "approx_bytes": total,
+        "budget_bytes": int(MEMORY_BUDGET_MB * 1024 * 1024),
+        "collections": collections,
+        "indexes": indexes,
+        "segments": {name: [seg.stats() for seg in segs] for name, segs in _segments.items()},
+    }
+
+
+def enforce_memory_budget():
+    """Spill cold log data until the hot store fits the budget. Returns docs spilled."""
+    return _spill()
+
+
+def _note_insert(name, n):
+    """Count inserts (caller holds _lock); True when the caller should run a spill check after unlocking."""
+    global _inserts_since_check
+    if MEMORY_BUDGET_MB <= 0 or name not in LOG_COLLECTIONS:
+        return False
+    _inserts_since_check += n
+    if _inserts_since_check < SPILL_CHECK_EVERY:
+        return False
+    _inserts_since_check = 0
+    return True
+
+
+def _spill_plan():
+    """Pick the oldest log documents to spill, largest collections first (caller holds _lock)."""
+    budget = MEMORY_BUDGET_MB * 1024 * 1024
+    usage = sum(_estimate_bytes(docs) for docs in _store.values())
+    if usage <= budget:
+        return []
+
+    cutoff = datetime.utcnow() - timedelta(hours=SPILL_HOT_HOURS)
+    plan = []
+    for name in sorted(LOG_COLLECTIONS, key=lambda n: len(_store.get(n, [])), reverse=True):
+        field = LOG_COLLECTIONS[name]
+        docs = _store.get(name, [])
+        cold = [d for d in docs if isinstance(d.get(field), datetime) and d[field] < cutoff]
+        if not cold:
+            continue
+        per_doc = max(1, _estimate_bytes(docs) / len(docs))
+        cold.sort(key=lambda d: d[field])
+        cold = cold[:int((usage - budget) / per_doc) + 1]
+        plan.append((name, field, docs, cold, mutation_count(name)))
+        usage -= per_doc * len(cold)
+        if usage <= budget:
+            break
+    return plan
+
+
+def _spill():
+    """Move cold log data to disk segments.
+
+    Like archive.archive_old_logs, _lock is held only to choose the documents
+    and to swap the written segments in; the pickling and file writes run
+    unlocked.  A collection whose rows were updated, removed or reset in
+    between (its mutation counter moved) keeps them hot until the next check.
+    """
+    if MEMORY_BUDGET_MB <= 0 or not _spill_lock.acquire(blocking=False):
+        return 0
+    try:
+        with _lock:
+            plan = _spill_plan()
+        spilled = 0
+        for name, field, hot, cold, version in plan:
+            segs = []
+            try:
+                for i in range(0, len(cold), SPILL_SEGMENT_DOCS):
+                    segs.append(SpillSegment.write(SPILL_DIR, name, field, cold[i:i + SPILL_SEGMENT_DOCS]))
+            except RuntimeError:
+                # A row was updated mid-pickle ("dict changed size"); the counter check would reject it anyway
+                version = None
+            with _lock:
+                current = _store.get(name) is hot and mutation_count(name) == version
+                if current:
+                    _segments.setdefault(name, []).extend(segs)
+                    moved = {id(d) for d in cold}
+                    hot[:] = [d for d in hot if id(d) not in moved]
+                    _mutated(name)
+                    spilled += len(cold)
+            if not current:
+                for seg in segs:
+                    seg.drop()
+                print(f"[WARN] {name} changed while spilling; retrying at the next check")
+    finally:
+        _spill_lock.release()
+    if spilled:
+        print(f"[DB] Spilled {spilled} cold log documents to {SPILL_DIR}")
+    return spilled
+
 
 _db = InMemoryDB()
 
@@ -241,6 +622,7 @@ async def init_db():
         "users", "sessions", "behavior_logs", "incidents", "alerts",
         "risk_score_history", "audit_trail", "apps", "user_credentials",
         "login_windows", "emergency_requests", "mfa_logs", "session_behavior",
+        "trusted_networks",
     ]:
         _db.create_collection(c)
     print("[OK] Database collections initialized")
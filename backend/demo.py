@@ -7,6 +7,7 @@ Provides simulate_attack() for live hackathon demo.
 
 from datetime import datetime, timedelta
 import random
+import geoip
 from db import get_db_connection
 from utils import hash_password, generate_session_id
 
@@ -19,6 +20,16 @@ ATTACK_DEVICES = [
 NORMAL_IP_PREFIX = "192.168.1."
 NORMAL_DEVICE = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/120.0"
 
+DEMO_APPS = [
+    {"_id": "app_crm", "name": "CRM Portal", "description": "Customer relationship management", "url": "https://crm.internal"},
+    {"_id": "app_hr", "name": "HR System", "description": "Human resources", "url": "https://hr.internal"},
+    {"_id": "app_finance", "name": "Finance Dashboard", "description": "Financial reporting", "url": "https://finance.internal"},
+    {"_id": "app_email", "name": "Email Server", "description": "Corporate email", "url": "https://mail.internal"},
+    {"_id": "app_files", "name": "File Storage", "description": "Document management", "url": "https://files.internal"},
+    {"_id": "app_admin", "name": "Admin Console", "description": "System administration (restricted)", "url": "https://admin.internal"},
+    {"_id": "app_analytics", "name": "Analytics Platform", "description": "Business intelligence", "url": "https://analytics.internal"},
+]
+
 
 async def seed_demo_data():
     db = get_db_connection()
@@ -29,15 +40,7 @@ async def seed_demo_data():
     print("Seeding demo data...")
 
     # ── Services ──
-    apps = [
-        {"_id": "app_crm", "name": "CRM Portal", "description": "Customer relationship management", "url": "https://crm.internal"},
-        {"_id": "app_hr", "name": "HR System", "description": "Human resources", "url": "https://hr.internal"},
-        {"_id": "app_finance", "name": "Finance Dashboard", "description": "Financial reporting", "url": "https://finance.internal"},
-        {"_id": "app_email", "name": "Email Server", "description": "Corporate email", "url": "https://mail.internal"},
-        {"_id": "app_files", "name": "File Storage", "description": "Document management", "url": "https://files.internal"},
-        {"_id": "app_admin", "name": "Admin Console", "description": "System administration (restricted)", "url": "https://admin.internal"},
-        {"_id": "app_analytics", "name": "Analytics Platform", "description": "Business intelligence", "url": "https://analytics.internal"},
-    ]
+    apps = [dict(a) for a in DEMO_APPS]
     for a in apps:
         a["created_at"] = datetime.utcnow()
         db["apps"].insert_one(a)
@@ -191,16 +194,19 @@ async def simulate_attack(target_user_id: str = None):
     sid = generate_session_id()
     aip = random.choice(ATTACK_IPS)
     adev = random.choice(ATTACK_DEVICES)
+    geo = geoip.lookup(aip)
     ahour = random.choice([0, 1, 2, 3, 23])
     login_time = datetime.utcnow().replace(hour=ahour, minute=random.randint(0, 59))
 
-    db["sessions"].insert_one({
+    attack_session = {
         "session_id": sid, "user_id": target_user_id,
         "ip_address": aip, "device_fingerprint": adev, "user_agent": adev,
         "start_time": login_time, "last_activity": datetime.utcnow(),
         "expires_at": datetime.utcnow() + timedelta(hours=24),
         "mfa_verified": False, "risk_at_login": 0.0, "revoked": False,
-    })
+        "geo": geo,
+    }
+    db["sessions"].insert_one(attack_session)
 
     dl_count = random.randint(50, 200)
     action_count = random.randint(150, 300)
@@ -208,7 +214,7 @@ async def simulate_attack(target_user_id: str = None):
         "session_id": sid, "user_id": target_user_id,
         "login_timestamp": login_time, "ip_address": aip,
         "device_info": adev,
-        "location": random.choice(["Tor Network", "Moscow, Russia", "Beijing, China"]),
+        "location": geo["location"] if geo else random.choice(["Tor Network", "Moscow, Russia", "Beijing, China"]),
         "accessed_services": ["Admin Console", "Finance Dashboard", "HR System", "File Storage"],
         "action_count": action_count, "download_count": dl_count,
         "duration_minutes": random.randint(5, 15),
@@ -234,11 +240,13 @@ async def simulate_attack(target_user_id: str = None):
         f"SIMULATED ATTACK: Session from {aip} at {ahour}:00. "
         f"{dl_count} downloads, unauthorized service access.",
         risk.get("breakdown", []),
+        source=attack_session,
     )
     await create_alert(
         target_user_id, "critical",
         f"ATTACK SIM: {target.get('name')} blocked — Risk {risk.get('score', 0)}/100",
         {"simulation": True, "risk_result": risk},
+        reason="simulated_attack", source=attack_session,
     )
 
     return {
@@ -1,14 +1,15 @@
 import logging
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 import os
 
+import mail_queue
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Email Configuration (Set these via environment variables for production)
+# Email Configuration (Set these via environment variables for production).
+# Delivery happens in mail_queue's background sender; these functions only
+# build the message and enqueue it, so callers never block on SMTP.
 SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
 SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
 SMTP_USER = os.getenv("SMTP_USER", "")
@@ -20,17 +21,8 @@ SIMULATION_MODE = not (SMTP_USER and SMTP_PASSWORD)
 
 def send_access_notification(user_email: str, user_name: str, app_name: str, username: str):
     """
-    Sends an email notification to the user when they are granted access to an application.
+    Queues an email notification to the user when they are granted access to an application.
     """
-    # Fetch latest config in case they were updated after module load
-    server_addr = os.getenv("SMTP_SERVER", "smtp.gmail.com")
-    port = int(os.getenv("SMTP_PORT", "587"))
-    user = os.getenv("SMTP_USER", "")
-    password = os.getenv("SMTP_PASSWORD", "")
-    sender = os.getenv("EMAIL_FROM", "noreply@zerotrust.io")
-    
-    is_sim = not (user and password)
-
     subject = f"Access Granted: {app_name} - Zero Trust Platform"
     
     body = f"""
@@ -47,7 +39,7 @@ def send_access_notification(user_email: str, user_name: str, app_name: str, use
     Zero Trust Admin Team
     """
 
-    if is_sim:
+    if mail_queue.simulated():
         logger.info("═══ EMAIL SIMULATION ═══")
         logger.info(f"Target: {user_email}")
         logger.info(f"Using App: {app_name}")
@@ -55,41 +47,13 @@ def send_access_notification(user_email: str, user_name: str, app_name: str, use
         logger.info("════════════════════════")
         return True
 
-    logger.info(f"Attempting to send real email to {user_email} via {server_addr}:{port}...")
-    try:
-        msg = MIMEMultipart()
-        msg['From'] = sender
-        msg['To'] = user_email
-        msg['Subject'] = subject
-        msg.attach(MIMEText(body, 'plain'))
-
-        logger.info(f"Connecting to SMTP server {server_addr}...")
-        server = smtplib.SMTP(server_addr, port)
-        server.set_debuglevel(1)  # Enable detailed SMTP debug output
-        server.starttls()
-        logger.info(f"Logging in as {user}...")
-        server.login(user, password)
-        server.send_message(msg)
-        server.quit()
-        
-        logger.info(f"SUCCESS: Notification email sent to {user_email}")
-        return True
-    except Exception as e:
-        logger.error(f"Failed to send email to {user_email}: {str(e)}")
-        return False
+    mail_queue.enqueue([user_email], subject, body)
+    return True
 
 def send_security_alert(admin_emails: list, target_user: str, risk_score: float, details: str):
     """
-    Sends a high-priority security alert to all administrators.
+    Queues a high-priority security alert for all administrators.
     """
-    server_addr = os.getenv("SMTP_SERVER", "smtp.gmail.com")
-    port = int(os.getenv("SMTP_PORT", "587"))
-    user = os.getenv("SMTP_USER", "")
-    password = os.getenv("SMTP_PASSWORD", "")
-    sender = os.getenv("EMAIL_FROM", "noreply@zerotrust.io")
-    
-    is_sim = not (user and password)
-
     subject = f"CRITICAL SECURITY ALERT: High Risk Detected for {target_user}"
     
     body = f"""
@@ -110,7 +74,7 @@ def send_security_alert(admin_emails: list, target_user: str, risk_score: float,
     AI Security Engine
     """
 
-    if is_sim:
+    if mail_queue.simulated():
         logger.info("═══ SECURITY ALERT SIMULATION ═══")
         for addr in admin_emails:
             logger.info(f"Admin Notified: {addr}")
@@ -119,23 +83,7 @@ def send_security_alert(admin_emails: list, target_user: str, risk_score: float,
         logger.info("════════════════════════════════")
         return True
 
-    try:
-        msg = MIMEMultipart()
-        msg['From'] = sender
-        msg['Subject'] = subject
-        msg.attach(MIMEText(body, 'plain'))
-
-        server = smtplib.SMTP(server_addr, port)
-        server.starttls()
-        server.login(user, password)
-        
-        for admin_email in admin_emails:
-            msg['To'] = admin_email
-            server.send_message(msg)
-            
-        server.quit()
-        logger.info(f"SUCCESS: Security alert sent to {len(admin_emails)} admins")
-        return True
-    except Exception as e:
-        logger.error(f"Failed to send security alert: {str(e)}")
-        return False
+    # One message per admin so each recipient retries / fails independently
+    for admin_email in admin_emails:
+        mail_queue.enqueue([admin_email], subject, body)
+    return True
@@ -0,0 +1,368 @@
+"""
+Offline GeoIP / ASN Lookup & Impossible Travel
+==============================================
+session_behavior.location used to be a constant ("Detected", "App Login"),
+so there was no geographic signal.  This module resolves IPv4 addresses
+against a local range table (no network access) and scores impossible
+travel between a user's consecutive logins.
+
+Range table.  `python geoip.py build ranges.csv ranges.bin` compiles a CSV
+(start_ip, end_ip, country_code, location, latitude, longitude, asn,
+as_org) into a column-oriented binary file:
+
+    header   b"ZTGEO\\x01\\0\\0", n (u32), string bytes (u32)
+    starts   n x u32      sorted, non-overlapping range starts
+    ends     n x u32
+    lat/lon  n x f32 each
+    asn      n x u32
+    loc/cc/org  (n + 1) x u32 offsets each into the UTF-8 string blob
+
+The file is mapped read-only with mmap and each column is a memoryview
+cast over the mapping, so a lookup is one C-level bisect over `starts`
+plus a compare against `ends` — no parsing, no per-lookup objects beyond
+the integers themselves.  GEOIP_DB_PATH points at a .bin (or a .csv,
+compiled once into the temp dir); the default is geoip_sample.csv next to
+this module, which only covers the demo's office and attack ranges.
+
+Impossible travel.  Each user's last GEOIP_LOGIN_HISTORY logins (start
+time, session, IP) are kept from a db.watch hook on `sessions`.  travel()
+finds the login just before a session and returns the great-circle
+distance and the speed needed to cover it; risk() scores speeds from 80%
+of GEOIP_MAX_SPEED_KMH as unlikely and above it as impossible.  Hops shorter than GEOIP_TRAVEL_MIN_KM
+are GeoIP noise and never score.
+"""
+
+import bisect
+import csv
+import hashlib
+import math
+import mmap
+import os
+import socket
+import struct
+import tempfile
+import threading
+from datetime import datetime
+
+import db
+
+GEOIP_DB_PATH = os.getenv("GEOIP_DB_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "geoip_sample.csv")
+GEOIP_MAX_SPEED_KMH = float(os.getenv("GEOIP_MAX_SPEED_KMH", "1000"))
+GEOIP_TRAVEL_MIN_KM = float(os.getenv("GEOIP_TRAVEL_MIN_KM", "300"))
+GEOIP_LOGIN_HISTORY = int(os.getenv("GEOIP_LOGIN_HISTORY", "16"))
+
+MAGIC = b"ZTGEO\x01\x00\x00"
+_HEADER = struct.Struct("<8sII")
+EARTH_RADIUS_KM = 6371.0
+
+
+# ─── Range Table ─────────────────────────────────────────────────────
+
+def ipv4_int(ip):
+    """Integer value of a dotted IPv4 (or IPv4-mapped IPv6) address, else None."""
+    if not isinstance(ip, str):
+        return None
+    if ip.startswith("::ffff:"):
+        ip = ip[7:]
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), "big")
+    except OSError:
+        return None
+
+
+def build(csv_path, out_path):
+    """Compile a range CSV into the binary table; returns the number of ranges."""
+    rows = []
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        for r in csv.DictReader(f):
+            start, end = ipv4_int(r["start_ip"].strip()), ipv4_int(r["end_ip"].strip())
+            if start is None or end is None or end < start:
+                raise ValueError(f"{csv_path}: bad range {r['start_ip']!r} - {r['end_ip']!r}")
+            rows.append((start, end, float(r["latitude"]), float(r["longitude"]), int(r.get("asn") or 0),
+                         r["location"].strip(), r.get("country_code", "").strip(), r.get("as_org", "").strip()))
+    rows.sort()
+    for a, b in zip(rows, rows[1:]):
+        if b[0] <= a[1]:
+            raise ValueError(f"{csv_path}: overlapping ranges at {socket.inet_ntoa(b[0].to_bytes(4, 'big'))}")
+
+    blob = bytearray()
+    offsets = []
+    for col in (5, 6, 7):
+        column = []
+        for r in rows:
+            column.append(len(blob))
+            blob += r[col].encode()
+        column.append(len(blob))
+        offsets.append(column)
+
+    n = len(rows)
+    tmp = out_path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, n, len(blob)))
+        f.write(struct.pack(f"<{n}I", *(r[0] for r in rows)))
+        f.write(struct.pack(f"<{n}I", *(r[1] for r in rows)))
+        f.write(struct.pack(f"<{n}f", *(r[2] for r in rows)))
+        f.write(struct.pack(f"<{n}f", *(r[3] for r in rows)))
+        f.write(struct.pack(f"<{n}I", *(r[4] for r in rows)))
+        for column in offsets:
+            f.write(struct.pack(f"<{n + 1}I", *column))
+        f.write(blob)
+    os.replace(tmp, out_path)
+    return n
+
+
+class RangeTable:
+    """Read-only, mmap-backed view of a compiled range table."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n, nbytes = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path}: not a GeoIP range table")
+        self.n = n
+        view = memoryview(self._map)
+        off = _HEADER.size
+
+        def column(fmt, count):
+            nonlocal off
+            col = view[off:off + 4 * count].cast(fmt)
+            off += 4 * count
+            return col
+
+        self.starts = column("I", n)
+        self.ends = column("I", n)
+        self.lat = column("f", n)
+        self.lon = column("f", n)
+        self.asn = column("I", n)
+        self.loc_off = column("I", n + 1)
+        self.cc_off = column("I", n + 1)
+        self.org_off = column("I", n + 1)
+        self._strings = view[off:off + nbytes]
+
+    def find(self, value):
+        """Row index of the range containing integer address `value`, or -1."""
+        i = bisect.bisect_right(self.starts, value) - 1
+        if i >= 0 and value <= self.ends[i]:
+            return i
+        return -1
+
+    def text(self, offsets, i):
+        return bytes(self._strings[offsets[i]:offsets[i + 1]]).decode()
+
+    def close(self):
+        for col in (self.starts, self.ends, self.lat, self.lon, self.asn,
+                    self.loc_off, self.cc_off, self.org_off, self._strings):
+            col.release()
+        self._map.close()
+        self._file.close()
+
+
+def _compiled(path):
+    if not path.endswith(".csv"):
+        return path
+    digest = hashlib.sha1(f"{MAGIC!r}:{os.path.abspath(path)}:{os.path.getmtime(path)}".encode()).hexdigest()[:12]
+    out = os.path.join(tempfile.gettempdir(), f"zerotrust_geoip_{digest}.bin")
+    if not os.path.exists(out):
+        build(path, out)
+    return out
+
+
+def _open(path):
+    try:
+        table = RangeTable(_compiled(path))
+    except (OSError, ValueError, KeyError) as e:
+        print(f"[WARN] GeoIP disabled: {e}")
+        return None
+    print(f"[OK] GeoIP table: {table.n} ranges from {path}")
+    return table
+
+
+_table = _open(GEOIP_DB_PATH)
+
+
+def lookup(ip):
+    """{location, country_code, latitude, longitude, asn, as_org} for an address, or None."""
+    value = ipv4_int(ip)
+    if _table is None or value is None:
+        return None
+    i = _table.find(value)
+    if i < 0:
+        return None
+    return {
+        "location": _table.text(_table.loc_off, i),
+        "country_code": _table.text(_table.cc_off, i),
+        "latitude": round(_table.lat[i], 4),
+        "longitude": round(_table.lon[i], 4),
+        "asn": _table.asn[i],
+        "as_org": _table.text(_table.org_off, i),
+    }
+
+
+def coords(ip):
+    """(lat, lon) for an address, or None."""
+    value = ipv4_int(ip)
+    if _table is None or value is None:
+        return None
+    i = _table.find(value)
+    return None if i < 0 else (_table.lat[i], _table.lon[i])
+
+
+def status() -> dict:
+    return {"enabled": _table is not None, "path": GEOIP_DB_PATH,
+            "ranges": _table.n if _table is not None else 0,
+            "users_tracked": len(_logins), "max_speed_kmh": GEOIP_MAX_SPEED_KMH,
+            "min_distance_km": GEOIP_TRAVEL_MIN_KM}
+
+
+# ─── Impossible Travel ───────────────────────────────────────────────
+
+_lock = threading.Lock()
+_logins = {}      # user_id -> [(start ts, session_id, ip)] sorted, last GEOIP_LOGIN_HISTORY
+
+
+def _start_ts(start):
+    return start.timestamp() if isinstance(start, datetime) else None
+
+
+def _record(uid, sid, ip, start):
+    ts = _start_ts(start)
+    if uid is None or ts is None:
+        return
+    history = _logins.setdefault(uid, [])
+    bisect.insort(history, (ts, sid or "", ip))
+    if len(history) > GEOIP_LOGIN_HISTORY:
+        del history[0]
+
+
+def haversine_km(a, b):
+    lat1, lon1, lat2, lon2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(h)))
+
+
+def travel(user_id, session_id, ip, start):
+    """(km, km/h) from the user's previous login to this one; (0, 0) when unknown."""
+    ts = _start_ts(start)
+    here = coords(ip)
+    if ts is None or here is None:
+        return 0.0, 0.0
+    with _lock:
+        history = _logins.get(user_id, ())
+        i = bisect.bisect_left(history, (ts, ""))
+        prev = next((h for h in reversed(history[:i]) if h[1] != session_id), None)
+    if prev is None:
+        return 0.0, 0.0
+    there = coords(prev[2])
+    if there is None:
+        return 0.0, 0.0
+    km = haversine_km(there, here)
+    hours = max(ts - prev[0], 60.0) / 3600
+    return km, km / hours
+
+
+def risk(km, kmh):
+    """(raw 0-100 risk, explanation) for the impossible_travel component."""
+    if km < GEOIP_TRAVEL_MIN_KM:
+        return 0.0, "No significant location change since the previous login"
+    fast = 0.8 * GEOIP_MAX_SPEED_KMH     # airliner door-to-door speeds stay below this
+    if kmh <= fast:
+        return 0.0, f"{km:.0f} km from the previous login at a plausible {kmh:.0f} km/h"
+    if kmh <= GEOIP_MAX_SPEED_KMH:
+        return (30 + 30 * (kmh - fast) / (GEOIP_MAX_SPEED_KMH - fast),
+                f"{km:.0f} km from the previous login at {kmh:.0f} km/h — unlikely travel")
+    return (min(100.0, 60 + 40 * (kmh - GEOIP_MAX_SPEED_KMH) / (4 * GEOIP_MAX_SPEED_KMH)),
+            f"{km:.0f} km from the previous login at {kmh:.0f} km/h — impossible travel")
+
+
+def _on_session_write(before, after):
+    if before is None and after is not None:
+        with _lock:
+            _record(after.get("user_id"), after.get("session_id"), after.get("ip_address"), after.get("start_time"))
+
+
+def rebuild():
+    rows = db.get_db_connection()["sessions"].find_fields({}, ("user_id", "session_id", "ip_address", "start_time"))
+    with _lock:
+        _logins.clear()
+        for uid, sid, ip, start in rows:
+            _record(uid, sid, ip, start)
+
+
+def _memory_report():
+    with _lock:
+        n = sum(len(h) for h in _logins.values())
+    return {"entries": n, "approx_bytes": n * 150}
+
+
+db.watch("sessions", _on_session_write)
+db.on_reset(rebuild)
+db.register_index("geoip_logins", _memory_report)
+rebuild()
+
+
+# ─── CLI ─────────────────────────────────────────────────────────────
+
+def _bench(n, ranges):
+    import random
+    import time
+    rng = random.Random(7)
+    table = _table
+    if ranges:
+        # Synthetic table of `ranges` contiguous blocks (real GeoIP city tables have ~3-4M)
+        path = os.path.join(tempfile.gettempdir(), f"zerotrust_geoip_bench_{ranges}.bin")
+        if not os.path.exists(path):
+            csv_path = path + ".csv"
+            bounds = sorted(rng.sample(range(1, 2 ** 32 - 1), ranges - 1))
+            with open(csv_path, "w", newline="") as f:
+                w = csv.writer(f)
+                w.writerow(["start_ip", "end_ip", "country_code", "location", "latitude", "longitude", "asn", "as_org"])
+                lo = 0
+                for hi in bounds + [2 ** 32]:
+                    w.writerow([socket.inet_ntoa(lo.to_bytes(4, "big")), socket.inet_ntoa((hi - 1).to_bytes(4, "big")),
+                                "ZZ", "Somewhere", rng.uniform(-60, 70), rng.uniform(-180, 180), lo % 65536, ""])
+                    lo = hi
+            build(csv_path, path)
+            os.remove(csv_path)
+        table = RangeTable(path)
+    if table is None:
+        print("[WARN] No GeoIP table loaded")
+        return
+    ips = [socket.inet_ntoa(rng.getrandbits(32).to_bytes(4, "big")) for _ in range(n)]
+    values = [ipv4_int(ip) for ip in ips]
+    t = time.perf_counter()
+    for v in values:
+        table.find(v)
+    raw = time.perf_counter() - t
+    t = time.perf_counter()
+    for ip in ips:
+        v = ipv4_int(ip)
+        i = table.find(v)
+        if i >= 0:
+            table.lat[i], table.lon[i]
+    full = time.perf_counter() - t
+    print(f"[OK] {table.n:,} ranges: find(int) {n / raw:,.0f} lookups/s, "
+          f"parse + find + coords {n / full:,.0f} lookups/s")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Offline GeoIP range table tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    b = sub.add_parser("build", help="compile a range CSV into a binary table")
+    b.add_argument("csv")
+    b.add_argument("out")
+    lk = sub.add_parser("lookup", help="resolve addresses against GEOIP_DB_PATH")
+    lk.add_argument("ips", nargs="+")
+    bench = sub.add_parser("bench", help="measure lookups per second against GEOIP_DB_PATH")
+    bench.add_argument("--n", type=int, default=1_000_000, help="lookups to time")
+    bench.add_argument("--ranges", type=int, default=0, help="benchmark a synthetic table of this many ranges instead")
+    args = parser.parse_args()
+    if args.command == "build":
+        print(f"[OK] Wrote {build(args.csv, args.out)} ranges to {args.out}")
+    elif args.command == "lookup":
+        for ip in args.ips:
+            print(ip, lookup(ip))
+    else:
+        _bench(args.n, args.ranges)
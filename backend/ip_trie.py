@@ -0,0 +1,329 @@
+"""
+IP Network Index
+================
+Binary radix (path-compressed) tries over integer-encoded addresses, used
+for the ip_location risk component instead of splitting strings on ".":
+
+  - IPIndex     per-user history of seen addresses (IPv4 and IPv6, one trie
+                per family, with counts so sessions can come and go).
+                match_len() is the longest prefix the address shares with
+                any known address — O(address bits), independent of how
+                many addresses the user has.
+  - trusted     admin-defined CIDR ranges (TRUSTED_CIDRS plus the
+                `trusted_networks` collection), longest-prefix matched.
+
+classify() turns an address and a user's history into one of the IP_*
+codes; risk_engine.calc_ip_risk and batch_risk both use it, so the scalar
+and vectorized paths agree.  "Same network" means sharing at least
+IP_SAME_NETWORK_PREFIX_V4 / _V6 leading bits with a known address.
+IPv4-mapped IPv6 addresses are treated as IPv4.  Strings that do not parse
+as addresses (proxies, test clients) still match exactly.
+"""
+
+import ipaddress
+import os
+import threading
+from collections import Counter
+from functools import lru_cache
+
+import db
+
+IP_SAME_NETWORK_PREFIX_V4 = int(os.getenv("IP_SAME_NETWORK_PREFIX_V4", "16"))
+IP_SAME_NETWORK_PREFIX_V6 = int(os.getenv("IP_SAME_NETWORK_PREFIX_V6", "48"))
+TRUSTED_CIDRS = [c.strip() for c in os.getenv("TRUSTED_CIDRS", "").split(",") if c.strip()]
+
+SAME_NETWORK_PREFIX = {32: IP_SAME_NETWORK_PREFIX_V4, 128: IP_SAME_NETWORK_PREFIX_V6}
+
+# Classification codes (also the batch feature values)
+IP_NO_HISTORY, IP_KNOWN, IP_SAME_SUBNET, IP_UNKNOWN, IP_TRUSTED = range(5)
+
+
+@lru_cache(maxsize=65536)
+def parse(ip):
+    """(width, integer) for a valid address, else None."""
+    try:
+        addr = ipaddress.ip_address(ip.strip() if isinstance(ip, str) else ip)
+    except (ValueError, TypeError, AttributeError):
+        return None
+    if addr.version == 6 and addr.ipv4_mapped is not None:
+        addr = addr.ipv4_mapped
+    return (32 if addr.version == 4 else 128), int(addr)
+
+
+# ─── Radix Trie ──────────────────────────────────────────────────────
+
+class _Node:
+    __slots__ = ("key", "depth", "count", "here", "children")
+
+    def __init__(self, key, depth, count=0, here=0):
+        self.key = key            # address bits, masked to `depth`
+        self.depth = depth
+        self.count = count        # prefixes stored in this subtree
+        self.here = here          # prefixes stored exactly at this node
+        self.children = [None, None]
+
+
+class RadixTrie:
+    """Path-compressed binary trie of (address, prefix length) entries with counts."""
+
+    __slots__ = ("width", "root")
+
+    def __init__(self, width):
+        self.width = width
+        self.root = _Node(0, 0)
+
+    def _bit(self, addr, depth):
+        return (addr >> (self.width - 1 - depth)) & 1
+
+    def _mask(self, addr, depth):
+        shift = self.width - depth
+        return (addr >> shift) << shift
+
+    def _common(self, addr, node, limit):
+        """Leading bits addr shares with node's prefix, capped at limit <= node.depth."""
+        x = (addr ^ node.key) >> (self.width - limit)
+        return limit - x.bit_length()
+
+    def __len__(self):
+        return self.root.count
+
+    def insert(self, addr, plen=None):
+        plen = self.width if plen is None else plen
+        addr = self._mask(addr, plen)
+        node = self.root
+        node.count += 1
+        while node.depth < plen:
+            b = self._bit(addr, node.depth)
+            child = node.children[b]
+            if child is None:
+                node.children[b] = _Node(addr, plen, 1, 1)
+                return
+            cl = self._common(addr, child, min(child.depth, plen))
+            if cl == child.depth:
+                child.count += 1
+                node = child
+                continue
+            mid = _Node(self._mask(addr, cl), cl, child.count + 1)
+            mid.children[self._bit(child.key, cl)] = child
+            if cl == plen:
+                mid.here = 1
+            else:
+                mid.children[self._bit(addr, cl)] = _Node(addr, plen, 1, 1)
+            node.children[b] = mid
+            return
+        node.here += 1
+
+    def remove(self, addr, plen=None):
+        plen = self.width if plen is None else plen
+        addr = self._mask(addr, plen)
+        path = [self.root]
+        node = self.root
+        while node.depth < plen:
+            child = node.children[self._bit(addr, node.depth)]
+            if child is None or child.depth > plen or self._common(addr, child, child.depth) != child.depth:
+                return False
+            path.append(child)
+            node = child
+        if node.here <= 0:
+            return False
+        node.here -= 1
+        for n in path:
+            n.count -= 1
+        for parent, child in zip(path, path[1:]):
+            if child.count == 0:
+                parent.children[parent.children.index(child)] = None
+                break
+        return True
+
+    def exact(self, addr):
+        node = self.root
+        while node.depth < self.width:
+            node = node.children[self._bit(addr, node.depth)]
+            if node is None or self._common(addr, node, node.depth) != node.depth:
+                return 0
+        return node.here
+
+    def match_len(self, addr, exclude=None):
+        """Longest prefix addr shares with a stored address (one `exclude` entry ignored); -1 if none."""
+        width = self.width
+
+        def live(n):
+            c = n.count
+            if exclude is not None and (n.depth == 0 or (exclude ^ n.key) >> (width - n.depth) == 0):
+                c -= 1
+            return c > 0
+
+        node = self.root
+        if not live(node):
+            return -1
+        while node.depth < width:
+            child = node.children[self._bit(addr, node.depth)]
+            if child is None or not live(child):
+                return node.depth
+            cl = self._common(addr, child, child.depth)
+            if cl < child.depth:
+                return cl
+            node = child
+        return width
+
+    def longest_prefix(self, addr):
+        """Depth of the most specific stored prefix containing addr, or None."""
+        best = None
+        node = self.root
+        while True:
+            if node.here > 0:
+                best = node.depth
+            if node.depth >= self.width:
+                return best
+            node = node.children[self._bit(addr, node.depth)]
+            if node is None or self._common(addr, node, node.depth) != node.depth:
+                return best
+
+
+# ─── Per-User Address History ────────────────────────────────────────
+
+class IPIndex:
+    """Counts of addresses seen for one user, indexed by network prefix."""
+
+    __slots__ = ("tries", "other", "total")
+
+    def __init__(self, ips=()):
+        self.tries = {32: RadixTrie(32), 128: RadixTrie(128)}
+        self.other = Counter()    # unparseable strings, exact match only
+        self.total = 0
+        for ip in ips:
+            self.add(ip)
+
+    def add(self, ip):
+        p = parse(ip)
+        if p is None:
+            self.other[ip] += 1
+        else:
+            self.tries[p[0]].insert(p[1])
+        self.total += 1
+
+    def remove(self, ip):
+        p = parse(ip)
+        if p is None:
+            if self.other.get(ip, 0) <= 0:
+                return
+            self.other[ip] -= 1
+            if self.other[ip] == 0:
+                del self.other[ip]
+        elif not self.tries[p[0]].remove(p[1]):
+            return
+        self.total -= 1
+
+    def exact_count(self, ip):
+        p = parse(ip)
+        return self.other.get(ip, 0) if p is None else self.tries[p[0]].exact(p[1])
+
+    def match_len(self, ip, exclude=None):
+        p = parse(ip)
+        if p is None:
+            return -1
+        ex = parse(exclude) if exclude else None
+        return self.tries[p[0]].match_len(p[1], ex[1] if ex and ex[0] == p[0] else None)
+
+    def view(self, exclude=None):
+        return KnownIPs(self, exclude)
+
+
+class KnownIPs:
+    """Read-only view of an IPIndex minus one session's address."""
+
+    __slots__ = ("_index", "_own")
+
+    def __init__(self, index, own):
+        self._index = index
+        self._own = own or None
+
+    def __len__(self):
+        n = self._index.total
+        if self._own is not None and self._index.exact_count(self._own) > 0:
+            n -= 1
+        return n
+
+    def __contains__(self, ip):
+        return self._index.exact_count(ip) - (1 if ip == self._own else 0) > 0
+
+    def match_len(self, ip):
+        return self._index.match_len(ip, self._own)
+
+
+# ─── Trusted Networks ────────────────────────────────────────────────
+
+_lock = threading.Lock()
+_trusted = {32: RadixTrie(32), 128: RadixTrie(128)}
+
+
+def parse_cidr(cidr):
+    """(width, network integer, prefix length); raises ValueError on bad input."""
+    net = ipaddress.ip_network(cidr.strip(), strict=False)
+    return (32 if net.version == 4 else 128), int(net.network_address), net.prefixlen
+
+
+def _set_trusted(cidr, add):
+    try:
+        width, addr, plen = parse_cidr(cidr)
+    except (ValueError, AttributeError):
+        print(f"[WARN] Ignoring invalid trusted CIDR: {cidr!r}")
+        return
+    with _lock:
+        if add:
+            _trusted[width].insert(addr, plen)
+        else:
+            _trusted[width].remove(addr, plen)
+
+
+def trusted_network(ip):
+    """The most specific trusted CIDR containing ip, as a string, or None."""
+    p = parse(ip)
+    if p is None:
+        return None
+    with _lock:
+        plen = _trusted[p[0]].longest_prefix(p[1])
+    if plen is None:
+        return None
+    return str(ipaddress.ip_network((p[1], plen), strict=False))
+
+
+def reload_trusted():
+    with _lock:
+        _trusted[32] = RadixTrie(32)
+        _trusted[128] = RadixTrie(128)
+    for cidr in TRUSTED_CIDRS:
+        _set_trusted(cidr, True)
+    for (cidr,) in db.get_db_connection()["trusted_networks"].find_fields({}, ("cidr",)):
+        _set_trusted(cidr, True)
+
+
+def _on_trusted_write(before, after):
+    if before is not None:
+        _set_trusted(before.get("cidr", ""), False)
+    if after is not None:
+        _set_trusted(after.get("cidr", ""), True)
+
+
+# ─── Classification ──────────────────────────────────────────────────
+
+def classify(ip, known):
+    """IP_* code for ip given a user's known addresses (KnownIPs or any iterable)."""
+    if trusted_network(ip) is not None:
+        return IP_TRUSTED
+    if not isinstance(known, KnownIPs):
+        known = IPIndex(known).view()
+    if not known:
+        return IP_NO_HISTORY
+    if ip in known:
+        return IP_KNOWN
+    p = parse(ip)
+    if p is not None and known.match_len(ip) >= SAME_NETWORK_PREFIX[p[0]]:
+        return IP_SAME_SUBNET
+    return IP_UNKNOWN
+
+
+for _cidr in TRUSTED_CIDRS:
+    _set_trusted(_cidr, True)
+db.watch("trusted_networks", _on_trusted_write)
+db.on_reset(reload_trusted)
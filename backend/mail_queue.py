@@ -0,0 +1,472 @@
+"""
+Outbound Mail Queue
+===================
+Request handlers used to open an SMTP connection, STARTTLS and log in on
+every e-mail, blocking the event loop for seconds.  Now they only
+enqueue():
+
+  - the queue is a SQLite file (MAIL_QUEUE_PATH, WAL mode), so queued mail
+    survives restarts; messages left mid-send by a crash are re-queued on
+    start()
+  - a background sender thread claims due messages in batches
+    (MAIL_BATCH_SIZE) and sends them over a pool of up to MAIL_POOL_SIZE
+    persistent SMTP connections (NOOP-checked before reuse, closed after
+    MAIL_IDLE_SECONDS idle)
+  - failures retry with exponential backoff and jitter, up to
+    MAIL_MAX_ATTEMPTS; permanent (5xx) rejections go straight to `dead`
+  - a circuit breaker opens after MAIL_BREAKER_THRESHOLD consecutive
+    connection-level failures and lets a single probe through after
+    MAIL_BREAKER_COOLDOWN_SECONDS
+
+Without SMTP_USER / SMTP_PASSWORD (and MAIL_TRANSPORT unset) messages are
+logged instead of sent, as before, and never written to the queue: a row
+in the outbox always means real delivery, so nothing queued while
+simulating goes out once credentials appear.  While simulating, the
+sender also leaves any already-queued rows alone.
+
+The queue lives in backend/data/ by default rather than the temp dir,
+which is often tmpfs and would lose queued mail on reboot.  For tests and local development,
+`python mail_queue.py sink --port 1025` runs LocalSMTPSink, a minimal
+in-process SMTP server; point the app at it with MAIL_TRANSPORT=smtp,
+SMTP_SERVER=127.0.0.1, SMTP_PORT=1025, SMTP_STARTTLS=0.
+"""
+
+import json
+import logging
+import os
+import random
+import smtplib
+import socketserver
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+logger = logging.getLogger(__name__)
+
+MAIL_QUEUE_PATH = os.getenv("MAIL_QUEUE_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                "data", "mail_queue.sqlite3")
+MAIL_TRANSPORT = os.getenv("MAIL_TRANSPORT", "")          # "smtp", "simulate", or "" = smtp when credentials are set
+MAIL_POOL_SIZE = int(os.getenv("MAIL_POOL_SIZE", "2"))
+MAIL_BATCH_SIZE = int(os.getenv("MAIL_BATCH_SIZE", "50"))
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", "8"))
+MAIL_BACKOFF_BASE_SECONDS = float(os.getenv("MAIL_BACKOFF_BASE_SECONDS", "5"))
+MAIL_BACKOFF_MAX_SECONDS = float(os.getenv("MAIL_BACKOFF_MAX_SECONDS", "900"))
+MAIL_BREAKER_THRESHOLD = int(os.getenv("MAIL_BREAKER_THRESHOLD", "5"))
+MAIL_BREAKER_COOLDOWN_SECONDS = float(os.getenv("MAIL_BREAKER_COOLDOWN_SECONDS", "60"))
+MAIL_IDLE_SECONDS = float(os.getenv("MAIL_IDLE_SECONDS", "60"))
+MAIL_POLL_SECONDS = float(os.getenv("MAIL_POLL_SECONDS", "2"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created REAL NOT NULL,
+    next_attempt REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'queued',
+    sender TEXT NOT NULL,
+    recipients TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt);
+"""
+
+_db_lock = threading.Lock()
+_conn = None
+_wake = threading.Event()
+_stop = threading.Event()
+_thread = None
+_stats = {"enqueued": 0, "sent": 0, "retried": 0, "dead": 0, "simulated": 0, "connections_opened": 0}
+
+
+def _db():
+    global _conn
+    if _conn is None:
+        os.makedirs(os.path.dirname(os.path.abspath(MAIL_QUEUE_PATH)), exist_ok=True)
+        _conn = sqlite3.connect(MAIL_QUEUE_PATH, check_same_thread=False, isolation_level=None)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+        _conn.executescript(_SCHEMA)
+    return _conn
+
+
+def _smtp_config():
+    # Read at send time so .env / runtime changes apply without a restart
+    return {
+        "server": os.getenv("SMTP_SERVER", "smtp.gmail.com"),
+        "port": int(os.getenv("SMTP_PORT", "587")),
+        "user": os.getenv("SMTP_USER", ""),
+        "password": os.getenv("SMTP_PASSWORD", ""),
+        "starttls": os.getenv("SMTP_STARTTLS", "1").lower() not in ("0", "false", "no"),
+        "timeout": float(os.getenv("SMTP_TIMEOUT_SECONDS", "15")),
+    }
+
+
+def simulated() -> bool:
+    transport = os.getenv("MAIL_TRANSPORT", MAIL_TRANSPORT)
+    if transport:
+        return transport == "simulate"
+    cfg = _smtp_config()
+    return not (cfg["user"] and cfg["password"])
+
+
+# ─── Enqueue ─────────────────────────────────────────────────────────
+
+def enqueue(recipients, subject: str, body: str, sender: str = None) -> int:
+    """Persist one message for the background sender; returns its queue id (0 if not queued)."""
+    recipients = [r for r in ([recipients] if isinstance(recipients, str) else recipients) if r]
+    if not recipients:
+        return 0
+    if simulated():
+        logger.info(f"Simulated delivery to {', '.join(recipients)} | {subject}")
+        _stats["simulated"] += 1
+        return 0
+    sender = sender or os.getenv("EMAIL_FROM", "noreply@zerotrust.io")
+    now = time.time()
+    with _db_lock:
+        cur = _db().execute(
+            "INSERT INTO outbox (created, next_attempt, sender, recipients, subject, body) VALUES (?, ?, ?, ?, ?, ?)",
+            (now, now, sender, json.dumps(recipients), subject, body))
+        _stats["enqueued"] += 1
+    _wake.set()
+    return cur.lastrowid
+
+
+# ─── Circuit Breaker ─────────────────────────────────────────────────
+
+class CircuitBreaker:
+    """closed -> open after `threshold` consecutive failures -> half-open probe after `cooldown`."""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self):
+        return self.state != "open"
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+
+_breaker = CircuitBreaker(MAIL_BREAKER_THRESHOLD, MAIL_BREAKER_COOLDOWN_SECONDS)
+
+
+# ─── Connection Pool ─────────────────────────────────────────────────
+
+class SMTPPool:
+    """Up to `size` logged-in SMTP connections, reused across messages and batches."""
+
+    def __init__(self, size):
+        self.size = max(1, size)
+        self._idle = []        # [(smtp, last_used)]
+        self._lock = threading.Lock()
+
+    def _open(self):
+        cfg = _smtp_config()
+        smtp = smtplib.SMTP(cfg["server"], cfg["port"], timeout=cfg["timeout"])
+        if cfg["starttls"]:
+            smtp.starttls()
+        if cfg["user"] and cfg["password"]:
+            smtp.login(cfg["user"], cfg["password"])
+        _stats["connections_opened"] += 1
+        return smtp
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                smtp, _ = self._idle.pop()
+            try:
+                if smtp.noop()[0] == 250:
+                    return smtp
+            except smtplib.SMTPException:
+                pass
+            except OSError:
+                pass
+            _close(smtp)
+        return self._open()
+
+    def release(self, smtp, healthy=True):
+        if not healthy:
+            _close(smtp)
+            return
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((smtp, time.monotonic()))
+                return
+        _close(smtp)
+
+    def prune(self, max_idle):
+        now = time.monotonic()
+        with self._lock:
+            stale = [s for s, t in self._idle if now - t >= max_idle]
+            self._idle = [(s, t) for s, t in self._idle if now - t < max_idle]
+        for smtp in stale:
+            _close(smtp)
+
+    def close(self):
+        self.prune(0)
+
+
+def _close(smtp):
+    try:
+        smtp.quit()
+    except (smtplib.SMTPException, OSError):
+        pass
+
+
+_pool = SMTPPool(MAIL_POOL_SIZE)
+
+
+# ─── Sender ──────────────────────────────────────────────────────────
+
+def _claim(limit):
+    now = time.time()
+    with _db_lock:
+        db = _db()
+        rows = db.execute(
+            "SELECT id, attempts, sender, recipients, subject, body FROM outbox "
+            "WHERE status = 'queued' AND next_attempt <= ? ORDER BY next_attempt LIMIT ?", (now, limit)).fetchall()
+        if rows:
+            db.executemany("UPDATE outbox SET status = 'sending' WHERE id = ?", [(r[0],) for r in rows])
+    return rows
+
+
+def _finish(msg_id, attempts, error=None, permanent=False):
+    with _db_lock:
+        db = _db()
+        if error is None:
+            db.execute("DELETE FROM outbox WHERE id = ?", (msg_id,))
+            _stats["sent"] += 1
+        elif permanent or attempts + 1 >= MAIL_MAX_ATTEMPTS:
+            db.execute("UPDATE outbox SET status = 'dead', attempts = ?, last_error = ? WHERE id = ?",
+                       (attempts + 1, error, msg_id))
+            _stats["dead"] += 1
+            logger.error(f"Giving up on mail {msg_id} after {attempts + 1} attempt(s): {error}")
+        else:
+            delay = min(MAIL_BACKOFF_MAX_SECONDS, MAIL_BACKOFF_BASE_SECONDS * 2 ** attempts)
+            delay *= random.uniform(0.8, 1.2)
+            db.execute("UPDATE outbox SET status = 'queued', attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?",
+                       (attempts + 1, time.time() + delay, error, msg_id))
+            _stats["retried"] += 1
+
+
+def _build(sender, recipients, subject, body):
+    msg = MIMEMultipart()
+    msg["From"] = sender
+    msg["To"] = ", ".join(recipients)
+    msg["Subject"] = subject
+    msg.attach(MIMEText(body, "plain"))
+    return msg.as_string()
+
+
+def _send_one(row):
+    msg_id, attempts, sender, recipients, subject, body = row
+    recipients = json.loads(recipients)
+    if not _breaker.allow():
+        with _db_lock:
+            _db().execute("UPDATE outbox SET status = 'queued' WHERE id = ?", (msg_id,))
+        return
+    try:
+        smtp = _pool.acquire()
+    except (smtplib.SMTPException, OSError) as e:
+        _breaker.failure()
+        _finish(msg_id, attempts, f"connect: {e}")
+        return
+    try:
+        smtp.sendmail(sender, recipients, _build(sender, recipients, subject, body))
+    except smtplib.SMTPRecipientsRefused as e:
+        _pool.release(smtp)
+        _breaker.success()
+        _finish(msg_id, attempts, f"recipients refused: {e.recipients}", permanent=True)
+    except smtplib.SMTPResponseException as e:
+        _pool.release(smtp, healthy=e.smtp_code < 500 or e.smtp_code in (552,))
+        _breaker.success()
+        _finish(msg_id, attempts, f"{e.smtp_code} {e.smtp_error!r}", permanent=e.smtp_code >= 500)
+    except (smtplib.SMTPException, OSError) as e:
+        _pool.release(smtp, healthy=False)
+        _breaker.failure()
+        _finish(msg_id, attempts, str(e))
+    else:
+        _pool.release(smtp)
+        _breaker.success()
+        _finish(msg_id, attempts)
+
+
+def drain(limit=None) -> int:
+    """Send every due message now (blocking); returns how many were attempted."""
+    done = 0
+    if simulated():
+        # Queued rows were meant for real delivery; keep them until SMTP is configured
+        return done
+    with ThreadPoolExecutor(max_workers=_pool.size) as workers:
+        while limit is None or done < limit:
+            if not _breaker.allow():
+                break
+            # Half-open: a single probe message decides whether the breaker closes
+            batch = _claim(1 if _breaker.state == "half_open" else MAIL_BATCH_SIZE)
+            if not batch:
+                break
+            list(workers.map(_send_one, batch))
+            done += len(batch)
+    return done
+
+
+def _run():
+    while not _stop.is_set():
+        try:
+            drain()
+            _pool.prune(MAIL_IDLE_SECONDS)
+        except Exception as e:
+            logger.error(f"Mail sender error: {e}")
+        _wake.wait(MAIL_POLL_SECONDS)
+        _wake.clear()
+    _pool.close()
+
+
+def start():
+    """Start the background sender (re-queues messages a crash left mid-send)."""
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    with _db_lock:
+        _db().execute("UPDATE outbox SET status = 'queued' WHERE status = 'sending'")
+    _stop.clear()
+    _thread = threading.Thread(target=_run, name="mail-sender", daemon=True)
+    _thread.start()
+
+
+def stop(timeout=5.0):
+    global _thread
+    _stop.set()
+    _wake.set()
+    if _thread is not None:
+        _thread.join(timeout)
+        _thread = None
+
+
+def status() -> dict:
+    with _db_lock:
+        counts = dict(_db().execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+    return dict(_stats, queued=counts.get("queued", 0), sending=counts.get("sending", 0),
+                dead=counts.get("dead", 0), breaker=_breaker.state,
+                transport="simulate" if simulated() else "smtp", path=MAIL_QUEUE_PATH)
+
+
+# ─── Local SMTP Sink ─────────────────────────────────────────────────
+
+class LocalSMTPSink:
+    """Minimal SMTP server on 127.0.0.1 that keeps received messages in memory (tests / dev)."""
+
+    def __init__(self, port=0, reject=None):
+        sink = self
+        self.messages = []      # [(mail_from, [rcpt], data)]
+        self.reject = reject    # optional callable(rcpt) -> SMTP reply string to refuse a recipient
+        self.connections = 0
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write((line + "\r\n").encode())
+
+            def handle(self):
+                sink.connections += 1
+                self.reply("220 localhost sink ready")
+                mail_from, rcpts = None, []
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    cmd = line.decode(errors="replace").strip()
+                    verb = cmd[:4].upper()
+                    if verb in ("EHLO", "HELO"):
+                        self.reply("250 localhost")
+                    elif verb == "MAIL":
+                        mail_from, rcpts = cmd.split(":", 1)[1].strip(" <>"), []
+                        self.reply("250 OK")
+                    elif verb == "RCPT":
+                        rcpt = cmd.split(":", 1)[1].strip(" <>")
+                        refused = sink.reject(rcpt) if sink.reject else None
+                        if refused:
+                            self.reply(refused)
+                        else:
+                            rcpts.append(rcpt)
+                            self.reply("250 OK")
+                    elif verb == "DATA":
+                        self.reply("354 End data with <CR><LF>.<CR><LF>")
+                        data = []
+                        while True:
+                            chunk = self.rfile.readline()
+                            if not chunk or chunk in (b".\r\n", b".\n"):
+                                break
+                            data.append(chunk)
+                        sink.messages.append((mail_from, rcpts, b"".join(data).decode(errors="replace")))
+                        self.reply("250 OK queued")
+                    elif verb in ("NOOP", "RSET"):
+                        self.reply("250 OK")
+                    elif verb == "QUIT":
+                        self.reply("221 Bye")
+                        return
+                    else:
+                        self.reply("502 Command not implemented")
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server(("127.0.0.1", port), Handler)
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Outbound mail queue tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    s = sub.add_parser("sink", help="run a local SMTP sink that prints received mail")
+    s.add_argument("--port", type=int, default=1025)
+    sub.add_parser("status", help="show queue counts")
+    args = parser.parse_args()
+    if args.command == "status":
+        print(json.dumps(status(), indent=2))
+    else:
+        sink = LocalSMTPSink(args.port).start()
+        print(f"[OK] SMTP sink listening on 127.0.0.1:{sink.port} (Ctrl+C to stop)")
+        try:
+            seen = 0
+            while True:
+                time.sleep(0.5)
+                for mail_from, rcpts, data in sink.messages[seen:]:
+                    print(f"--- from {mail_from} to {', '.join(rcpts)} ---\n{data}")
+                seen = len(sink.messages)
+        except KeyboardInterrupt:
+            sink.stop()
@@ -10,6 +10,7 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, EmailStr
 from datetime import datetime, timedelta
 from typing import Optional, List
+import asyncio
 import jwt
 import os
 from dotenv import load_dotenv
@@ -20,7 +21,10 @@ load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
 from db import get_db_connection, init_db
 from utils import hash_password, verify_password, generate_session_id, generate_otp
 from email_utils import send_access_notification
-from risk_engine import evaluate_session_risk
+from risk_engine import evaluate_session_risk, get_session_risk
+import geoip
+import reeval
+import throttle
 
 app = FastAPI(title="Zero Trust Security API", version="2.0.0")
 
@@ -97,6 +101,10 @@ class EmergencyDecision(BaseModel):
     approve: bool
     reason: Optional[str] = None
 
+class TrustedNetworkCreate(BaseModel):
+    cidr: str
+    label: Optional[str] = None
+
 class AppLoginRequest(BaseModel):
     app_id: str
     username: str
@@ -191,22 +199,41 @@ async def register(data: UserRegister):
     )
 
 
+def _client_ip(request: Request, default="127.0.0.1"):
+    """Source address for throttling, sessions and audit (X-Forwarded-For only via TRUSTED_PROXIES)."""
+    peer = request.client.host if request.client else None
+    return throttle.client_ip(peer, request.headers.get("x-forwarded-for")) or default
+
+
+def _check_throttle(ip, account):
+    """429 before any password hashing when the source IP or (IP, account) pair is over its failure limit."""
+    wait = throttle.check(ip, account)
+    if wait:
+        raise HTTPException(429, "Too many failed login attempts, try again later",
+                            headers={"Retry-After": str(wait)})
+
+
 @app.post("/api/auth/login", response_model=TokenResponse)
 async def login(creds: UserLogin, request: Request):
     db = get_db_connection()
+    ip = _client_ip(request)
+    _check_throttle(ip, creds.email)
     user = db["users"].find_one({"email": creds.email})
     if not user or not verify_password(creds.password, user["password"]):
+        throttle.record_failure(ip, creds.email)
         if user:
             db["users"].update_one({"_id": user["_id"]}, {"$inc": {"failed_login_count": 1}})
         raise HTTPException(401, "Invalid credentials")
 
     uid = str(user["_id"])
-    attempts = user.get("failed_login_count", 0) + 1
+    recent = throttle.counts(ip, creds.email)
+    throttle.record_success(ip, creds.email)
+    attempts = max(user.get("failed_login_count", 0), recent["account"]) + 1
     db["users"].update_one({"_id": user["_id"]}, {"$set": {"failed_login_count": 0}})
     
     sid = generate_session_id()
-    ip = request.client.host if request.client else "127.0.0.1"
     ua = request.headers.get("user-agent", "unknown")
+    geo = geoip.lookup(ip)
 
     db["sessions"].insert_one({
         "session_id": sid, "user_id": uid,
@@ -217,13 +244,15 @@ async def login(creds: UserLogin, request: Request):
         "mfa_verified": True, "risk_at_login": user.get("risk_score", 0),
         "revoked": False,
         "login_attempt_count": attempts,
+        "source_failed_logins": recent["other_accounts"],
+        "geo": geo,
     })
 
     # Create session behavior record
     db["session_behavior"].insert_one({
         "session_id": sid, "user_id": uid,
         "login_timestamp": datetime.utcnow(), "ip_address": ip,
-        "device_info": ua[:60], "location": "Detected",
+        "device_info": ua[:60], "location": geo["location"] if geo else "Detected",
         "accessed_services": [], "action_count": 0,
         "download_count": 0, "duration_minutes": 0,
         "service_switches": 0, "failed_access_attempts": 0,
@@ -231,6 +260,7 @@ async def login(creds: UserLogin, request: Request):
 
     # Evaluate risk at login
     risk = await evaluate_session_risk(uid, sid)
+    reeval.record(uid, sid, risk)
     risk_score = risk.get("score", 0) / 100.0
     db["sessions"].update_one({"session_id": sid}, {"$set": {"risk_at_login": risk_score}})
 
@@ -244,18 +274,24 @@ async def login(creds: UserLogin, request: Request):
 @app.post("/api/app-login")
 async def app_login(data: AppLoginRequest, request: Request):
     db = get_db_connection()
+    ip = _client_ip(request)
+    account = f"{data.app_id}:{data.username}"
+    _check_throttle(ip, account)
     cred = db["user_credentials"].find_one({"app_id": data.app_id, "username": data.username})
     if not cred or not verify_password(data.password, cred["password_hash"]):
+        throttle.record_failure(ip, account)
         raise HTTPException(401, "Invalid app credentials")
     
     uid = cred["user_id"]
     user = db["users"].find_one({"_id": uid})
     if not user or not user.get("is_active"):
         raise HTTPException(403, "User account disabled")
+    recent = throttle.counts(ip, account)
+    throttle.record_success(ip, account)
         
     sid = generate_session_id()
-    ip = request.client.host if request.client else "127.0.0.1"
     ua = request.headers.get("user-agent", "unknown")
+    geo = geoip.lookup(ip)
 
     db["sessions"].insert_one({
         "session_id": sid, "user_id": uid,
@@ -264,20 +300,24 @@ async def app_login(data: AppLoginRequest, request: Request):
         "last_activity": datetime.utcnow(),
         "expires_at": datetime.utcnow() + timedelta(hours=TOKEN_HOURS),
         "mfa_verified": False, "risk_at_login": user.get("risk_score", 0),
-        "revoked": False,
+        "revoked": False, "app_id": data.app_id,
+        "login_attempt_count": recent["account"] + 1,
+        "source_failed_logins": recent["other_accounts"],
+        "geo": geo,
     })
 
     db["session_behavior"].insert_one({
         "session_id": sid, "user_id": uid,
         "login_timestamp": datetime.utcnow(), "ip_address": ip,
-        "device_info": ua[:60], "location": "App Login",
+        "device_info": ua[:60], "location": geo["location"] if geo else "App Login",
         "accessed_services": [data.app_id], "action_count": 0,
         "download_count": 0, "duration_minutes": 0,
         "service_switches": 0, "failed_access_attempts": 0,
     })
     
     risk = await evaluate_session_risk(uid, sid)
-    
+    reeval.record(uid, sid, risk)
+
     token = create_token(uid, user["email"], sid)
     return {"access_token": token, "session_id": sid, "user": {"name": user.get("name"), "id": str(user["_id"])}}
 
@@ -322,7 +362,8 @@ async def app_action(data: AppActionRequest, request: Request, auth: tuple = Dep
                 "action": "module_dwell", "duration": duration, "timestamp": now
             })
 
-    risk = await evaluate_session_risk(uid, sid)
+    # Debounced: returns the last known score, re-scoring at most once per window
+    risk = await reeval.submit(uid, sid, sensitive=data.is_sensitive)
     return {"status": "success", "action": data.action, "risk_score": risk.get("score")}
 
 @app.get("/api/admin/user/{user_id}/activity-analytics")
@@ -415,7 +456,7 @@ async def get_profile(auth: tuple = Depends(get_current_user)):
 @app.get("/api/user/risk-score")
 async def get_risk_score(auth: tuple = Depends(get_current_user)):
     user, session = auth
-    result = await evaluate_session_risk(str(user["_id"]), session["session_id"])
+    result = await get_session_risk(str(user["_id"]), session["session_id"])
     return {
         "overall_risk": result.get("score", 0) / 100.0,
         "behavioral_anomaly": next((b["raw_risk"] / 100 for b in result.get("breakdown", []) if b["factor"] == "behavioral_anomaly"), 0),
@@ -447,6 +488,20 @@ async def admin_dashboard(auth: tuple = Depends(require_admin)):
     return await calculate_all_risks()
 
 
+@app.get("/api/admin/risk/sweep")
+async def admin_risk_sweep(auth: tuple = Depends(require_admin)):
+    """Batch re-score every active session without persisting anything."""
+    from batch_risk import evaluate_sessions_batch
+    db = get_db_connection()
+    sids = [row[0] for row in db["sessions"].find_fields({"revoked": False}, ("session_id",))]
+    results = await asyncio.to_thread(evaluate_sessions_batch, sids)
+    counts = {"ALLOW": 0, "RE_AUTHENTICATE": 0, "BLOCK": 0}
+    for r in results:
+        counts[r["decision"]] += 1
+    flagged = sorted((r for r in results if r["decision"] != "ALLOW"), key=lambda r: r["score"], reverse=True)
+    return {"evaluated": len(results), "decisions": counts, "flagged": flagged[:100]}
+
+
 @app.get("/api/admin/users")
 async def admin_users(auth: tuple = Depends(require_admin)):
     db = get_db_connection()
@@ -462,8 +517,31 @@ async def admin_users(auth: tuple = Depends(require_admin)):
     ]
 
 
+@app.get("/api/admin/users/at-risk")
+async def admin_users_at_risk(min_score: float = 0.6, offset: int = 0, limit: int = 50,
+                              auth: tuple = Depends(require_admin)):
+    """Users with risk_score >= min_score (0-1), highest first, paginated from the risk index."""
+    import risk_index
+    return risk_index.above(min_score, max(0, offset), max(1, min(limit, 500)))
+
+
+@app.get("/api/admin/shared-infrastructure")
+async def admin_shared_infrastructure(limit: int = 20, auth: tuple = Depends(require_admin)):
+    """IPs shared by the most accounts in the sliding login window."""
+    import shared_infra
+    return shared_infra.top_shared(max(1, min(limit, 200)))
+
+
 @app.get("/api/admin/incidents")
-async def admin_incidents(auth: tuple = Depends(require_admin)):
+async def admin_incidents(view: str = "list", hours: Optional[float] = None, limit: int = 100,
+                          auth: tuple = Depends(require_admin)):
+    """view=list (default): latest incidents.  view=campaigns: incidents and alerts
+    correlated by user / IP / device / time (see correlation.py)."""
+    if view == "campaigns":
+        import correlation
+        return await asyncio.to_thread(correlation.campaigns, hours, max(1, min(limit, 1000)))
+    if view != "list":
+        raise HTTPException(400, "view must be 'list' or 'campaigns'")
     db = get_db_connection()
     incidents = list(db["incidents"].find({}).sort("timestamp", -1).limit(100))
     return [
@@ -489,10 +567,18 @@ async def admin_alerts(auth: tuple = Depends(require_admin)):
             "severity": a["severity"], "status": a["status"],
             "description": a["description"], "timestamp": a["timestamp"],
             "acknowledged": a.get("acknowledged", False),
+            "reason": a.get("reason"), "count": a.get("count", 1),
+            "last_seen": a.get("last_seen", a["timestamp"]),
         })
     return out
 
 
+@app.get("/api/admin/alerts/aggregation")
+async def admin_alert_aggregation(auth: tuple = Depends(require_admin)):
+    import alert_aggregator
+    return alert_aggregator.status()
+
+
 @app.get("/api/admin/active-sessions")
 async def admin_active_sessions(auth: tuple = Depends(require_admin)):
     db = get_db_connection()
@@ -572,7 +658,7 @@ async def admin_action(user_id: str, data: AdminActionRequest, request: Request,
         "action": data.action, "reason": data.reason,
         "before_state": before, "after_state": after,
         "timestamp": datetime.utcnow(),
-        "ip_address": request.client.host if request.client else "unknown",
+        "ip_address": _client_ip(request, "unknown"),
     })
     return {"status": "success", "action": data.action}
 
@@ -589,6 +675,20 @@ async def user_risk_history(user_id: str, auth: tuple = Depends(require_admin)):
     ]
 
 
+@app.get("/api/admin/user/{user_id}/risk-chart")
+async def user_risk_chart(user_id: str, tier: str = "raw", days: int = 30, points: int = 200,
+                          auth: tuple = Depends(require_admin)):
+    """Risk score series downsampled (LTTB) to at most `points` points.
+
+    tier=raw charts the stored history rows; tier=hour / tier=day charts the
+    rollup averages and includes each bucket's min / max.
+    """
+    import risk_timeseries
+    if tier != "raw" and tier not in risk_timeseries.TIERS:
+        raise HTTPException(400, "tier must be raw, hour or day")
+    return risk_timeseries.chart(user_id, tier, datetime.utcnow() - timedelta(days=days), points)
+
+
 @app.get("/api/admin/user/{user_id}/sessions")
 async def user_sessions(user_id: str, auth: tuple = Depends(require_admin)):
     db = get_db_connection()
@@ -632,6 +732,121 @@ async def audit_trail(auth: tuple = Depends(require_admin)):
     ]
 
 
+@app.get("/api/admin/system/memory")
+async def system_memory(auth: tuple = Depends(require_admin)):
+    from db import memory_stats
+    return memory_stats()
+
+
+@app.post("/api/admin/system/baselines/rebuild")
+async def system_rebuild_baselines(auth: tuple = Depends(require_admin)):
+    from baselines import rebuild
+    return {"status": "rebuilt", "sessions": await asyncio.to_thread(rebuild)}
+
+
+@app.get("/api/admin/risk/policy")
+async def get_risk_policy(auth: tuple = Depends(require_admin)):
+    import policy
+    policy.current()
+    return policy.status()
+
+
+@app.put("/api/admin/risk/policy")
+async def put_risk_policy(request: Request, auth: tuple = Depends(require_admin)):
+    """Validate, persist and hot-swap a new risk policy document."""
+    import policy
+    try:
+        ps = policy.save(await request.json())
+    except ValueError as e:
+        raise HTTPException(400, f"Invalid policy: {e}")
+    return {"status": "applied", "version": ps.version, "policies": [p.name for p in ps.policies]}
+
+
+@app.post("/api/admin/risk/policy/reload")
+async def reload_risk_policy(auth: tuple = Depends(require_admin)):
+    import policy
+    try:
+        ps = policy.reload()
+    except ValueError as e:
+        raise HTTPException(400, f"Invalid policy: {e}")
+    return {"status": "reloaded", "version": ps.version, "source": ps.source}
+
+
+@app.get("/api/admin/system/continuous-eval")
+async def system_continuous_eval(auth: tuple = Depends(require_admin)):
+    import continuous_eval
+    return continuous_eval.status()
+
+
+@app.get("/api/admin/system/cohorts")
+async def system_cohorts(auth: tuple = Depends(require_admin)):
+    import cohort
+    return cohort.status()
+
+
+@app.post("/api/admin/system/cohorts/refresh")
+async def system_cohorts_refresh(auth: tuple = Depends(require_admin)):
+    import cohort
+    await asyncio.to_thread(cohort.refresh)
+    return cohort.status()
+
+
+@app.get("/api/admin/system/tracing")
+async def system_tracing(auth: tuple = Depends(require_admin)):
+    """Per-phase latency histograms and the slowest sampled risk evaluations."""
+    import tracing
+    return tracing.report()
+
+
+@app.post("/api/admin/system/tracing")
+async def configure_tracing(request: Request, auth: tuple = Depends(require_admin)):
+    """Body: {"sample_rate": 0-1, "reset": bool} (both optional)."""
+    import tracing
+    body = await request.json()
+    if body.get("reset"):
+        tracing.reset()
+    if "sample_rate" in body:
+        try:
+            tracing.set_sample_rate(body["sample_rate"])
+        except (TypeError, ValueError):
+            raise HTTPException(400, "sample_rate must be a number between 0 and 1")
+    return tracing.report()
+
+
+@app.get("/api/admin/system/mail")
+async def system_mail(auth: tuple = Depends(require_admin)):
+    """Outbound mail queue depth, delivery counters and circuit breaker state."""
+    import mail_queue
+    return mail_queue.status()
+
+
+@app.get("/api/admin/system/geoip")
+async def system_geoip(ip: Optional[str] = None, auth: tuple = Depends(require_admin)):
+    """GeoIP table status, or the lookup result for ?ip=."""
+    if ip is not None:
+        return {"ip": ip, "geo": geoip.lookup(ip)}
+    return geoip.status()
+
+
+@app.get("/api/admin/system/throttle")
+async def system_throttle(top: int = 10, auth: tuple = Depends(require_admin)):
+    """Login throttle limits, counters and the IPs / accounts with the most recent failures."""
+    return throttle.status(top)
+
+
+@app.get("/api/admin/system/archive")
+async def system_archive(auth: tuple = Depends(require_admin)):
+    from archive import archive_stats
+    return archive_stats()
+
+
+@app.post("/api/admin/system/memory/spill")
+async def system_memory_spill(auth: tuple = Depends(require_admin)):
+    from db import enforce_memory_budget, memory_stats
+    spilled = enforce_memory_budget()
+    return {"spilled_documents": spilled, "memory": memory_stats()}
+
+
 # ── App management ──
 @app.get("/api/admin/apps")
 async def list_apps(auth: tuple = Depends(require_admin)):
@@ -648,6 +863,37 @@ async def create_app(data: AppCreateRequest, auth: tuple = Depends(require_admin
     r = db["apps"].insert_one(doc)
     return {"id": str(r.inserted_id), "status": "created"}
 
+# ── Trusted networks (ip_location risk 0 inside these ranges) ──
+@app.get("/api/admin/trusted-networks")
+async def list_trusted_networks(auth: tuple = Depends(require_admin)):
+    from ip_trie import TRUSTED_CIDRS
+    db = get_db_connection()
+    nets = [{"id": str(n["_id"]), "cidr": n["cidr"], "label": n.get("label"), "created_at": n.get("created_at")}
+            for n in db["trusted_networks"].find({})]
+    return nets + [{"id": None, "cidr": c, "label": "TRUSTED_CIDRS", "created_at": None} for c in TRUSTED_CIDRS]
+
+@app.post("/api/admin/trusted-networks")
+async def create_trusted_network(data: TrustedNetworkCreate, auth: tuple = Depends(require_admin)):
+    import ipaddress
+    admin_user, _ = auth
+    try:
+        cidr = str(ipaddress.ip_network(data.cidr.strip(), strict=False))
+    except ValueError:
+        raise HTTPException(400, "Invalid CIDR")
+    db = get_db_connection()
+    if db["trusted_networks"].find_one({"cidr": cidr}):
+        raise HTTPException(409, "Network already trusted")
+    r = db["trusted_networks"].insert_one({"cidr": cidr, "label": data.label,
+                                           "created_by": str(admin_user["_id"]), "created_at": datetime.utcnow()})
+    return {"id": str(r.inserted_id), "cidr": cidr, "status": "created"}
+
+@app.delete("/api/admin/trusted-networks/{network_id}")
+async def delete_trusted_network(network_id: str, auth: tuple = Depends(require_admin)):
+    db = get_db_connection()
+    if not db["trusted_networks"].delete_one({"_id": network_id}):
+        raise HTTPException(404, "Trusted network not found")
+    return {"status": "deleted"}
+
 # ── User credentials per app ──
 @app.get("/api/admin/app/{app_id}/users")
 async def list_app_users(app_id: str, auth: tuple = Depends(require_admin)):
@@ -772,16 +1018,51 @@ async def health_check_legacy():
     return {"status": "healthy"}
 
 
+ARCHIVE_INTERVAL_MINUTES = float(os.getenv("ARCHIVE_INTERVAL_MINUTES", "60"))
+
+
+async def _archive_loop():
+    from archive import archive_old_logs
+    while True:
+        await asyncio.to_thread(archive_old_logs)
+        await asyncio.sleep(ARCHIVE_INTERVAL_MINUTES * 60)
+
+
 @app.on_event("startup")
 async def startup():
     await init_db()
+    snapshot = os.getenv("DB_SNAPSHOT_PATH")
+    warm = bool(snapshot) and os.path.exists(snapshot)
+    if warm:
+        from db import load
+        print(f"[OK] Loaded {load(snapshot)} documents from snapshot {snapshot}")
     from demo import seed_demo_data
     await seed_demo_data()
     from db import seed_activity_data
     await seed_activity_data()
+    if snapshot and not warm:
+        from db import dump
+        print(f"[OK] Wrote {dump(snapshot)} documents to snapshot {snapshot}")
+    asyncio.create_task(_archive_loop())
+    import mail_queue
+    mail_queue.start()
+    import alert_aggregator
+    asyncio.create_task(alert_aggregator.digest_loop())
+    import cohort
+    await asyncio.to_thread(cohort.refresh)
+    import continuous_eval
+    continuous_eval.start()
     print("[OK] Zero Trust API ready on port 8080")
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    import continuous_eval
+    continuous_eval.stop()
+    import mail_queue
+    await asyncio.to_thread(mail_queue.stop)
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8080)
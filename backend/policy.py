@@ -0,0 +1,327 @@
+"""
+Risk Policy
+===========
+Weights, business hours, behavioral limits and decision cutoffs used to be
+module constants in risk_engine / utils.  They now come from a declarative
+JSON policy file (RISK_POLICY_PATH, default risk_policy.json next to this
+module):
+
+    {
+      "default": {"weights": {...}, "normal_hours": [8, 20],
+                  "max_normal_downloads": 10, "max_normal_service_switches": 5,
+                  "thresholds": {"allow": 30, "re_authenticate": 60}},
+      "roles": {"admin": {<partial overrides>}},
+      "apps":  {"app_hr": {<partial overrides>}}
+    }
+
+Sections override the default key by key (weights merge per component);
+an app section is applied on top of a role section.  Weights are relative:
+each compiled policy divides them by their sum, so the weighted score stays
+on the 0-100 scale the thresholds are written for when components are
+added (the defaults sum to 1.2 since shared_infrastructure and
+impossible_travel joined) or a section raises one weight.  A policy document is
+validated and compiled into a PolicySet up front: one CompiledPolicy per
+(role, app) combination with a weight tuple in component order, a 24-entry
+hour table (risk + explanation) and the cutoffs, plus stacked NumPy tables
+for batch_risk.  Evaluation is then dict lookups and table reads only.
+
+The active PolicySet is swapped with a single assignment, so evaluations
+see either the old or the new policy, never a mix.  The file is re-checked
+every RISK_POLICY_CHECK_SECONDS; invalid files are rejected and the
+running policy stays in place.
+"""
+
+import copy
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+RISK_POLICY_PATH = os.getenv("RISK_POLICY_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "risk_policy.json")
+RISK_POLICY_CHECK_SECONDS = float(os.getenv("RISK_POLICY_CHECK_SECONDS", "5"))
+
+COMPONENTS = (
+    "time_deviation", "device_mismatch", "ip_location", "behavioral_anomaly",
+    "download_spike", "unauthorized_service", "login_attempts", "shared_infrastructure",
+    "impossible_travel",
+)
+
+DEFAULT_POLICY = {
+    "weights": {
+        "time_deviation":       0.15,
+        "device_mismatch":      0.15,
+        "ip_location":          0.15,
+        "behavioral_anomaly":   0.20,
+        "download_spike":       0.15,
+        "unauthorized_service": 0.15,
+        "login_attempts":       0.10,
+        "shared_infrastructure": 0.10,
+        "impossible_travel":    0.10,
+    },
+    "normal_hours": [8, 20],
+    "max_normal_downloads": 10,
+    "max_normal_service_switches": 5,
+    "thresholds": {"allow": 30, "re_authenticate": 60},
+}
+
+SECTION_KEYS = set(DEFAULT_POLICY)
+TOP_KEYS = {"default", "roles", "apps", "version", "description"}
+
+
+class PolicyError(ValueError):
+    pass
+
+
+# ─── Validation ──────────────────────────────────────────────────────
+
+def _number(where, value, lo=None, hi=None):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise PolicyError(f"{where}: expected a number, got {value!r}")
+    if (lo is not None and value < lo) or (hi is not None and value > hi):
+        raise PolicyError(f"{where}: {value} outside [{lo}, {hi}]")
+    return value
+
+
+def _check_section(where, section):
+    if not isinstance(section, dict):
+        raise PolicyError(f"{where}: expected an object")
+    unknown = set(section) - SECTION_KEYS
+    if unknown:
+        raise PolicyError(f"{where}: unknown keys {sorted(unknown)}")
+    weights = section.get("weights", {})
+    if not isinstance(weights, dict):
+        raise PolicyError(f"{where}.weights: expected an object")
+    for name, w in weights.items():
+        if name not in COMPONENTS:
+            raise PolicyError(f"{where}.weights: unknown component {name!r}")
+        _number(f"{where}.weights.{name}", w, 0, 1)
+    if "normal_hours" in section:
+        hours = section["normal_hours"]
+        if not isinstance(hours, list) or len(hours) != 2 or not all(isinstance(h, int) and not isinstance(h, bool) for h in hours):
+            raise PolicyError(f"{where}.normal_hours: expected [start, end] hours")
+        if not 0 <= hours[0] <= hours[1] <= 23:
+            raise PolicyError(f"{where}.normal_hours: need 0 <= start <= end <= 23")
+    for key in ("max_normal_downloads", "max_normal_service_switches"):
+        if key in section:
+            _number(f"{where}.{key}", section[key], 1e-9)
+    if "thresholds" in section:
+        t = section["thresholds"]
+        if not isinstance(t, dict) or set(t) - {"allow", "re_authenticate"}:
+            raise PolicyError(f"{where}.thresholds: expected allow / re_authenticate")
+        for k, v in t.items():
+            _number(f"{where}.thresholds.{k}", v, 0, 100)
+
+
+def _merge(base, override):
+    out = copy.deepcopy(base)
+    for key, value in override.items():
+        if key in ("weights", "thresholds"):
+            out[key] = dict(out[key], **value)
+        else:
+            out[key] = copy.deepcopy(value)
+    return out
+
+
+def validate(doc):
+    if not isinstance(doc, dict):
+        raise PolicyError("policy: expected a JSON object")
+    unknown = set(doc) - TOP_KEYS
+    if unknown:
+        raise PolicyError(f"policy: unknown keys {sorted(unknown)}")
+    _check_section("default", doc.get("default", {}))
+    for group in ("roles", "apps"):
+        sections = doc.get(group, {})
+        if not isinstance(sections, dict):
+            raise PolicyError(f"{group}: expected an object")
+        for name, section in sections.items():
+            _check_section(f"{group}.{name}", section)
+
+
+# ─── Compilation ─────────────────────────────────────────────────────
+
+class CompiledPolicy:
+    __slots__ = ("name", "index", "weights", "weight_map", "hour_table", "normal_hours",
+                 "max_downloads", "max_switches", "allow", "re_authenticate")
+
+    def __init__(self, name, index, spec):
+        t = spec["thresholds"]
+        if not 0 <= t["allow"] <= t["re_authenticate"] <= 100:
+            raise PolicyError(f"{name}: need 0 <= allow <= re_authenticate <= 100")
+        total = float(sum(spec["weights"][c] for c in COMPONENTS))
+        if total <= 0:
+            raise PolicyError(f"{name}: weights sum to zero")
+        self.name = name
+        self.index = index
+        self.weight_map = {c: spec["weights"][c] / total for c in COMPONENTS}
+        self.weights = tuple(self.weight_map[c] for c in COMPONENTS)
+        self.normal_hours = tuple(spec["normal_hours"])
+        self.max_downloads = spec["max_normal_downloads"]
+        self.max_switches = spec["max_normal_service_switches"]
+        self.allow = t["allow"]
+        self.re_authenticate = t["re_authenticate"]
+        self.hour_table = tuple(self.hour_risk(h) for h in range(24))
+
+    def hour_risk(self, hour):
+        start, end = self.normal_hours
+        if start <= hour <= end:
+            return 0.0, f"Login at {hour}:00 — within business hours ({start:02d}-{end:02d})"
+        dev = start - hour if hour < start else hour - end
+        risk = min(100, (dev / 12) * 100)
+        if 0 <= hour <= 4:
+            return min(100, risk * 1.5), f"Login at {hour}:00 — deep off-hours (midnight-4 AM zone)"
+        return risk, f"Login at {hour}:00 — outside normal business hours"
+
+    def decision(self, score):
+        if score <= self.allow:
+            return "ALLOW"
+        if score <= self.re_authenticate:
+            return "RE_AUTHENTICATE"
+        return "BLOCK"
+
+
+class PolicySet:
+    """All compiled policies of one policy document, selected by (role, app)."""
+
+    def __init__(self, doc, version, source=None):
+        validate(doc)
+        self.doc = doc
+        self.version = version
+        self.source = source
+        self.loaded_at = datetime.utcnow()
+        base = _merge(DEFAULT_POLICY, doc.get("default", {}))
+        roles = doc.get("roles", {})
+        apps = doc.get("apps", {})
+
+        specs = {(None, None): ("default", base)}
+        for role, section in roles.items():
+            specs[(role, None)] = (f"role:{role}", _merge(base, section))
+        for app, section in apps.items():
+            specs[(None, app)] = (f"app:{app}", _merge(base, section))
+            for role in roles:
+                specs[(role, app)] = (f"role:{role}+app:{app}", _merge(specs[(role, None)][1], section))
+
+        self.policies = []
+        self._by_key = {}
+        for key, (name, spec) in specs.items():
+            compiled = CompiledPolicy(name, len(self.policies), spec)
+            self.policies.append(compiled)
+            self._by_key[key] = compiled
+        self.default = self._by_key[(None, None)]
+        self.by_name = {p.name: p for p in self.policies}
+        self._tables = None
+
+    def select(self, role=None, app_id=None) -> CompiledPolicy:
+        by_key = self._by_key
+        return (by_key.get((role, app_id)) or by_key.get((None, app_id))
+                or by_key.get((role, None)) or self.default)
+
+    def tables(self) -> dict:
+        """Per-policy parameters stacked for vectorized scoring (row i = policy index i)."""
+        if self._tables is None:
+            ps = self.policies
+            self._tables = {
+                "weights": np.array([p.weights for p in ps], dtype=np.float64),
+                "hour_risk": np.array([[r for r, _ in p.hour_table] for p in ps], dtype=np.float64),
+                "max_downloads": np.array([p.max_downloads for p in ps], dtype=np.float64),
+                "max_switches": np.array([p.max_switches for p in ps], dtype=np.float64),
+                "allow": np.array([p.allow for p in ps], dtype=np.float64),
+                "re_authenticate": np.array([p.re_authenticate for p in ps], dtype=np.float64),
+            }
+        return self._tables
+
+
+# ─── Active Policy ───────────────────────────────────────────────────
+
+_lock = threading.Lock()
+_swap_hooks = []
+_active = PolicySet({}, version=0, source="built-in")
+_file_mtime = None
+_next_check = 0.0
+
+
+def on_swap(callback):
+    """Register callback(policy_set), run after every successful swap."""
+    _swap_hooks.append(callback)
+
+
+def _swap(ps):
+    global _active
+    _active = ps
+    for cb in _swap_hooks:
+        cb(ps)
+
+
+def apply(doc, source="api") -> PolicySet:
+    """Validate + compile a policy document and make it active; raises PolicyError."""
+    with _lock:
+        ps = PolicySet(doc, version=_active.version + 1, source=source)
+        _swap(ps)
+    return ps
+
+
+def reload(path=None) -> PolicySet:
+    """(Re)load the policy file; a missing file means built-in defaults."""
+    global _file_mtime
+    path = path or RISK_POLICY_PATH
+    if not os.path.exists(path):
+        _file_mtime = None
+        return _active
+    mtime = os.path.getmtime(path)
+    try:
+        with open(path) as f:
+            doc = json.load(f)
+    except json.JSONDecodeError as e:
+        raise PolicyError(f"{path}: {e}")
+    ps = apply(doc, source=path)
+    _file_mtime = mtime
+    return ps
+
+
+def save(doc, path=None) -> PolicySet:
+    """Validate, write the policy file atomically and activate it."""
+    global _file_mtime
+    path = path or RISK_POLICY_PATH
+    PolicySet(doc, version=0)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(doc, f, indent=2)
+    os.replace(tmp, path)
+    ps = apply(doc, source=path)
+    _file_mtime = os.path.getmtime(path)
+    return ps
+
+
+def _check_file():
+    global _next_check, _file_mtime
+    _next_check = time.monotonic() + RISK_POLICY_CHECK_SECONDS
+    try:
+        mtime = os.path.getmtime(RISK_POLICY_PATH)
+    except OSError:
+        return
+    if mtime != _file_mtime:
+        try:
+            ps = reload()
+            print(f"[OK] Risk policy v{ps.version} loaded from {RISK_POLICY_PATH}")
+        except (PolicyError, OSError) as e:
+            print(f"[WARN] Rejected risk policy {RISK_POLICY_PATH}: {e}")
+            _file_mtime = mtime
+
+
+def current() -> PolicySet:
+    if time.monotonic() >= _next_check:
+        _check_file()
+    return _active
+
+
+def status() -> dict:
+    ps = _active
+    return {
+        "version": ps.version, "source": ps.source, "loaded_at": ps.loaded_at,
+        "policies": [p.name for p in ps.policies], "document": ps.doc,
+    }
+
+
+_check_file()
@@ -0,0 +1,168 @@
+"""
+Coalesced Session Re-Evaluation
+================================
+/api/app-action used to run the full evaluate_session_risk on every click.
+The scheduler here marks a session dirty instead and re-scores it at most
+once per REEVAL_WINDOW_SECONDS; all actions inside the window coalesce
+into a single evaluation that runs when the window closes.  Callers get
+the last known result straight away.
+
+Critical signals skip the debounce: REEVAL_BURST_COUNT sensitive actions
+within REEVAL_BURST_SECONDS trigger an immediate evaluation.
+
+Per-session state is dropped when the session is revoked or deleted, and
+when it simply expires: open sessions' expires_at sit in a heap that is
+drained on every session write and every submit().
+"""
+
+import asyncio
+import heapq
+import os
+import time
+from collections import deque
+from datetime import datetime
+
+import db
+from risk_engine import evaluate_session_risk
+
+REEVAL_WINDOW_SECONDS = float(os.getenv("REEVAL_WINDOW_SECONDS", "5"))
+REEVAL_BURST_COUNT = int(os.getenv("REEVAL_BURST_COUNT", "3"))
+REEVAL_BURST_SECONDS = float(os.getenv("REEVAL_BURST_SECONDS", "60"))
+
+
+class _SessionState:
+    __slots__ = ("user_id", "last_eval", "last_result", "timer", "running", "dirty", "sensitive")
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.last_eval = 0.0
+        self.last_result = None
+        self.timer = None
+        self.running = False
+        self.dirty = False
+        self.sensitive = deque()
+
+
+_states: dict = {}   # session_id -> _SessionState
+_expires: dict = {}  # session_id -> expires_at of open sessions
+_expiry: list = []   # heap of (expires_at, session_id); stale when _expires moved on
+_tasks: set = set()  # in-flight timer re-evaluations; the loop only keeps weak references
+
+
+def _forget(session_id):
+    st = _states.pop(session_id, None)
+    if st is not None and st.timer is not None:
+        st.timer.cancel()
+
+
+def _drop_expired(now):
+    while _expiry and _expiry[0][0] < now:
+        exp, sid = heapq.heappop(_expiry)
+        if _expires.get(sid) == exp:
+            del _expires[sid]
+            _forget(sid)
+
+
+def record(user_id: str, session_id: str, result: dict):
+    """Remember an evaluation that happened outside the scheduler (e.g. at login)."""
+    st = _states.get(session_id) or _states.setdefault(session_id, _SessionState(user_id))
+    st.last_result = result
+    st.last_eval = time.monotonic()
+
+
+def _is_burst(st, now):
+    st.sensitive.append(now)
+    while st.sensitive and now - st.sensitive[0] > REEVAL_BURST_SECONDS:
+        st.sensitive.popleft()
+    return len(st.sensitive) >= REEVAL_BURST_COUNT
+
+
+async def _run(session_id):
+    st = _states.get(session_id)
+    if st is None:
+        return None
+    if st.timer is not None:
+        st.timer.cancel()
+        st.timer = None
+    st.running = True
+    st.dirty = False
+    try:
+        result = await evaluate_session_risk(st.user_id, session_id)
+    finally:
+        st.running = False
+    st.last_result = result
+    st.last_eval = time.monotonic()
+    if st.dirty:
+        _schedule(session_id, st)
+    return result
+
+
+def _done(task):
+    _tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"[WARN] Scheduled re-evaluation failed: {task.exception()!r}")
+
+
+def _fire(session_id):
+    task = asyncio.ensure_future(_run(session_id))
+    _tasks.add(task)
+    task.add_done_callback(_done)
+
+
+def _schedule(session_id, st):
+    if st.timer is not None:
+        return
+    wait = max(0.0, REEVAL_WINDOW_SECONDS - (time.monotonic() - st.last_eval))
+    st.timer = asyncio.get_running_loop().call_later(wait, _fire, session_id)
+
+
+async def submit(user_id: str, session_id: str, sensitive: bool = False) -> dict:
+    """Mark the session dirty; returns the freshest result available without waiting."""
+    _drop_expired(datetime.utcnow())
+    st = _states.get(session_id) or _states.setdefault(session_id, _SessionState(user_id))
+    now = time.monotonic()
+    critical = sensitive and _is_burst(st, now)
+
+    if st.running:
+        st.dirty = True
+        return st.last_result or {}
+    if st.last_result is None or critical or now - st.last_eval >= REEVAL_WINDOW_SECONDS:
+        if critical:
+            st.sensitive.clear()
+        return await _run(session_id)
+    _schedule(session_id, st)
+    return st.last_result
+
+
+def _track(session_id, expires_at):
+    if isinstance(expires_at, datetime) and _expires.get(session_id) != expires_at:
+        _expires[session_id] = expires_at
+        heapq.heappush(_expiry, (expires_at, session_id))
+
+
+def _on_session_write(before, after):
+    _drop_expired(datetime.utcnow())
+    # Forget sessions once they are revoked or removed
+    if after is None or after.get("revoked"):
+        sid = (after or before).get("session_id")
+        _expires.pop(sid, None)
+        _forget(sid)
+    else:
+        _track(after.get("session_id"), after.get("expires_at"))
+
+
+def rebuild():
+    rows = db.get_db_connection()["sessions"].find_fields({"revoked": False}, ("session_id", "expires_at"))
+    _expires.clear()
+    _expiry.clear()
+    for sid, exp in rows:
+        _track(sid, exp)
+    open_sids = {sid for sid, _ in rows}
+    for sid in [s for s in _states if s not in open_sids]:
+        _forget(sid)
+    _drop_expired(datetime.utcnow())
+
+
+db.watch("sessions", _on_session_write)
+db.on_reset(rebuild)
+rebuild()
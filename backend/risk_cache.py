@@ -0,0 +1,235 @@
+"""
+Versioned Session Risk Cache
+=============================
+Caches the last evaluate_session_risk result per session, keyed by a
+version token of everything the score depends on:
+
+  - the session doc's scoring fields (start time, device, IP, login attempts,
+    failed logins from the source IP)
+  - the session_behavior doc
+  - the user's decayed baseline and quantile sketches (move when one of
+    their sessions closes), role cohort thresholds and peer-group
+    baselines, device / IP history
+  - the user's credential set and role, the app catalogue, trusted networks
+    and the active risk policy
+  - shared_infra.version() of the session's IP: how many other accounts
+    share it changes with their logins and as the window slides, without
+    any write to this session or user
+
+db.watch hooks bump the relevant counter on every write, so a stored
+result is served only while none of its inputs changed.  Writes that do
+not affect scoring (last_activity, revoked, risk_score ...) leave entries
+alone.  lookup() is what read-only callers use; evaluate_session_risk
+stores into the cache itself (not for sessions it has just revoked).
+
+Entries are dropped when their session is revoked, deleted or expires
+(expires_at is tracked in a heap drained on every write, store and
+lookup), and the cache is an LRU capped at RISK_CACHE_MAX_ENTRIES.
+"""
+
+import heapq
+import itertools
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import baselines
+import cohort
+import db
+import policy
+import shared_infra
+import sketches
+
+SESSION_FIELDS = ("start_time", "login_attempt_count", "source_failed_logins")
+HISTORY_FIELDS = ("device_fingerprint", "ip_address", "user_id")
+RISK_CACHE_MAX_ENTRIES = int(os.getenv("RISK_CACHE_MAX_ENTRIES", "20000"))
+
+_lock = threading.Lock()
+_clock = itertools.count(1)
+_global_ver = 0
+_user_ver: dict = {}      # user_id -> version
+_session_ver: dict = {}   # session_id -> version
+_entries: "OrderedDict[str, tuple]" = OrderedDict()   # session_id -> (token, result), LRU order
+_expires: dict = {}       # session_id -> expires_at of open sessions
+_expiry: list = []        # heap of (expires_at, session_id); stale when _expires moved on
+_session_ip: dict = {}    # session_id -> ip_address of open sessions
+_stats = {"hits": 0, "misses": 0}
+
+
+def token(user_id: str, session_id: str) -> tuple:
+    """Current version of a session's scoring inputs; take it before reading them."""
+    with _lock:
+        ip = _session_ip.get(session_id)
+        versions = (_global_ver, _user_ver.get(user_id, 0), _session_ver.get(session_id, 0))
+    return versions + (shared_infra.version(ip),)
+
+
+def lookup(user_id: str, session_id: str):
+    """Cached result if no input changed since it was computed, else None."""
+    current = token(user_id, session_id)
+    with _lock:
+        _drop_expired(datetime.utcnow())
+        entry = _entries.get(session_id)
+        if entry is not None and entry[0] == current:
+            _entries.move_to_end(session_id)
+            _stats["hits"] += 1
+            return entry[1]
+        _stats["misses"] += 1
+        return None
+
+
+def store(session_id: str, tok: tuple, result: dict):
+    with _lock:
+        _drop_expired(datetime.utcnow())
+        _entries[session_id] = (tok, result)
+        _entries.move_to_end(session_id)
+        while len(_entries) > RISK_CACHE_MAX_ENTRIES:
+            _entries.popitem(last=False)
+
+
+def clear():
+    global _global_ver
+    with _lock:
+        _global_ver = next(_clock)
+        _entries.clear()
+        _user_ver.clear()
+        _session_ver.clear()
+        _expires.clear()
+        _expiry.clear()
+        _session_ip.clear()
+
+
+def rebuild():
+    """clear(), then pick up the IPs of open sessions already in the store (startup / snapshot loads)."""
+    rows = db.get_db_connection()["sessions"].find_fields({}, ("session_id", "ip_address", "revoked"))
+    clear()
+    with _lock:
+        _session_ip.update((sid, ip) for sid, ip, revoked in rows if not revoked)
+
+
+def stats() -> dict:
+    with _lock:
+        return dict(_stats, entries=len(_entries))
+
+
+# ─── Write Hooks ─────────────────────────────────────────────────────
+
+def _bump_user(uid):
+    if uid is not None:
+        _user_ver[uid] = next(_clock)
+
+
+def _bump_session(sid):
+    if sid is not None:
+        _session_ver[sid] = next(_clock)
+
+
+def _changed(before, after, fields):
+    if before is None or after is None:
+        return True
+    return any(before.get(f) != after.get(f) for f in fields)
+
+
+def _forget(sid):
+    _entries.pop(sid, None)
+    _session_ver.pop(sid, None)
+    _expires.pop(sid, None)
+    _session_ip.pop(sid, None)
+
+
+def _drop_expired(now):
+    while _expiry and _expiry[0][0] < now:
+        exp, sid = heapq.heappop(_expiry)
+        if _expires.get(sid) == exp:
+            _forget(sid)
+
+
+def _on_session_write(before, after):
+    with _lock:
+        _drop_expired(datetime.utcnow())
+        if after is None:
+            _forget(before.get("session_id"))
+            _bump_user(before.get("user_id"))
+            return
+        sid, exp = after.get("session_id"), after.get("expires_at")
+        if after.get("revoked"):
+            _forget(sid)
+        else:
+            _session_ip[sid] = after.get("ip_address")
+            if isinstance(exp, datetime) and _expires.get(sid) != exp:
+                _expires[sid] = exp
+                heapq.heappush(_expiry, (exp, sid))
+        # Device / IP history is shared by all of the user's sessions
+        if _changed(before, after, HISTORY_FIELDS):
+            _bump_user(after.get("user_id"))
+            if before is not None:
+                _bump_user(before.get("user_id"))
+        if _changed(before, after, SESSION_FIELDS):
+            _bump_session(after.get("session_id"))
+
+
+def _on_behavior_write(before, after):
+    with _lock:
+        for doc in (before, after):
+            if doc is not None:
+                _bump_session(doc.get("session_id"))
+
+
+def _on_baseline_fold(user_id, values):
+    with _lock:
+        _bump_user(user_id)
+
+
+def _on_credential_write(before, after):
+    with _lock:
+        for doc in (before, after):
+            if doc is not None:
+                _bump_user(doc.get("user_id"))
+
+
+def _on_app_write(before, after):
+    global _global_ver
+    with _lock:
+        _global_ver = next(_clock)
+
+
+def _on_policy_swap(policies):
+    _on_app_write(None, None)
+
+
+def _on_cohort_change(name):
+    _on_app_write(None, None)
+
+
+def _on_cohort_refresh():
+    _on_app_write(None, None)
+
+
+def _on_user_write(before, after):
+    # Role selects the risk policy
+    if before is not None and after is not None and before.get("role") != after.get("role"):
+        with _lock:
+            _bump_user(after.get("_id"))
+
+
+def _memory_report():
+    with _lock:
+        n = len(_entries)
+        versions = len(_user_ver) + len(_session_ver) + len(_expires) + len(_expiry) + len(_session_ip)
+    return {"entries": n, "approx_bytes": n * 1500 + versions * 120}
+
+
+db.watch("sessions", _on_session_write)
+db.watch("session_behavior", _on_behavior_write)
+db.watch("user_credentials", _on_credential_write)
+db.watch("apps", _on_app_write)
+db.watch("trusted_networks", _on_app_write)
+db.watch("users", _on_user_write)
+policy.on_swap(_on_policy_swap)
+baselines.on_fold(_on_baseline_fold)
+sketches.on_cohort_change(_on_cohort_change)
+cohort.on_refresh(_on_cohort_refresh)
+db.on_reset(rebuild)
+db.register_index("risk_cache", _memory_report)
+rebuild()
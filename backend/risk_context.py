@@ -0,0 +1,228 @@
+"""
+Per-User Risk Context Cache
+============================
+Everything evaluate_session_risk needs to know about a user's history, kept
+in memory so an evaluation does no history scans:
+
+  - devices and IPs seen across the user's sessions (per-session keyed, so
+    the session being evaluated can be excluded); IPs live in an
+    ip_trie.IPIndex for prefix matching
+  - app credentials the user holds, resolved to allowed service names
+
+Contexts live in an LRU cache (RISK_CONTEXT_CACHE_SIZE users).  A miss
+builds the context with one pass over the user's sessions and credentials;
+after that, db.watch hooks on `sessions`, `user_credentials` and `apps`
+keep cached contexts current.  invalidate() drops entries explicitly.
+"""
+
+import os
+import threading
+from collections import Counter, OrderedDict
+
+import db
+from ip_trie import IPIndex
+
+RISK_CONTEXT_CACHE_SIZE = int(os.getenv("RISK_CONTEXT_CACHE_SIZE", "10000"))
+
+_lock = threading.Lock()
+_cache: "OrderedDict[str, RiskContext]" = OrderedDict()
+_app_names: dict = {}
+_apps_loaded = False
+
+
+class KnownView:
+    """Read-only set view over a Counter, minus one session's contribution."""
+
+    __slots__ = ("_counts", "_own")
+
+    def __init__(self, counts, own):
+        self._counts = counts
+        self._own = own
+
+    def _count(self, value):
+        return self._counts.get(value, 0) - (1 if value == self._own else 0)
+
+    def __contains__(self, value):
+        return self._count(value) > 0
+
+    def __len__(self):
+        n = len(self._counts)
+        if self._own in self._counts and self._counts[self._own] == 1:
+            n -= 1
+        return n
+
+    def __iter__(self):
+        return (v for v in self._counts if self._count(v) > 0)
+
+
+class RiskContext:
+    __slots__ = ("user_id", "sessions", "devices", "ips", "credentials")
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.sessions = {}          # session_id -> (device, ip)
+        self.devices = Counter()
+        self.ips = IPIndex()
+        self.credentials = {}       # credential _id -> app_id
+
+    def set_session(self, sid, device, ip):
+        self.drop_session(sid)
+        self.sessions[sid] = (device, ip)
+        if device:
+            self.devices[device] += 1
+        if ip:
+            self.ips.add(ip)
+
+    def drop_session(self, sid):
+        old = self.sessions.pop(sid, None)
+        if old is None:
+            return
+        device, ip = old
+        if device:
+            self.devices[device] -= 1
+            if self.devices[device] <= 0:
+                del self.devices[device]
+        if ip:
+            self.ips.remove(ip)
+
+    def known_devices(self, session_id):
+        own = self.sessions.get(session_id, (None, None))[0]
+        return KnownView(self.devices, own)
+
+    def known_ips(self, session_id):
+        own = self.sessions.get(session_id, (None, None))[1]
+        return self.ips.view(own)
+
+    def allowed_services(self):
+        return [_app_names[a] for a in self.credentials.values() if a in _app_names]
+
+
+def _load_apps():
+    global _apps_loaded
+    if _apps_loaded:
+        return
+    for a in db.get_db_connection()["apps"].find({}):
+        _app_names[a["_id"]] = a.get("name", a["_id"])
+    _apps_loaded = True
+
+
+def _build(user_id):
+    conn = db.get_db_connection()
+    ctx = RiskContext(user_id)
+    for s in conn["sessions"].find({"user_id": user_id}):
+        ctx.set_session(s.get("session_id"), s.get("device_fingerprint", ""), s.get("ip_address", ""))
+    for c in conn["user_credentials"].find({"user_id": user_id}):
+        ctx.credentials[c["_id"]] = c.get("app_id")
+    return ctx
+
+
+def get(user_id: str) -> RiskContext:
+    with _lock:
+        _load_apps()
+        ctx = _cache.get(user_id)
+        if ctx is not None:
+            _cache.move_to_end(user_id)
+            return ctx
+        ctx = _build(user_id)
+        _cache[user_id] = ctx
+        while len(_cache) > RISK_CONTEXT_CACHE_SIZE:
+            _cache.popitem(last=False)
+        return ctx
+
+
+def warm(user_ids) -> dict:
+    """Contexts for many users, building the missing ones with one pass over sessions and credentials.
+
+    Returns {user_id: RiskContext} for every requested user.  Bulk callers
+    should use that mapping for the rest of their pass rather than get():
+    beyond RISK_CONTEXT_CACHE_SIZE users the freshly built contexts are
+    evicted from the LRU at once, and get() would rebuild each with a full
+    sessions scan.
+    """
+    with _lock:
+        _load_apps()
+        contexts, missing = {}, set()
+        for u in user_ids:
+            ctx = _cache.get(u)
+            if ctx is None:
+                missing.add(u)
+            else:
+                contexts[u] = ctx
+        if not missing:
+            return contexts
+        built = {u: RiskContext(u) for u in missing}
+        conn = db.get_db_connection()
+        for sid, uid, device, ip in conn["sessions"].find_fields(
+                {"user_id": {"$in": missing}}, ("session_id", "user_id", "device_fingerprint", "ip_address")):
+            built[uid].set_session(sid, device if device is not None else "", ip if ip is not None else "")
+        for cid, uid, app_id in conn["user_credentials"].find_fields(
+                {"user_id": {"$in": missing}}, ("_id", "user_id", "app_id")):
+            built[uid].credentials[cid] = app_id
+        _cache.update(built)
+        while len(_cache) > RISK_CONTEXT_CACHE_SIZE:
+            _cache.popitem(last=False)
+        contexts.update(built)
+        return contexts
+
+
+def invalidate(user_id: str = None):
+    """Drop one user's context, or everything (including app names) when no user given."""
+    global _apps_loaded
+    with _lock:
+        if user_id is None:
+            _cache.clear()
+            _app_names.clear()
+            _apps_loaded = False
+        else:
+            _cache.pop(user_id, None)
+
+
+# ─── Write Hooks ─────────────────────────────────────────────────────
+
+def _on_session_write(before, after):
+    with _lock:
+        if before is not None:
+            ctx = _cache.get(before.get("user_id"))
+            if ctx is not None and (after is None or after.get("user_id") != before.get("user_id")):
+                ctx.drop_session(before.get("session_id"))
+        if after is not None:
+            ctx = _cache.get(after.get("user_id"))
+            if ctx is None:
+                return
+            key = (after.get("device_fingerprint", ""), after.get("ip_address", ""))
+            if ctx.sessions.get(after.get("session_id")) != key:
+                ctx.set_session(after.get("session_id"), *key)
+
+
+def _on_credential_write(before, after):
+    with _lock:
+        if before is not None:
+            ctx = _cache.get(before.get("user_id"))
+            if ctx is not None:
+                ctx.credentials.pop(before["_id"], None)
+        if after is not None:
+            ctx = _cache.get(after.get("user_id"))
+            if ctx is not None:
+                ctx.credentials[after["_id"]] = after.get("app_id")
+
+
+def _on_app_write(before, after):
+    with _lock:
+        if before is not None:
+            _app_names.pop(before["_id"], None)
+        if after is not None:
+            _app_names[after["_id"]] = after.get("name", after["_id"])
+
+
+def _memory_report():
+    with _lock:
+        users = len(_cache)
+        entries = sum(len(c.sessions) + len(c.credentials) for c in _cache.values())
+    return {"entries": users, "approx_bytes": users * 600 + entries * 200}
+
+
+db.watch("sessions", _on_session_write)
+db.watch("user_credentials", _on_credential_write)
+db.watch("apps", _on_app_write)
+db.on_reset(invalidate)
+db.register_index("risk_context", _memory_report)
@@ -28,42 +28,32 @@ increase overall risk non-linearly).
 
 from datetime import datetime, timedelta
 from typing import Dict, List, Tuple
-import math
+import alert_aggregator
+import cohort
+import dashboard_metrics
+import geoip
+import ip_trie
+import policy
+import risk_cache
+import risk_context
+import risk_index
+import risk_timeseries
+import shared_infra
+import sketches
+import throttle
+import tracing
 from db import get_db_connection
-from email_utils import send_security_alert
 from utils import get_risk_level
 
-# ─── Weight Configuration ────────────────────────────────────────────
-RISK_WEIGHTS = {
-    "time_deviation":       0.15,
-    "device_mismatch":      0.15,
-    "ip_location":          0.15,
-    "behavioral_anomaly":   0.20,
-    "download_spike":       0.15,
-    "unauthorized_service": 0.15,
-    "login_attempts":       0.10,
-}
-
-NORMAL_HOURS_START = 8
-NORMAL_HOURS_END = 20
-MAX_NORMAL_DOWNLOADS = 10
-MAX_NORMAL_SERVICE_SWITCHES = 5
-
-
 # ─── Component Calculators ───────────────────────────────────────────
+# Weights, normal hours and limits come from the active risk policy (see policy.py);
+# calculators given no policy use the current default section.
 
-def calc_time_deviation(login_hour: int) -> Tuple[float, str]:
-    if NORMAL_HOURS_START <= login_hour <= NORMAL_HOURS_END:
-        return 0.0, f"Login at {login_hour}:00 — within business hours (08-20)"
-    if login_hour < NORMAL_HOURS_START:
-        dev = NORMAL_HOURS_START - login_hour
-    else:
-        dev = login_hour - NORMAL_HOURS_END
-    risk = min(100, (dev / 12) * 100)
-    if 0 <= login_hour <= 4:
-        risk = min(100, risk * 1.5)
-        return risk, f"Login at {login_hour}:00 — deep off-hours (midnight-4 AM zone)"
-    return risk, f"Login at {login_hour}:00 — outside normal business hours"
+def calc_time_deviation(login_hour: int, pol=None) -> Tuple[float, str]:
+    pol = pol or policy.current().default
+    if 0 <= login_hour < 24:
+        return pol.hour_table[login_hour]
+    return pol.hour_risk(login_hour)
 
 
 def calc_device_risk(device: str, known: List[str]) -> Tuple[float, str]:
@@ -74,22 +64,33 @@ def calc_device_risk(device: str, known: List[str]) -> Tuple[float, str]:
     return 80.0, f"Unknown device '{device[:40]}' not in {len(known)} registered devices"
 
 
-def calc_ip_risk(ip: str, known: List[str]) -> Tuple[float, str]:
-    if not known:
+def calc_ip_risk(ip: str, known) -> Tuple[float, str]:
+    code = ip_trie.classify(ip, known)
+    if code == ip_trie.IP_TRUSTED:
+        return 0.0, f"IP {ip} inside trusted network {ip_trie.trusted_network(ip)}"
+    if code == ip_trie.IP_NO_HISTORY:
         return 10.0, "First session — establishing IP baseline"
-    if ip in known:
+    if code == ip_trie.IP_KNOWN:
         return 0.0, "Known IP address"
-    parts = ip.split(".")
-    for k in known:
-        kp = k.split(".")
-        if parts[:2] == kp[:2]:
-            return 30.0, f"IP {ip} same subnet but different host"
+    if code == ip_trie.IP_SAME_SUBNET:
+        return 30.0, f"IP {ip} same subnet but different host"
     return 85.0, f"IP {ip} from completely unknown network"
 
 
-def calc_download_spike(current: int, avg: float) -> Tuple[float, str]:
+def calc_download_spike(current: int, avg: float, pol=None,
+                        quantiles: Tuple[float, float] = None) -> Tuple[float, str]:
+    pol = pol or policy.current().default
+    if quantiles is not None:
+        # Never stricter than the no-baseline rule: all-zero histories give p95 = p99 = 0
+        p95, p99 = max(quantiles[0], pol.max_downloads), max(quantiles[1], pol.max_downloads)
+        r = sketches.exceedance(current, p95, p99)
+        if r == 0:
+            return 0.0, f"{current} downloads within normal range (p95 {p95:.0f})"
+        if current <= p99:
+            return r, f"{current} downloads — above p95 {p95:.0f}"
+        return r, f"{current} downloads — above p99 {p99:.0f} — SPIKE DETECTED"
     if avg == 0:
-        if current > MAX_NORMAL_DOWNLOADS:
+        if current > pol.max_downloads:
             return 70.0, f"{current} downloads with no baseline — suspicious"
         return 0.0, "Download activity normal"
     ratio = current / max(avg, 1)
@@ -102,24 +103,33 @@ def calc_download_spike(current: int, avg: float) -> Tuple[float, str]:
     return r, f"{current} downloads — {ratio:.1f}x above avg — SPIKE DETECTED"
 
 
-def calc_behavioral_anomaly(session: dict, profile: dict) -> Tuple[float, str]:
+def calc_behavioral_anomaly(session: dict, profile: dict, pol=None) -> Tuple[float, str]:
+    pol = pol or policy.current().default
     factors = []
     total = 0.0
 
     actions = session.get("action_count", 0)
     avg_a = profile.get("avg_actions", 20)
     std_a = profile.get("std_actions", 10)
-    if std_a > 0 and actions > avg_a + 2 * std_a:
+    q = profile.get("q_actions")
+    if q is not None and q[1] > q[0]:
+        r = sketches.exceedance(actions, q[0], q[1])
+        if r > 0:
+            total += r * 0.4
+            factors.append(f"Action count {actions} above p{99 if actions > q[1] else 95} "
+                           f"({q[1] if actions > q[1] else q[0]:.0f})")
+    elif std_a > 0 and actions > avg_a + 2 * std_a:   # also when p95 == p99: no spread to score against
         z = (actions - avg_a) / std_a
         r = min(100, z * 20)
         total += r * 0.4
         factors.append(f"Action count {actions} is {z:.1f}σ above normal ({avg_a:.0f})")
 
     sw = session.get("service_switches", 0)
-    if sw > MAX_NORMAL_SERVICE_SWITCHES:
-        r = min(100, (sw / MAX_NORMAL_SERVICE_SWITCHES) * 40)
+    limit = max(pol.max_switches, profile.get("avg_switches", 0) + 2 * profile.get("std_switches", 0))
+    if sw > limit:
+        r = min(100, (sw / limit) * 40)
         total += r * 0.3
-        factors.append(f"Service switching {sw} exceeds limit ({MAX_NORMAL_SERVICE_SWITCHES})")
+        factors.append(f"Service switching {sw} exceeds limit ({limit:.0f})")
 
     dur = session.get("duration_minutes", 0)
     avg_d = profile.get("avg_session_duration", 30)
@@ -149,23 +159,41 @@ def calc_unauthorized_service(accessed: List[str], allowed: List[str]) -> Tuple[
     return risk, f"Unauthorised access to: {', '.join(unauthorized)}"
 
 
-def calc_login_attempt_risk(count: int) -> Tuple[float, str]:
+def calc_login_attempt_risk(count: int, source_failures: int = 0) -> Tuple[float, str]:
+    """`count` attempts on this account; `source_failures` recent failures from its IP on other accounts."""
+    spray = throttle.spray_risk(source_failures)
     if count <= 1:
-        return 0.0, "Successful login on first attempt"
-    if count == 2:
-        return 40.0, "Successful login after 1 failed attempt"
-    risk = min(100, 40 + (count - 2) * 25)
-    return risk, f"Successful login after {count-1} failed attempts — possible brute-force"
+        risk, why = 0.0, "Successful login on first attempt"
+    elif count == 2:
+        risk, why = 40.0, "Successful login after 1 failed attempt"
+    else:
+        risk = min(100, 40 + (count - 2) * 25)
+        why = f"Successful login after {count-1} failed attempts — possible brute-force"
+    if spray > risk:
+        return spray, f"{source_failures} failed logins against other accounts from this IP — possible password spray"
+    return risk, why
+
+
+def calc_shared_infrastructure(ip: str, user_id: str) -> Tuple[float, str]:
+    """Fan-in: distinct accounts seen on this session's IP in the sliding window."""
+    return shared_infra.risk(shared_infra.fan_in(user_id, ip))
+
+
+def calc_impossible_travel(user_id: str, session_id: str, ip: str, start) -> Tuple[float, str]:
+    """Speed needed to get from the previous login's GeoIP location to this one."""
+    return geoip.risk(*geoip.travel(user_id, session_id, ip, start))
 
 
 # ─── Composite Score ─────────────────────────────────────────────────
 
-def composite_risk(components: Dict[str, Tuple[float, str]]) -> dict:
+def composite_risk(components: Dict[str, Tuple[float, str]], pol=None) -> dict:
+    pol = pol or policy.current().default
+    weights = pol.weight_map
     breakdown = []
     weighted_sum = 0.0
 
     for name, (raw, explanation) in components.items():
-        w = RISK_WEIGHTS.get(name, 0.1)
+        w = weights.get(name, 0.1)
         wr = raw * w
         weighted_sum += wr
         status = "normal" if raw < 30 else "warning" if raw < 60 else "critical"
@@ -190,10 +218,10 @@ def composite_risk(components: Dict[str, Tuple[float, str]]) -> dict:
 
     score = min(100, weighted_sum * mult)
 
-    if score <= 30:
+    if score <= pol.allow:
         decision = "ALLOW"
         detail = "Access granted — risk within acceptable limits"
-    elif score <= 60:
+    elif score <= pol.re_authenticate:
         decision = "RE_AUTHENTICATE"
         detail = "Elevated risk — re-authentication required"
     else:
@@ -208,118 +236,126 @@ def composite_risk(components: Dict[str, Tuple[float, str]]) -> dict:
         "breakdown": breakdown,
         "critical_factors": crits,
         "warning_factors": warns,
+        "policy": pol.name,
         "timestamp": datetime.utcnow().isoformat(),
     }
 
 
 # ─── Profile Builder ─────────────────────────────────────────────────
 
-def build_user_profile(user_id: str) -> dict:
-    db = get_db_connection()
-    sessions = list(db["session_behavior"].find({"user_id": user_id}))
-    if not sessions:
-        return {
-            "avg_actions": 20, "std_actions": 10,
-            "avg_downloads": 5, "avg_session_duration": 30,
-        }
-
-    def mean(lst):
-        return sum(lst) / len(lst) if lst else 0
-
-    def std(lst):
-        if len(lst) < 2:
-            return 10
-        m = mean(lst)
-        return max(1, math.sqrt(sum((x - m) ** 2 for x in lst) / len(lst)))
-
-    ac = [s.get("action_count", 0) for s in sessions]
-    dl = [s.get("download_count", 0) for s in sessions]
-    du = [s.get("duration_minutes", 0) for s in sessions]
-
-    return {
-        "avg_actions": mean(ac) or 20,
-        "std_actions": std(ac),
-        "avg_downloads": mean(dl) or 5,
-        "avg_session_duration": mean(du) or 30,
-        "total_sessions": len(sessions),
-    }
+def build_user_profile(user_id: str, role: str = None, app_ids=()) -> dict:
+    """Decayed (EWMA / EWMV) baseline blended with the peer cohort's, plus p95 / p99 sketch thresholds."""
+    profile = cohort.user_profile(user_id, role, app_ids)
+    q = sketches.thresholds(user_id, profile)
+    profile["q_actions"] = q["action_count"]
+    profile["q_downloads"] = q["download_count"]
+    return profile
 
 
 # ─── Main Evaluation Entry Point ─────────────────────────────────────
 
+@tracing.traced("evaluate_session_risk")
 async def evaluate_session_risk(user_id: str, session_id: str) -> dict:
     """Full risk evaluation — called on login and continuously during session."""
     db = get_db_connection()
-    user = db["users"].find_one({"_id": user_id})
-    if not user:
-        return {"error": "User not found", "score": 100}
-    session = db["sessions"].find_one({"session_id": session_id})
-    if not session:
-        return {"error": "Session not found", "score": 100}
-
-    profile = build_user_profile(user_id)
-    sb = db["session_behavior"].find_one({"session_id": session_id}) or {}
-
-    # Known devices / IPs from historical sessions
-    past = list(db["sessions"].find({"user_id": user_id}))
-    known_devs = list({s.get("device_fingerprint", "") for s in past if s.get("session_id") != session_id} - {""})
-    known_ips = list({s.get("ip_address", "") for s in past if s.get("session_id") != session_id} - {""})
-
-    # Allowed services
-    creds = list(db["user_credentials"].find({"user_id": user_id}))
-    allowed_services = []
-    for c in creds:
-        app = db["apps"].find_one({"_id": c.get("app_id")})
-        if app:
-            allowed_services.append(app.get("name", c.get("app_id")))
+    version = risk_cache.token(user_id, session_id)
+    with tracing.span("load"):
+        user = db["users"].find_one({"_id": user_id})
+        if not user:
+            return {"error": "User not found", "score": 100}
+        session = db["sessions"].find_one({"session_id": session_id})
+        if not session:
+            return {"error": "Session not found", "score": 100}
+        sb = db["session_behavior"].find_one({"session_id": session_id}) or {}
+        pol = policy.current().select(user.get("role"), session.get("app_id"))
+
+    # Known devices / IPs and allowed services from the cached risk context
+    with tracing.span("risk_context"):
+        ctx = risk_context.get(user_id)
+        known_devs = ctx.known_devices(session_id)
+        known_ips = ctx.known_ips(session_id)
+        allowed_services = ctx.allowed_services()
+    with tracing.span("build_user_profile"):
+        profile = build_user_profile(user_id, user.get("role"), ctx.credentials.values())
 
     login_time = session.get("start_time", datetime.utcnow())
     hour = login_time.hour if isinstance(login_time, datetime) else 12
 
-    components = {
-        "time_deviation":       calc_time_deviation(hour),
-        "device_mismatch":      calc_device_risk(session.get("device_fingerprint", "unknown"), known_devs),
-        "ip_location":          calc_ip_risk(session.get("ip_address", "0.0.0.0"), known_ips),
-        "behavioral_anomaly":   calc_behavioral_anomaly(sb, profile),
-        "download_spike":       calc_download_spike(sb.get("download_count", 0), profile.get("avg_downloads", 5)),
-        "unauthorized_service": calc_unauthorized_service(sb.get("accessed_services", []), allowed_services or ["*"]),
-        "login_attempts":       calc_login_attempt_risk(session.get("login_attempt_count", 1)),
-    }
+    with tracing.span("components"):
+        components = {
+            "time_deviation":       calc_time_deviation(hour, pol),
+            "device_mismatch":      calc_device_risk(session.get("device_fingerprint", "unknown"), known_devs),
+            "ip_location":          calc_ip_risk(session.get("ip_address", "0.0.0.0"), known_ips),
+            "behavioral_anomaly":   calc_behavioral_anomaly(sb, profile, pol),
+            "download_spike":       calc_download_spike(sb.get("download_count", 0), profile.get("avg_downloads", 5),
+                                                        pol, profile.get("q_downloads")),
+            "unauthorized_service": calc_unauthorized_service(sb.get("accessed_services", []), allowed_services or ["*"]),
+            "login_attempts":       calc_login_attempt_risk(session.get("login_attempt_count", 1),
+                                                          session.get("source_failed_logins", 0)),
+            "shared_infrastructure": calc_shared_infrastructure(session.get("ip_address", "0.0.0.0"), user_id),
+            "impossible_travel":    calc_impossible_travel(user_id, session_id, session.get("ip_address"),
+                                                           session.get("start_time")),
+        }
 
-    result = composite_risk(components)
-
-    # Persist snapshot
-    old = user.get("risk_score", 0)
-    new = result["score"] / 100.0
-    db["risk_score_history"].insert_one({
-        "user_id": user_id, "session_id": session_id,
-        "old_score": old, "new_score": new,
-        "delta": round(new - old, 4),
-        "factors": result["breakdown"],
-        "timestamp": datetime.utcnow(),
-        "triggered_by": "session_evaluation",
-    })
-    db["users"].update_one({"_id": user_id}, {"$set": {"risk_score": new, "last_risk_recalc": datetime.utcnow()}})
+    with tracing.span("composite_risk"):
+        result = composite_risk(components, pol)
+
+    # Persist snapshot (only when score or decision moved; see risk_timeseries)
+    with tracing.span("persist"):
+        old = user.get("risk_score", 0)
+        new = result["score"] / 100.0
+        risk_timeseries.record({
+            "user_id": user_id, "session_id": session_id,
+            "old_score": old, "new_score": new,
+            "delta": round(new - old, 4),
+            "factors": result["breakdown"],
+            "timestamp": datetime.utcnow(),
+            "triggered_by": "session_evaluation",
+        }, result["decision"])
+        db["users"].update_one({"_id": user_id}, {"$set": {"risk_score": new, "last_risk_recalc": datetime.utcnow()}})
 
     # Adaptive access control
-    if result["decision"] == "BLOCK":
-        db["sessions"].update_one({"session_id": session_id}, {"$set": {"revoked": True, "revoke_reason": "High risk"}})
-        db["users"].update_one({"_id": user_id}, {"$set": {"access_level": "blocked"}})
-        await create_incident(user_id, "critical", "high_risk_session", result["decision_detail"], result["breakdown"])
-        await create_alert(user_id, "critical", f"Session blocked — Risk {result['score']}/100", result)
-    elif result["decision"] == "RE_AUTHENTICATE":
-        db["users"].update_one({"_id": user_id}, {"$set": {"access_level": "restricted"}})
-        await create_alert(user_id, "high", f"Re-auth required — Risk {result['score']}/100", result)
-    else:
-        if user.get("access_level") == "restricted":
-            db["users"].update_one({"_id": user_id}, {"$set": {"access_level": "full"}})
-
+    with tracing.span("access_control"):
+        if result["decision"] == "BLOCK":
+            db["sessions"].update_one({"session_id": session_id}, {"$set": {"revoked": True, "revoke_reason": "High risk"}})
+            db["users"].update_one({"_id": user_id}, {"$set": {"access_level": "blocked"}})
+            await create_incident(user_id, "critical", "high_risk_session", result["decision_detail"], result["breakdown"],
+                                  source=session)
+            await create_alert(user_id, "critical", f"Session blocked — Risk {result['score']}/100", result,
+                               reason="session_blocked", source=session)
+        elif result["decision"] == "RE_AUTHENTICATE":
+            db["users"].update_one({"_id": user_id}, {"$set": {"access_level": "restricted"}})
+            await create_alert(user_id, "high", f"Re-auth required — Risk {result['score']}/100", result,
+                               reason="re_authentication_required", source=session)
+        else:
+            if user.get("access_level") == "restricted":
+                db["users"].update_one({"_id": user_id}, {"$set": {"access_level": "full"}})
+
+    # A revoked session is never scored again; caching it would only leak the entry
+    if result["decision"] != "BLOCK" and not session.get("revoked"):
+        risk_cache.store(session_id, version, result)
     return result
 
 
+async def get_session_risk(user_id: str, session_id: str) -> dict:
+    """Read path: the cached result while the session's inputs are unchanged, else a fresh evaluation."""
+    cached = risk_cache.lookup(user_id, session_id)
+    if cached is not None:
+        return cached
+    return await evaluate_session_risk(user_id, session_id)
+
+
 # ─── Incident & Alert Helpers ─────────────────────────────────────────
 
-async def create_incident(user_id, risk_level, incident_type, description, evidence=None):
+def source_fields(source) -> dict:
+    """Session / IP / device of the session that raised an incident or alert (for correlation)."""
+    if not source:
+        return {}
+    return {"session_id": source.get("session_id"), "ip_address": source.get("ip_address"),
+            "device_fingerprint": source.get("device_fingerprint")}
+
+
+async def create_incident(user_id, risk_level, incident_type, description, evidence=None, source=None):
     db = get_db_connection()
     ai_text = _explain(incident_type, evidence or [])
     doc = {
@@ -329,36 +365,26 @@ async def create_incident(user_id, risk_level, incident_type, description, evide
         "timestamp": datetime.utcnow(),
         "action_taken": "auto_blocked" if risk_level == "critical" else "flagged",
         "resolved": False,
+        **source_fields(source),
     }
     r = db["incidents"].insert_one(doc)
     doc["id"] = str(r.inserted_id)
     return doc
 
 
-async def create_alert(user_id, severity, description, details=None):
+async def create_alert(user_id, severity, description, details=None, reason=None, source=None):
+    """Open (or merge into) the alert for (user, severity, reason) and queue an admin digest."""
     db = get_db_connection()
-    user = db["users"].find_one({"_id": user_id})
-    user_name = user.get("name", user_id) if user else user_id
-    
-    doc = {
-        "user_id": user_id, "severity": severity,
-        "status": "open", "description": description,
-        "details": details or {}, "timestamp": datetime.utcnow(),
-        "acknowledged": False,
-    }
-    db["alerts"].insert_one(doc)
-
-    # Notify administrators for High/Critical risks
-    if severity in ["high", "critical"]:
-        admins = list(db["users"].find({"role": "admin"}))
-        admin_emails = [a["email"] for a in admins if a.get("email")]
-        if admin_emails:
-            send_security_alert(
-                admin_emails=admin_emails,
-                target_user=user_name,
-                risk_score=details.get("score", 100) if details else 100,
-                details=description
-            )
+    doc, _ = alert_aggregator.record(user_id, severity, description, details, reason, source_fields(source))
+
+    # Notify administrators for High/Critical risks (rate-limited digests)
+    if severity in alert_aggregator.NOTIFY_SEVERITIES:
+        user = db["users"].find_one({"_id": user_id})
+        user_name = user.get("name", user_id) if user else user_id
+        alert_aggregator.queue(user_id, user_name, severity, description,
+                               details.get("score", 100) if details else 100, reason)
+        with tracing.span("alert_email"):
+            await alert_aggregator.flush()
     return doc
 
 
@@ -386,53 +412,9 @@ def _explain(incident_type, evidence):
 # ─── Dashboard Metrics ────────────────────────────────────────────────
 
 async def calculate_all_risks() -> dict:
-    db = get_db_connection()
-    users = list(db["users"].find({}))
-    sessions = list(db["sessions"].find({"revoked": False}))
-    alerts = list(db["alerts"].find({}))
-    incidents = list(db["incidents"].find({}))
-    audit = list(db["audit_trail"].find({"action": {"$in": ["mark_safe", "unblock", "dismiss_alert", "resolve_incident"]}}))
-    resolved_count = len(audit)
-
-    scores = [u.get("risk_score", 0) for u in users]
-    critical = sum(1 for s in scores if s > 0.6)
-    blocked = sum(1 for u in users if u.get("access_level") == "blocked" or not u.get("is_active", True))
-
-    cutoff = datetime.utcnow() - timedelta(minutes=30)
-    active = [s for s in sessions if isinstance(s.get("last_activity"), datetime) and s["last_activity"] >= cutoff]
-    suspicious = sum(1 for s in sessions if s.get("risk_at_login", 0) >= 0.3)
-
-    day_ago = datetime.utcnow() - timedelta(hours=24)
-    recent_alerts = sum(1 for a in alerts if isinstance(a.get("timestamp"), datetime) and a["timestamp"] >= day_ago)
-    recent_incidents = sum(1 for i in incidents if isinstance(i.get("timestamp"), datetime) and i["timestamp"] >= day_ago)
-    attacks = sum(1 for i in incidents if i.get("incident_type") in ("simulated_attack", "high_risk_session"))
-
-    top = sorted(users, key=lambda u: u.get("risk_score", 0), reverse=True)[:5]
-    top_fmt = []
-    for u in top:
-        s = u.get("risk_score", 0)
-        top_fmt.append({
-            "user_id": str(u["_id"]),
-            "email": u.get("email", ""),
-            "name": u.get("name", ""),
-            "role": u.get("role", "user"),
-            "risk_score": s,
-            "risk_level": get_risk_level(s * 100),
-            "access_level": u.get("access_level", "full"),
-        })
-
-    avg = sum(scores) / len(scores) if scores else 0
-
-    return {
-        "total_users": len(users),
-        "active_users": len(active),
-        "critical_risks": critical,
-        "suspicious_sessions": suspicious,
-        "blocked_accounts": blocked,
-        "recent_alerts": recent_alerts,
-        "incidents_24h": recent_incidents,
-        "avg_risk_score": round(avg, 4),
-        "attack_attempts": attacks,
-        "resolved_by_admin": resolved_count,
-        "top_risks": top_fmt,
-    }
+    """Dashboard counters, maintained incrementally from writes (see dashboard_metrics)."""
+    metrics = dashboard_metrics.snapshot()
+    metrics["top_risks"] = [
+        dict(u, risk_level=get_risk_level(u["risk_score"] * 100)) for u in risk_index.top(5)
+    ]
+    return metrics
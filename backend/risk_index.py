@@ -0,0 +1,115 @@
+"""
+Risk Score Index
+================
+Users ordered by `risk_score`, kept current from a db.watch hook on
+`users`, so every path that changes a score (evaluate_session_risk, the
+batch sweep's bulk_set, admin mark-safe / unblock) updates it in
+O(log n) without callers doing anything.
+
+The index is a SortedList of (-risk_score, seq, user_id); `seq` is the
+order in which a user was first seen, so equal scores keep store order as
+the old full sort did.  With positional indexing and bisection:
+
+  - top(k)                             O(log n + k)
+  - above(threshold, offset, limit)    O(log n + limit), plus the total
+                                       count above the threshold
+
+Each entry carries the few display fields the dashboard needs, so reads
+never go back to the users collection.
+"""
+
+import threading
+
+from sortedcontainers import SortedList
+
+import db
+
+_lock = threading.Lock()
+_order = SortedList()
+_entries = {}     # user_id -> ((-score, seq, user_id), display fields)
+_seq = 0
+
+
+def _row(doc):
+    return {
+        "user_id": str(doc.get("_id")),
+        "email": doc.get("email", ""),
+        "name": doc.get("name", ""),
+        "role": doc.get("role", "user"),
+        "risk_score": doc.get("risk_score", 0),
+        "access_level": doc.get("access_level", "full"),
+    }
+
+
+def _put(doc):
+    global _seq
+    uid = doc.get("_id")
+    old = _entries.get(uid)
+    score = doc.get("risk_score", 0) or 0
+    if old is not None:
+        if old[0][0] == -score:
+            _entries[uid] = (old[0], _row(doc))
+            return
+        _order.remove(old[0])
+        seq = old[0][1]
+    else:
+        seq = _seq
+        _seq += 1
+    key = (-score, seq, uid)
+    _order.add(key)
+    _entries[uid] = (key, _row(doc))
+
+
+def _drop(uid):
+    old = _entries.pop(uid, None)
+    if old is not None:
+        _order.remove(old[0])
+
+
+def _on_user_write(before, after):
+    with _lock:
+        if after is None:
+            _drop(before.get("_id"))
+        else:
+            _put(after)
+
+
+def rebuild():
+    global _seq
+    rows = db.get_db_connection()["users"].find_fields(
+        {}, ("_id", "email", "name", "role", "risk_score", "access_level"))
+    with _lock:
+        _order.clear()
+        _entries.clear()
+        _seq = 0
+        for uid, email, name, role, score, access in rows:
+            doc = {"_id": uid, "email": email, "name": name, "role": role, "risk_score": score, "access_level": access}
+            _put({k: v for k, v in doc.items() if v is not None})
+
+
+# ─── Queries ─────────────────────────────────────────────────────────
+
+def top(k: int) -> list:
+    """The k highest-risk users, highest first."""
+    with _lock:
+        return [_entries[key[2]][1] for key in _order.islice(0, k)]
+
+
+def above(threshold: float, offset: int = 0, limit: int = 50) -> dict:
+    """One page of users with risk_score >= threshold, highest first, plus the total."""
+    with _lock:
+        # Keys sort by -score, so everything before the first key > -threshold qualifies
+        total = _order.bisect_left((-threshold, float("inf"), ""))
+        page = [_entries[key[2]][1] for key in _order.islice(offset, min(offset + limit, total))]
+    return {"threshold": threshold, "total": total, "offset": offset, "limit": limit, "users": page}
+
+
+def _memory_report():
+    with _lock:
+        return {"entries": len(_entries), "approx_bytes": len(_entries) * 420}
+
+
+db.watch("users", _on_user_write)
+db.on_reset(rebuild)
+db.register_index("risk_index", _memory_report)
+rebuild()
@@ -0,0 +1,206 @@
+"""
+Risk Score Time Series
+======================
+Keeps `risk_score_history` proportional to meaningful change instead of to
+request volume, and keeps charting cheap:
+
+  - observe() decides whether an evaluation is worth a history row: only
+    when the score moved more than RISK_HISTORY_EPSILON points (0-100 scale)
+    or the decision changed since the last row written for that session.
+  - Every evaluation, written or not, lands in per-user rollups: hourly and
+    daily buckets holding min / max / sum / count, each tier with its own
+    retention (RISK_ROLLUP_HOURLY_DAYS, RISK_ROLLUP_DAILY_DAYS).
+  - lttb() downsamples a series to a fixed number of points for charts
+    (Largest-Triangle-Three-Buckets).
+
+Rows that are written reach the rollups through a db.watch hook on
+`risk_score_history` (so seeded and demo rows count too); skipped samples
+are folded in by observe() directly.  rebuild() recomputes the rollups from
+the stored history after a snapshot load.
+"""
+
+import os
+import threading
+from datetime import datetime, timedelta
+
+import db
+
+RISK_HISTORY_EPSILON = float(os.getenv("RISK_HISTORY_EPSILON", "2"))
+RISK_ROLLUP_HOURLY_DAYS = int(os.getenv("RISK_ROLLUP_HOURLY_DAYS", "30"))
+RISK_ROLLUP_DAILY_DAYS = int(os.getenv("RISK_ROLLUP_DAILY_DAYS", "730"))
+
+TIERS = {
+    "hour": (timedelta(hours=1), RISK_ROLLUP_HOURLY_DAYS),
+    "day":  (timedelta(days=1), RISK_ROLLUP_DAILY_DAYS),
+}
+
+_lock = threading.Lock()
+_rollups: dict = {}        # user_id -> {tier: {bucket_start: [min, max, sum, count]}}
+_last_written: dict = {}   # (user_id, session_id) -> (score 0-100, decision)
+
+
+def _bucket(ts, tier):
+    if tier == "hour":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _fold(user_id, ts, score):
+    tiers = _rollups.setdefault(user_id, {t: {} for t in TIERS})
+    for tier, (_, keep_days) in TIERS.items():
+        buckets = tiers[tier]
+        key = _bucket(ts, tier)
+        b = buckets.get(key)
+        if b is None:
+            buckets[key] = [score, score, score, 1]
+            cutoff = key - timedelta(days=keep_days)
+            for old in [k for k in buckets if k < cutoff]:
+                del buckets[old]
+        else:
+            if score < b[0]:
+                b[0] = score
+            if score > b[1]:
+                b[1] = score
+            b[2] += score
+            b[3] += 1
+
+
+# ─── Write Coalescing ────────────────────────────────────────────────
+
+def observe(doc: dict, decision: str) -> bool:
+    """True if this history row should be written; folds skipped samples into the rollups."""
+    score = doc.get("new_score", 0) * 100
+    key = (doc.get("user_id"), doc.get("session_id"))
+    with _lock:
+        last = _last_written.get(key)
+        if last is not None and last[1] == decision and abs(score - last[0]) <= RISK_HISTORY_EPSILON:
+            ts = doc.get("timestamp")
+            if isinstance(ts, datetime):
+                _fold(key[0], ts, score)
+            return False
+        _last_written[key] = (score, decision)
+        return True
+
+
+def record(doc: dict, decision: str) -> bool:
+    """Insert a history row if it passes observe(); returns whether it was written."""
+    doc["decision"] = decision
+    if not observe(doc, decision):
+        return False
+    db.get_db_connection()["risk_score_history"].insert_one(doc)
+    return True
+
+
+# ─── Rollup Queries ──────────────────────────────────────────────────
+
+def rollup(user_id: str, tier: str = "hour", since: datetime = None) -> list:
+    """[(bucket_start, min, max, avg, count)] in time order."""
+    with _lock:
+        buckets = dict(_rollups.get(user_id, {}).get(tier, {}))
+    return [
+        (k, b[0], b[1], b[2] / b[3], b[3])
+        for k, b in sorted(buckets.items())
+        if since is None or k >= since
+    ]
+
+
+def lttb(points: list, threshold: int) -> list:
+    """Largest-Triangle-Three-Buckets downsampling of [(x, y), ...] sorted by x."""
+    n = len(points)
+    if threshold >= n or threshold < 3:
+        return list(points)
+    out = [points[0]]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        lo = int(i * every) + 1
+        hi = int((i + 1) * every) + 1
+        nxt_hi = min(int((i + 2) * every) + 1, n)
+        nxt = points[hi:nxt_hi] or [points[-1]]
+        avg_x = sum(p[0] for p in nxt) / len(nxt)
+        avg_y = sum(p[1] for p in nxt) / len(nxt)
+        ax, ay = points[a]
+        best, best_area = lo, -1.0
+        for j in range(lo, hi):
+            x, y = points[j]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        out.append(points[best])
+        a = best
+    out.append(points[-1])
+    return out
+
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def chart(user_id: str, tier: str, since: datetime, points: int) -> dict:
+    """Series for charting: raw history rows or rollup averages, LTTB-downsampled."""
+    extra = {}
+    if tier == "raw":
+        rows = db.get_db_connection()["risk_score_history"].find_fields(
+            {"user_id": user_id, "timestamp": {"$gte": since}}, ("timestamp", "new_score"))
+        series = sorted(((ts - _EPOCH).total_seconds(), (s or 0) * 100)
+                        for ts, s in rows if isinstance(ts, datetime))
+    else:
+        series = []
+        for start, lo, hi, avg, count in rollup(user_id, tier, since):
+            x = (start - _EPOCH).total_seconds()
+            series.append((x, avg))
+            extra[x] = {"min": round(lo, 1), "max": round(hi, 1), "count": count}
+    sampled = lttb(series, max(3, points))
+    return {
+        "tier": tier, "total_points": len(series),
+        "points": [
+            dict({"timestamp": _EPOCH + timedelta(seconds=x), "score": round(y, 1)}, **extra.get(x, {}))
+            for x, y in sampled
+        ],
+    }
+
+
+def rebuild():
+    """Recompute rollups from stored history (after snapshot loads)."""
+    rows = db.get_db_connection()["risk_score_history"].find_fields(
+        {}, ("user_id", "session_id", "new_score", "timestamp", "decision"))
+    rows.sort(key=lambda r: r[3] if isinstance(r[3], datetime) else datetime.min)
+    live = {sid for (sid,) in db.get_db_connection()["sessions"].find_fields({"revoked": False}, ("session_id",))}
+    with _lock:
+        _rollups.clear()
+        _last_written.clear()
+        for uid, sid, score, ts, decision in rows:
+            if uid is None or not isinstance(ts, datetime):
+                continue
+            _fold(uid, ts, (score or 0) * 100)
+            if sid in live:
+                _last_written[(uid, sid)] = ((score or 0) * 100, decision)
+    return len(rows)
+
+
+# ─── Write Hooks ─────────────────────────────────────────────────────
+
+def _on_history_write(before, after):
+    if before is None and after is not None and after.get("user_id") is not None \
+            and isinstance(after.get("timestamp"), datetime):
+        with _lock:
+            _fold(after.get("user_id"), after["timestamp"], (after.get("new_score") or 0) * 100)
+
+
+def _on_session_write(before, after):
+    if after is None or after.get("revoked"):
+        doc = after or before
+        with _lock:
+            _last_written.pop((doc.get("user_id"), doc.get("session_id")), None)
+
+
+def _memory_report():
+    with _lock:
+        buckets = sum(len(b) for tiers in _rollups.values() for b in tiers.values())
+        sessions = len(_last_written)
+    return {"entries": buckets, "approx_bytes": buckets * 180 + sessions * 150}
+
+
+db.watch("risk_score_history", _on_history_write)
+db.watch("sessions", _on_session_write)
+db.on_reset(rebuild)
+db.register_index("risk_rollups", _memory_report)
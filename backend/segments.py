@@ -0,0 +1,146 @@
+"""
+On-Disk Cold Segments for the In-Memory Database
+=================================================
+Time-ranged slices of log collections that were spilled out of the hot
+store to keep the process under its memory budget.  Each segment is one
+file of individually pickled records, ordered by time and mapped read-only
+with mmap.  Only the record offsets and timestamps stay in memory, so a
+query that bounds the timestamp decodes (and the OS pages in) just the
+records inside its range.
+
+Every cold segment type (see also archive.ArchiveBlock) exposes the same
+small interface to db.py: `may_match(query)`, `docs(query)`, `count`,
+`nbytes`, `stats()` and `drop()`.
+
+may_match() prunes on two zone maps kept in memory per segment: the
+timestamp range and a UserFilter (Bloom filter) over the segment's
+user_ids.  A cold read is therefore cheap only for queries that bound the
+timestamp or name user_id (equality or $in); anything else — an unfiltered
+count_documents with a query, an aggregate whose first stage does not
+$match on those fields — still unpickles every record under db's lock.
+"""
+
+import bisect
+import hashlib
+import mmap
+import os
+import pickle
+import uuid
+from datetime import datetime
+
+
+def time_bounds(query, field):
+    """Extract the [lo, hi] datetime range a query places on `field`."""
+    if not query or field not in query:
+        return None, None
+    val = query[field]
+    if not isinstance(val, dict):
+        return (val, val) if isinstance(val, datetime) else (None, None)
+    lo = val.get("$gte", val.get("$gt"))
+    hi = val.get("$lte", val.get("$lt"))
+    return (lo if isinstance(lo, datetime) else None,
+            hi if isinstance(hi, datetime) else None)
+
+
+class UserFilter:
+    """Bloom filter over a segment's user_ids: ~1% false positives at 10 bits per user."""
+
+    __slots__ = ("_bits", "_m")
+    BITS_PER_USER = 10
+    HASHES = 7
+
+    def __init__(self, users):
+        users = {str(u) for u in users if u is not None}
+        self._m = max(64, len(users) * self.BITS_PER_USER)
+        self._bits = bytearray((self._m + 7) // 8)
+        for u in users:
+            for p in self._positions(u):
+                self._bits[p >> 3] |= 1 << (p & 7)
+
+    def _positions(self, user):
+        h = hashlib.blake2b(user.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(h[:8], "little"), int.from_bytes(h[8:], "little") | 1
+        return ((h1 + i * h2) % self._m for i in range(self.HASHES))
+
+    def may_contain(self, user):
+        return all(self._bits[p >> 3] & (1 << (p & 7)) for p in self._positions(str(user)))
+
+    def may_match(self, query):
+        """False only when the query's user_id (equality or $in) cannot be in the segment."""
+        if not query or "user_id" not in query:
+            return True
+        val = query["user_id"]
+        if isinstance(val, dict):
+            wanted = val.get("$in")
+            if isinstance(wanted, (list, tuple, set, frozenset)):
+                return any(self.may_contain(u) for u in wanted if u is not None)
+            return True
+        return val is not None and self.may_contain(val)
+
+    @property
+    def nbytes(self):
+        return len(self._bits)
+
+
+class SpillSegment:
+    def __init__(self, path, collection, field, times, offsets, users=None):
+        self.path = path
+        self.collection = collection
+        self.field = field
+        self.t_min = times[0]
+        self.t_max = times[-1]
+        self.count = len(times)
+        self.nbytes = offsets[-1]
+        self.users = users
+        self._times = times        # record i has `field` == times[i] and spans offsets[i]:offsets[i + 1]
+        self._offsets = offsets
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def write(cls, directory, collection, field, docs):
+        """Persist `docs` (already ordered by `field`) as a new segment."""
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{collection}-{docs[0][field]:%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}.seg")
+        offsets = [0]
+        try:
+            with open(path, "wb") as f:
+                for d in docs:
+                    offsets.append(offsets[-1] + f.write(pickle.dumps(d, protocol=5)))
+        except Exception:
+            os.remove(path)
+            raise
+        return cls(path, collection, field, [d[field] for d in docs], offsets,
+                   UserFilter(d.get("user_id") for d in docs))
+
+    def overlaps(self, lo, hi):
+        if lo is not None and self.t_max < lo:
+            return False
+        if hi is not None and self.t_min > hi:
+            return False
+        return True
+
+    def may_match(self, query):
+        return self.overlaps(*time_bounds(query, self.field)) and (self.users is None or self.users.may_match(query))
+
+    def docs(self, query=None):
+        """Decode the records whose `field` lies in the query's time bounds (all of them without bounds)."""
+        lo, hi = time_bounds(query, self.field)
+        first = bisect.bisect_left(self._times, lo) if lo is not None else 0
+        last = bisect.bisect_right(self._times, hi) if hi is not None else self.count
+        return [pickle.loads(self._map[self._offsets[i]:self._offsets[i + 1]]) for i in range(first, last)]
+
+    def drop(self):
+        self._map.close()
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def stats(self):
+        return {
+            "t_min": self.t_min.isoformat(), "t_max": self.t_max.isoformat(),
+            "documents": self.count, "disk_bytes": self.nbytes,
+            "user_filter_bytes": self.users.nbytes if self.users is not None else 0,
+        }
@@ -0,0 +1,214 @@
+"""
+Shared Infrastructure Index
+===========================
+Many accounts logging in from one IP address in a short time is the
+signature of credential stuffing or a shared attack box.  Spotting it by
+scanning sessions costs O(sessions) per login; this module keeps an
+inverted index instead:
+
+  - FanIndex maps an IP to the users and sessions seen on it inside a
+    sliding window of SHARED_INFRA_WINDOW_MINUTES, keyed by the session's
+    start_time.  Expiry runs off a heap of (timestamp, key, user, session)
+    events, and an entry is only removed if no later login refreshed it,
+    so memory stays proportional to logins in the window.
+  - fan_in() is one dict lookup: how many distinct users (the evaluated
+    user included) share the session's IP right now.
+  - risk() turns that count into the shared_infrastructure component
+    once it reaches SHARED_IP_MIN_USERS (default 3).
+  - version(ip) changes whenever a login or window expiry moves the IP's
+    user count where the component can change, so risk_cache can key
+    cached scores on it: fan-in moves with *other* accounts' logins and
+    with time, neither of which writes the scored session.
+
+Only IPs are counted.  device_fingerprint is the first 60 characters of
+the User-Agent, which is identical for every Chrome / Edge on Windows, so
+a device fan-in would flag whole offices; it stays out until there is a
+real fingerprint.
+
+Office egress / NAT addresses must be added to the trusted networks
+(TRUSTED_CIDRS or /api/admin/trusted-networks): IPs in trusted networks
+(ip_trie) and placeholder values never count, but with none configured
+every office with SHARED_IP_MIN_USERS people logging in within the window
+scores as shared infrastructure.
+"""
+
+import heapq
+import itertools
+import os
+import threading
+from datetime import datetime
+
+import db
+import ip_trie
+
+SHARED_INFRA_WINDOW_MINUTES = float(os.getenv("SHARED_INFRA_WINDOW_MINUTES", "60"))
+SHARED_IP_MIN_USERS = int(os.getenv("SHARED_IP_MIN_USERS", "3"))
+
+_IGNORED = {None, "", "unknown", "0.0.0.0", "registration"}
+
+_lock = threading.Lock()
+
+
+def _now():
+    # Naive UTC datetimes through .timestamp() (and back with fromtimestamp), like the session start_times
+    return datetime.utcnow().timestamp()
+
+
+class FanIndex:
+    """key -> {user_id: last_seen} and {session_id: seen} over a sliding window."""
+
+    def __init__(self, window_seconds):
+        self.window = window_seconds
+        self.users = {}
+        self.sessions = {}
+        self.versions = {}           # key -> version, moved when its user count can change the risk
+        self._events = []            # heap of (ts, seq, key, user_id, session_id)
+        self._seq = itertools.count()
+        self._clock = itertools.count(1)
+
+    def _moved(self, key, count):
+        # fan_in() is the count, or count + 1 for a user outside it; below the floor risk stays 0
+        if count + 1 >= SHARED_IP_MIN_USERS:
+            self.versions[key] = next(self._clock)
+
+    def add(self, key, user_id, session_id, ts, now):
+        if key in _IGNORED or ts < now - self.window:
+            return
+        users = self.users.setdefault(key, {})
+        if user_id not in users:
+            self._moved(key, len(users) + 1)
+        if users.get(user_id, -1) < ts:
+            users[user_id] = ts
+        self.sessions.setdefault(key, {})[session_id] = ts
+        heapq.heappush(self._events, (ts, next(self._seq), key, user_id, session_id))
+
+    def prune(self, now):
+        cutoff = now - self.window
+        events = self._events
+        while events and events[0][0] < cutoff:
+            ts, _, key, uid, sid = heapq.heappop(events)
+            users = self.users.get(key)
+            if users is not None and users.get(uid) == ts:
+                self._moved(key, len(users))
+                del users[uid]
+                if not users:
+                    # Back to "nobody on this IP", the state an absent version (0) stands for
+                    del self.users[key]
+                    self.versions.pop(key, None)
+            sessions = self.sessions.get(key)
+            if sessions is not None and sessions.get(sid) == ts:
+                del sessions[sid]
+                if not sessions:
+                    del self.sessions[key]
+
+    def fan_in(self, key, user_id):
+        users = self.users.get(key)
+        if not users:
+            return 1
+        return len(users) + (user_id not in users)
+
+    def top(self, n, label):
+        ranked = heapq.nlargest(n, self.users.items(), key=lambda kv: len(kv[1]))
+        return [
+            {label: key, "users": len(users), "sessions": len(self.sessions.get(key, ())),
+             "user_ids": sorted(users, key=users.get, reverse=True)[:20],
+             "last_seen": datetime.fromtimestamp(max(users.values())).isoformat()}
+            for key, users in ranked
+        ]
+
+    def clear(self):
+        self.users.clear()
+        self.sessions.clear()
+        self.versions.clear()
+        self._events.clear()
+
+    def __len__(self):
+        return len(self._events)
+
+
+_ips = FanIndex(SHARED_INFRA_WINDOW_MINUTES * 60)
+
+
+def _login_ts(start, now):
+    return min(start.timestamp(), now) if isinstance(start, datetime) else now
+
+
+def _add(uid, sid, ip, start, now):
+    _ips.add(ip, uid, sid, _login_ts(start, now), now)
+
+
+# ─── Scoring ─────────────────────────────────────────────────────────
+
+def fan_in(user_id, ip):
+    """Distinct users on ip in the window, counting user_id."""
+    if ip in _IGNORED or ip_trie.trusted_network(ip) is not None:
+        return 1
+    now = _now()
+    with _lock:
+        _ips.prune(now)
+        return _ips.fan_in(ip, user_id)
+
+
+def version(ip) -> int:
+    """Changes whenever fan_in() on ip can score differently (0: nobody on it in the window)."""
+    if ip in _IGNORED or ip_trie.trusted_network(ip) is not None:
+        return 0
+    now = _now()
+    with _lock:
+        _ips.prune(now)
+        return _ips.versions.get(ip, 0)
+
+
+def risk(ip_users):
+    """(raw 0-100 risk, explanation) for the shared_infrastructure component."""
+    window = f"{SHARED_INFRA_WINDOW_MINUTES:g} min"
+    if ip_users < SHARED_IP_MIN_USERS:
+        return 0.0, f"IP not shared with other accounts in the last {window}"
+    return (min(100.0, 30.0 + 15.0 * (ip_users - SHARED_IP_MIN_USERS)),
+            f"{ip_users} accounts logged in from this IP in the last {window} — possible credential stuffing")
+
+
+# ─── Index Maintenance ───────────────────────────────────────────────
+
+def _on_session_write(before, after):
+    if before is None and after is not None:
+        with _lock:
+            _add(after.get("user_id"), after.get("session_id"), after.get("ip_address"),
+                 after.get("start_time"), _now())
+
+
+def rebuild():
+    now = _now()
+    rows = db.get_db_connection()["sessions"].find_fields(
+        {}, ("user_id", "session_id", "ip_address", "start_time"))
+    with _lock:
+        _ips.clear()
+        for uid, sid, ip, start in rows:
+            _add(uid, sid, ip, start, now)
+
+
+def top_shared(limit=20) -> dict:
+    """IPs with the most distinct users in the window."""
+    now = _now()
+    with _lock:
+        _ips.prune(now)
+        ips = _ips.top(limit, "ip")
+    for row in ips:
+        row["trusted_network"] = ip_trie.trusted_network(row["ip"])
+    return {
+        "window_minutes": SHARED_INFRA_WINDOW_MINUTES,
+        "ip_min_users": SHARED_IP_MIN_USERS,
+        "ips": ips,
+    }
+
+
+def _memory_report():
+    with _lock:
+        n = len(_ips)
+    return {"entries": n, "approx_bytes": n * 260}
+
+
+db.watch("sessions", _on_session_write)
+db.on_reset(rebuild)
+db.register_index("shared_infra", _memory_report)
+rebuild()
@@ -0,0 +1,246 @@
+"""
+Quantile Sketches
+=================
+Mean / std z-scores are fragile on skewed counts (downloads especially),
+and exact percentiles would need every user's raw history.  Instead each
+user keeps one KLL sketch (Karnin-Lang-Liberty) per behavioral metric:
+bounded memory (about 3 * SKETCH_K values), O(1) amortised updates, rank
+error around 1.7 / SKETCH_K, and sketches merge by concatenating their
+compactor levels.
+
+Sketches are fed from the same place as the decayed baselines: one sample
+per metric when a session closes (baselines.on_fold).  Scoring reads p95 /
+p99 for the cohort cohort.user_profile chose (credential set, then role):
+the cohort's merged sketch (rebuilt at most every
+SKETCH_COHORT_REFRESH_SECONDS, and after every cohort refresh) blended with
+the user's own quantiles by the same n / (n + COHORT_PRIOR_SESSIONS)
+weight as the means.  Without a cohort the user's own p95 / p99 are used
+once they have SKETCH_MIN_SAMPLES sessions, and the mean / std rules
+before that.  exceedance() maps a value
+against (p95, p99) to a 0-100 risk; batch_risk mirrors it column-wise.
+
+Quantiles of a history with no spread are useless as thresholds (a
+cohort that never downloads has p95 = p99 = 0, so one download would score
+100): download quantiles are floored at the policy's max_normal_downloads,
+and action counts fall back to the mean / std rule when p99 <= p95.
+"""
+
+import math
+import os
+import random
+import threading
+import time
+
+import baselines
+import cohort as cohorts
+import db
+
+SKETCH_K = int(os.getenv("SKETCH_K", "64"))
+SKETCH_MIN_SAMPLES = int(os.getenv("SKETCH_MIN_SAMPLES", "10"))
+SKETCH_COHORT_REFRESH_SECONDS = float(os.getenv("SKETCH_COHORT_REFRESH_SECONDS", "300"))
+
+METRICS = baselines.METRICS
+SCORED = ("action_count", "download_count")
+
+_rng = random.Random()
+
+
+class KLLSketch:
+    """KLL quantile sketch over floats; level h items each stand for 2**h samples."""
+
+    __slots__ = ("k", "n", "levels", "size", "max_size")
+
+    def __init__(self, k=None):
+        self.k = k or SKETCH_K
+        self.n = 0
+        self.levels = [[]]
+        self.size = 0
+        self.max_size = self._capacity(0)
+
+    def _capacity(self, h):
+        depth = len(self.levels) - h - 1
+        return max(2, int(math.ceil(self.k * (2 / 3) ** depth)))
+
+    def _grow(self):
+        self.levels.append([])
+        self.max_size = sum(self._capacity(h) for h in range(len(self.levels)))
+
+    def _compress(self):
+        for h in range(len(self.levels)):
+            level = self.levels[h]
+            if len(level) < self._capacity(h):
+                continue
+            if h + 1 >= len(self.levels):
+                self._grow()
+            level.sort()
+            keep = [level.pop()] if len(level) % 2 else []
+            promoted = level[_rng.getrandbits(1)::2]
+            self.levels[h + 1].extend(promoted)
+            self.size -= len(level) - len(promoted)
+            self.levels[h] = keep
+            if self.size < self.max_size:
+                break
+
+    def update(self, x):
+        self.levels[0].append(float(x))
+        self.size += 1
+        self.n += 1
+        if self.size >= self.max_size:
+            self._compress()
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self._grow()
+        for h, items in enumerate(other.levels):
+            self.levels[h].extend(items)
+        self.size += other.size
+        self.n += other.n
+        while self.size >= self.max_size:
+            before = self.size
+            self._compress()
+            if self.size == before:
+                self._grow()
+        return self
+
+    def quantiles(self, qs):
+        """Values at each quantile in qs (0-1), or None per q when empty."""
+        weighted = sorted((x, 1 << h) for h, level in enumerate(self.levels) for x in level)
+        total = sum(w for _, w in weighted)
+        if not total:
+            return [None] * len(qs)
+        out = []
+        for q in qs:
+            target = q * total
+            acc = 0
+            value = weighted[-1][0]
+            for x, w in weighted:
+                acc += w
+                if acc >= target:
+                    value = x
+                    break
+            out.append(value)
+        return out
+
+
+def exceedance(x, p95, p99):
+    """0 up to p95, 30-60 between p95 and p99, 60-100 beyond p99."""
+    if x <= p95:
+        return 0.0
+    if x <= p99:
+        return 30 + 30 * (x - p95) / (p99 - p95)
+    return min(100, 60 + 40 * (x - p99) / max(p99, 1))
+
+
+# ─── Per-User / Cohort State ─────────────────────────────────────────
+
+_lock = threading.Lock()
+_sketches: dict = {}     # user_id -> [KLLSketch per metric]
+_own: dict = {}          # user_id -> (samples, {metric: (p95, p99)}), cached until the next fold
+_cohorts: dict = {}      # cohort name -> (built_at, {metric: (p95, p99) or None})
+_change_hooks = []
+
+
+def on_cohort_change(callback):
+    """Register callback(name), run when a rebuilt cohort's thresholds differ."""
+    _change_hooks.append(callback)
+
+
+def _on_fold(user_id, values):
+    with _lock:
+        sk = _sketches.get(user_id)
+        if sk is None:
+            sk = _sketches[user_id] = [KLLSketch() for _ in METRICS]
+        for s, x in zip(sk, values):
+            s.update(x)
+        _own.pop(user_id, None)
+
+
+def _on_reset():
+    with _lock:
+        _sketches.clear()
+        _own.clear()
+        _cohorts.clear()
+
+
+def _on_cohort_refresh():
+    # Membership may have changed; rebuild lazily on the next read
+    with _lock:
+        _cohorts.clear()
+
+
+def _pcts(sketch, min_samples=SKETCH_MIN_SAMPLES):
+    if sketch.n < max(1, min_samples):
+        return None
+    p95, p99 = sketch.quantiles((0.95, 0.99))
+    return p95, p99
+
+
+def _own_locked(user_id):
+    cached = _own.get(user_id)
+    if cached is None:
+        sk = _sketches.get(user_id)
+        if sk is None:
+            cached = (0, {})
+        else:
+            cached = (sk[0].n, {metric: _pcts(s, 1) for metric, s in zip(METRICS, sk)})
+        _own[user_id] = cached
+    return cached
+
+
+def _cohort_locked(name):
+    entry = _cohorts.get(name)
+    if entry is not None and time.monotonic() - entry[0] < SKETCH_COHORT_REFRESH_SECONDS:
+        return entry[1]
+    merged = [KLLSketch() for _ in METRICS]
+    for uid in cohorts.members(name):
+        sk = _sketches.get(uid)
+        if sk is not None:
+            for m, s in zip(merged, sk):
+                m.merge(s)
+    result = {metric: _pcts(m) for metric, m in zip(METRICS, merged)}
+    _cohorts[name] = (time.monotonic(), result)
+    if entry is not None and entry[1] != result:
+        for cb in _change_hooks:
+            cb(name)
+    return result
+
+
+def thresholds(user_id: str, profile: dict = None) -> dict:
+    """{metric: (p95, p99)} for the scored metrics; None where data is too thin.
+
+    `profile` is the user's cohort.user_profile(); its cohort and effective
+    session count pick the peer sketch and the blend weight.
+    """
+    name = (profile or {}).get("cohort")
+    with _lock:
+        n, own = _own_locked(user_id)
+        peer = _cohort_locked(name) if name else {}
+    w = cohorts.own_weight(profile.get("effective_sessions", 0)) if name else 1.0
+    out = {}
+    for m in SCORED:
+        o, p = own.get(m), peer.get(m)
+        if p is None:
+            out[m] = o if n >= SKETCH_MIN_SAMPLES else None
+        elif o is None:
+            out[m] = p
+        else:
+            out[m] = (w * o[0] + (1 - w) * p[0], w * o[1] + (1 - w) * p[1])
+    return out
+
+
+def cohort(name: str) -> dict:
+    """p95 / p99 of every metric over the merged sketches of a cohort ("role:<r>" / "apps:<a,b>")."""
+    with _lock:
+        return dict(_cohort_locked(name))
+
+
+def _memory_report():
+    with _lock:
+        users = len(_sketches)
+        values = sum(s.size for sk in _sketches.values() for s in sk)
+    return {"entries": users, "approx_bytes": values * 32 + users * len(METRICS) * 120}
+
+
+baselines.on_fold(_on_fold, reset=_on_reset)
+cohorts.on_refresh(_on_cohort_refresh)
+db.register_index("quantile_sketches", _memory_report)
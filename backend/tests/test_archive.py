@@ -0,0 +1,24 @@
+"""Archive statistics follow the sealed blocks the store actually holds."""
+
+import uuid
+from datetime import datetime, timedelta
+
+import archive
+import db
+
+
+def test_stats_reset_when_the_store_is_reloaded(tmp_path):
+    logs = db.get_db_connection()["behavior_logs"]
+    marker = f"user_{uuid.uuid4().hex}"
+    old = datetime.utcnow() - timedelta(days=archive.ARCHIVE_AFTER_DAYS + 2)
+    logs.insert_many([{"user_id": marker, "timestamp": old + timedelta(minutes=i), "action": "view"}
+                      for i in range(500)])
+    assert archive.archive_old_logs() >= 500
+    assert archive.archive_stats()["rows"] >= 500
+
+    snapshot = str(tmp_path / "store.ztdb")
+    db.dump(snapshot)
+    db.load(snapshot)
+    stats = archive.archive_stats()
+    assert (stats["rows"], stats["blocks"], stats["raw_bytes"], stats["compression_ratio"]) == (0, 0, 0, 0)
+    assert logs.count_documents({"user_id": marker}) == 500
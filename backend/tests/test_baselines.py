@@ -0,0 +1,178 @@
+"""Incremental user baselines against a from-scratch batch computation."""
+
+import math
+import random
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import baselines
+import db
+
+DAY = 86400.0
+
+
+def batch_stats(samples, half_life):
+    """Weighted mean / std over (t, x), each weighted by its age relative to the newest sample."""
+    newest = max(t for t, _ in samples)
+    weights = [0.5 ** ((newest - t) / half_life) for t, _ in samples]
+    total = sum(weights)
+    mean = sum(w * x for w, (_, x) in zip(weights, samples)) / total
+    var = sum(w * (x - mean) ** 2 for w, (_, x) in zip(weights, samples)) / total
+    return mean, math.sqrt(var)
+
+
+def fold_all(samples, half_life):
+    u = baselines.UserBaseline()
+    for t, x in samples:
+        u.fold([x, 0, 0, 0], t, half_life)
+    return u.stats[0]
+
+
+def test_without_decay_matches_population_stats():
+    rnd = random.Random(1)
+    samples = [(i * DAY, rnd.uniform(0, 100)) for i in range(500)]
+    s = fold_all(samples, half_life=1e18)
+    xs = [x for _, x in samples]
+    assert s.mean == pytest.approx(statistics.fmean(xs), rel=1e-9)
+    assert s.std() == pytest.approx(statistics.pstdev(xs), rel=1e-9)
+    assert s.effective_n() == pytest.approx(len(xs))
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_decayed_stats_match_batch(shuffle):
+    rnd = random.Random(2)
+    samples = [(rnd.uniform(0, 200) * DAY, rnd.gauss(30, 8)) for _ in range(300)]
+    samples.sort()
+    if shuffle:
+        # Late-arriving old sessions are down-weighted by age instead of rewinding the clock
+        rnd.shuffle(samples)
+    half_life = 30 * DAY
+    s = fold_all(samples, half_life)
+    mean, std = batch_stats(samples, half_life)
+    assert s.mean == pytest.approx(mean, rel=1e-9)
+    assert s.std() == pytest.approx(std, rel=1e-9)
+
+
+def _insert_closed_session(conn, uid, start, values):
+    sid = f"test_{uuid.uuid4().hex}"
+    conn["sessions"].insert_one({"session_id": sid, "user_id": uid, "start_time": start,
+                                 "expires_at": start + timedelta(hours=8), "revoked": True})
+    conn["session_behavior"].insert_one(dict(zip(baselines.METRICS, values), session_id=sid, user_id=uid,
+                                             login_timestamp=start))
+
+
+def test_write_hooks_match_rebuild_and_batch():
+    conn = db.get_db_connection()
+    rnd = random.Random(3)
+    uid = f"user_{uuid.uuid4().hex}"
+    now = datetime.utcnow()
+    rows = []
+    for i in range(60):
+        start = now - timedelta(days=120 - 2 * i, hours=rnd.random())
+        values = [rnd.randint(5, 60), rnd.randint(0, 9), rnd.randint(5, 90), rnd.randint(0, 6)]
+        _insert_closed_session(conn, uid, start, values)
+        rows.append((start, values))
+
+    incremental = baselines.user_profile(uid)
+    baselines.rebuild()
+    rebuilt = baselines.user_profile(uid)
+    assert rebuilt == pytest.approx(incremental, rel=1e-9)
+
+    half_life = baselines.BASELINE_HALF_LIFE_DAYS * DAY
+    t = [(start - baselines._EPOCH).total_seconds() for start, _ in rows]
+    columns = {m: batch_stats([(ti, v[i]) for ti, (_, v) in zip(t, rows)], half_life)
+               for i, m in enumerate(baselines.METRICS)}
+    assert incremental["avg_actions"] == pytest.approx(columns["action_count"][0], rel=1e-9)
+    assert incremental["std_actions"] == pytest.approx(max(1, columns["action_count"][1]), rel=1e-9)
+    assert incremental["avg_downloads"] == pytest.approx(columns["download_count"][0], rel=1e-9)
+    assert incremental["avg_session_duration"] == pytest.approx(columns["duration_minutes"][0], rel=1e-9)
+    assert incremental["avg_switches"] == pytest.approx(columns["service_switches"][0], rel=1e-9)
+    assert incremental["std_switches"] == pytest.approx(columns["service_switches"][1], rel=1e-9)
+    assert incremental["total_sessions"] == len(rows)
+
+
+def test_open_session_folds_only_when_it_closes():
+    conn = db.get_db_connection()
+    uid = f"user_{uuid.uuid4().hex}"
+    now = datetime.utcnow()
+    _insert_closed_session(conn, uid, now - timedelta(days=1), [10, 1, 20, 1])
+    before = baselines.user_profile(uid)
+
+    sid = f"test_{uuid.uuid4().hex}"
+    conn["sessions"].insert_one({"session_id": sid, "user_id": uid, "start_time": now,
+                                 "expires_at": now + timedelta(hours=8), "revoked": False})
+    conn["session_behavior"].insert_one({"session_id": sid, "user_id": uid, "login_timestamp": now,
+                                         "action_count": 500, "download_count": 50,
+                                         "duration_minutes": 300, "service_switches": 9})
+    assert baselines.user_profile(uid) == before
+
+    conn["sessions"].update_one({"session_id": sid}, {"$set": {"revoked": True}})
+    after = baselines.user_profile(uid)
+    assert after["total_sessions"] == 2
+    assert after["avg_actions"] > before["avg_actions"]
+
+
+
+def test_expired_session_folds_without_a_sweep():
+    conn = db.get_db_connection()
+    uid = f"user_{uuid.uuid4().hex}"
+    sid = f"test_{uuid.uuid4().hex}"
+    now = datetime.utcnow()
+    conn["sessions"].insert_one({"session_id": sid, "user_id": uid, "start_time": now,
+                                 "expires_at": now + timedelta(milliseconds=50), "revoked": False})
+    conn["session_behavior"].insert_one({"session_id": sid, "user_id": uid, "login_timestamp": now,
+                                         "action_count": 40, "download_count": 2,
+                                         "duration_minutes": 10, "service_switches": 1})
+    assert sid in baselines._open
+    time.sleep(0.1)
+    # No close_expired() call: the next profile read drains the expiry heap
+    profile = baselines.user_profile(uid)
+    assert sid not in baselines._open
+    assert profile["total_sessions"] == 1
+    assert profile["avg_actions"] == 40
+
+# ─── Drift Replay ────────────────────────────────────────────────────
+
+def replay_shift(half_life_days, days=240, shift_day=120, before=20.0, after=60.0, seed=7):
+    """One session a day whose action count jumps from `before` to `after` on shift_day.
+
+    Returns days after the shift until the EWMA and the all-time mean reach
+    halfway to the new level, the final EWMA, and the per-user state size
+    in bytes at the start and end.
+    """
+    rnd = random.Random(seed)
+    u = baselines.UserBaseline()
+    total = 0.0
+    mid = (before + after) / 2
+    ewma_days = alltime_days = None
+    sizes = []
+    for day in range(days):
+        level = before if day < shift_day else after
+        x = max(0.0, rnd.gauss(level, level * 0.15))
+        u.fold([x, 0, 0, 0], day * DAY, half_life_days * DAY)
+        total += x
+        sizes.append(sys.getsizeof(u) + sum(sys.getsizeof(s) for s in u.stats))
+        if day >= shift_day:
+            if ewma_days is None and u.stats[0].mean >= mid:
+                ewma_days = day - shift_day + 1
+            if alltime_days is None and total / (day + 1) >= mid:
+                alltime_days = day - shift_day + 1
+    return ewma_days, alltime_days, u.stats[0].mean, (sizes[0], sizes[-1])
+
+
+@pytest.mark.parametrize("half_life_days", [7, 30])
+def test_ewma_tracks_level_shift_within_about_one_half_life(half_life_days):
+    ewma_days, alltime_days, final, sizes = replay_shift(half_life_days)
+    # One half-life of daily sessions moves a decayed mean halfway; allow noise
+    assert ewma_days is not None and ewma_days <= 1.25 * half_life_days
+    # The undecayed mean needs about as long as the old regime lasted
+    assert alltime_days is not None and alltime_days >= 100
+    assert ewma_days < alltime_days / 3
+    assert final == pytest.approx(60.0, rel=0.1)
+    # Constant memory: no per-session state accumulates
+    assert sizes[0] == sizes[1]
@@ -0,0 +1,105 @@
+"""Vectorized batch scoring against the scalar risk_engine path, session by session."""
+
+import asyncio
+import random
+import uuid
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+
+import batch_risk
+import cohort
+import db
+import ip_trie
+import policy
+import risk_engine
+
+SERVICES = ["CRM Portal", "Email Server", "File Storage", "HR System"]
+IPS = ["10.1.2.3", "10.9.9.9", "192.168.1.5", "192.168.1.77", "192.168.2.9",
+       "185.220.101.42", "91.219.236.5", "203.0.113.8"]
+
+
+@pytest.fixture
+def mixed_policies():
+    previous = policy.current()
+    app = f"app_{uuid.uuid4().hex[:8]}"
+    policy.apply({
+        "default": {"thresholds": {"allow": 25, "re_authenticate": 55}},
+        "roles": {"admin": {"weights": {"login_attempts": 0.3, "time_deviation": 0.05}, "normal_hours": [6, 22]},
+                  "auditor": {"max_normal_downloads": 50}},
+        "apps": {app: {"max_normal_service_switches": 2, "thresholds": {"allow": 10}}},
+    })
+    trusted = db.get_db_connection()["trusted_networks"].insert_one({"cidr": "10.0.0.0/8", "label": "office"})
+    yield app
+    db.get_db_connection()["trusted_networks"].delete_one({"_id": trusted.inserted_id})
+    policy.apply(previous.doc, source=previous.source)
+
+
+def _seed(app, rnd):
+    conn = db.get_db_connection()
+    now = datetime.utcnow()
+    sids = []
+    loner = f"role_{uuid.uuid4().hex[:8]}"
+    for u in range(26):
+        uid = f"user_{uuid.uuid4().hex}"
+        # The last two share a role too small for a cohort and hold no credentials: no quantiles at all
+        role = loner if u >= 24 else rnd.choice(["user", "admin", "auditor"])
+        conn["users"].insert_one({"_id": uid, "name": uid, "role": role, "risk_score": 0.1})
+        for a in rnd.sample([app, "app_crm", "app_mail"], 0 if role == loner else rnd.randint(0, 2)):
+            conn["user_credentials"].insert_one({"user_id": uid, "app_id": a})
+        # Seasoned users carry their own sketches; thin ones fall back to cohorts or mean / std
+        history = 15 if u % 3 and role != loner else rnd.randint(0, 2)
+        for i in range(history + 3):
+            start = now - timedelta(days=history + 3 - i, minutes=rnd.randint(0, 1440))
+            sid = f"test_{uuid.uuid4().hex}"
+            closed = i < history
+            conn["sessions"].insert_one({
+                "session_id": sid, "user_id": uid, "start_time": start,
+                "expires_at": start + timedelta(hours=8), "revoked": closed,
+                "device_fingerprint": rnd.choice(["chrome-win", "firefox-mac", f"new-{uuid.uuid4().hex[:6]}"]),
+                "ip_address": rnd.choice(IPS), "app_id": rnd.choice([None, app]),
+                "login_attempt_count": rnd.choice([1, 1, 2, 4]),
+                "source_failed_logins": rnd.choice([0, 0, 12, 30]),
+            })
+            conn["session_behavior"].insert_one({
+                "session_id": sid, "user_id": uid, "login_timestamp": start,
+                "action_count": rnd.choice([0, 10, 25, rnd.randint(0, 300)]),
+                # Every fourth user never downloads (p95 = p99 = 0 on their own sketch) until the scored sessions
+                "download_count": (0 if closed else rnd.randint(1, 9)) if u % 4 == 0
+                else rnd.choice([0, 0, 3, rnd.randint(0, 80)]),
+                "duration_minutes": rnd.choice([10, 30, rnd.randint(0, 400)]),
+                "service_switches": rnd.randint(0, 12),
+                "failed_access_attempts": rnd.choice([0, 0, 3]),
+                "accessed_services": rnd.sample(SERVICES, rnd.randint(0, 3)),
+            })
+            sids.append(sid)
+    return sids
+
+
+def test_batch_matches_scalar_components_and_score(mixed_policies):
+    sids = _seed(mixed_policies, random.Random(11))
+    cohort.refresh()
+
+    # The sample must exercise every branch the two paths implement separately
+    _, _, X = batch_risk.extract_features(sids)
+    assert np.isnan(X[:, batch_risk.F_P95_DOWNLOADS]).any() and (~np.isnan(X[:, batch_risk.F_P95_DOWNLOADS])).any()
+    assert (X[:, batch_risk.F_IP] == ip_trie.IP_TRUSTED).any() and (X[:, batch_risk.F_IP] != ip_trie.IP_TRUSTED).any()
+    assert (X[:, batch_risk.F_DEVICE] == batch_risk.DEVICE_UNKNOWN).any()
+    assert len(set(X[:, batch_risk.F_POLICY])) > 1
+
+    async def compare():
+        for sid in sids:
+            # Batch first: the scalar path persists decisions (revocations, access levels)
+            batch = batch_risk.evaluate_sessions_batch([sid])[0]
+            scalar = await risk_engine.evaluate_session_risk(batch["user_id"], sid)
+            raw = {b["factor"]: b["raw_risk"] for b in scalar["breakdown"]}
+            assert_allclose([raw[c] for c in policy.COMPONENTS],
+                            [batch["components"][c] for c in policy.COMPONENTS], rtol=0, atol=1e-9, err_msg=sid)
+            assert_allclose(scalar["score"], batch["score"], rtol=0, atol=1e-9, err_msg=sid)
+            assert (scalar["decision"], scalar["multiplier"], scalar["critical_factors"], scalar["warning_factors"],
+                    scalar["policy"]) == (batch["decision"], batch["multiplier"], batch["critical_factors"],
+                                          batch["warning_factors"], batch["policy"])
+
+    asyncio.run(compare())
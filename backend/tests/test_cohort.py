@@ -0,0 +1,94 @@
+"""Cohort baselines pool the same decayed, closed-session population as user baselines."""
+
+import random
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import baselines
+import cohort
+import db
+import risk_engine
+
+
+def test_cohort_matches_pooled_decayed_closed_sessions():
+    conn = db.get_db_connection()
+    rnd = random.Random(4)
+    role = f"role_{uuid.uuid4().hex[:8]}"
+    now = datetime.utcnow()
+    half_life = baselines.BASELINE_HALF_LIFE_DAYS * 86400
+    closed = []
+    for u in range(5):
+        uid = f"user_{uuid.uuid4().hex}"
+        conn["users"].insert_one({"_id": uid, "role": role})
+        for _ in range(20):
+            start = now - timedelta(days=rnd.uniform(1, 200))
+            actions = rnd.randint(10, 80)
+            sid = f"test_{uuid.uuid4().hex}"
+            conn["sessions"].insert_one({"session_id": sid, "user_id": uid, "start_time": start,
+                                         "expires_at": start + timedelta(hours=8), "revoked": True})
+            conn["session_behavior"].insert_one({"session_id": sid, "user_id": uid, "login_timestamp": start,
+                                                 "action_count": actions})
+            closed.append((start, actions))
+        # An open session with the all-zero behavior row written at login must not drag the cohort down
+        sid = f"test_{uuid.uuid4().hex}"
+        conn["sessions"].insert_one({"session_id": sid, "user_id": uid, "start_time": now,
+                                     "expires_at": now + timedelta(hours=8), "revoked": False})
+        conn["session_behavior"].insert_one({"session_id": sid, "user_id": uid, "login_timestamp": now,
+                                             "action_count": 0})
+
+    c = cohort.refresh()[f"role:{role}"]
+    weights = [0.5 ** ((now - start).total_seconds() / half_life) for start, _ in closed]
+    mean = sum(w * x for w, (_, x) in zip(weights, closed)) / sum(weights)
+    std = (sum(w * (x - mean) ** 2 for w, (_, x) in zip(weights, closed)) / sum(weights)) ** 0.5
+    assert c["users"] == 5
+    assert c["sessions"] == len(closed)
+    assert c["effective_sessions"] == pytest.approx(sum(weights), rel=1e-3)
+    assert c["avg_actions"] == pytest.approx(mean, rel=1e-6)
+    assert c["std_actions"] == pytest.approx(std, rel=1e-6)
+
+
+def _closed_sessions(conn, uid, rows, now):
+    for i, (actions, downloads) in enumerate(rows):
+        start = now - timedelta(days=1 + i)
+        sid = f"test_{uuid.uuid4().hex}"
+        conn["sessions"].insert_one({"session_id": sid, "user_id": uid, "start_time": start,
+                                     "expires_at": start + timedelta(hours=8), "revoked": True})
+        conn["session_behavior"].insert_one({"session_id": sid, "user_id": uid, "login_timestamp": start,
+                                             "action_count": actions, "download_count": downloads})
+
+
+def test_thin_user_scores_follow_credential_set_cohort():
+    """Action / download scores of a thin user come from their credential-set cohort, not the shared role."""
+    conn = db.get_db_connection()
+    rnd = random.Random(7)
+    now = datetime.utcnow()
+    role = f"role_{uuid.uuid4().hex[:8]}"
+    quiet_app, busy_app = f"app_{uuid.uuid4().hex[:8]}", f"app_{uuid.uuid4().hex[:8]}"
+    for app, actions, downloads in ((quiet_app, (5, 15), (0, 2)), (busy_app, (80, 120), (20, 40))):
+        for _ in range(4):
+            uid = f"user_{uuid.uuid4().hex}"
+            conn["users"].insert_one({"_id": uid, "role": role})
+            conn["user_credentials"].insert_one({"user_id": uid, "app_id": app})
+            _closed_sessions(conn, uid, [(rnd.randint(*actions), rnd.randint(*downloads)) for _ in range(15)], now)
+    thin = {}
+    for app in (quiet_app, busy_app):
+        uid = thin[app] = f"user_{uuid.uuid4().hex}"
+        conn["users"].insert_one({"_id": uid, "role": role})
+        conn["user_credentials"].insert_one({"user_id": uid, "app_id": app})
+        _closed_sessions(conn, uid, [(50, 10)], now)
+    cohort.refresh()
+
+    session = {"action_count": 60, "download_count": 25}
+    scores = {}
+    for app, uid in thin.items():
+        profile = risk_engine.build_user_profile(uid, role, [app])
+        assert profile["cohort"] == f"apps:{app}"
+        assert profile["q_actions"] is not None and profile["q_downloads"] is not None
+        scores[app] = (risk_engine.calc_behavioral_anomaly(session, profile)[0],
+                       risk_engine.calc_download_spike(session["download_count"], profile["avg_downloads"],
+                                                       quantiles=profile["q_downloads"])[0])
+    # Far above the quiet cohort, ordinary for the busy one
+    assert scores[quiet_app][0] > 0 and scores[quiet_app][1] >= 60
+    assert scores[busy_app] == (0.0, 0.0)
@@ -0,0 +1,33 @@
+"""Campaign correlation windows on when incidents and alerts were last seen."""
+
+import uuid
+from datetime import datetime, timedelta
+
+import correlation
+import db
+
+
+def _campaign_of(result, doc_id):
+    return next((c for c in result if str(doc_id) in c["incident_ids"] + c["alert_ids"]), None)
+
+
+def test_recurring_alert_raised_before_the_window_joins_its_campaign():
+    conn = db.get_db_connection()
+    now = datetime.utcnow()
+    ip = f"198.51.100.{uuid.uuid4().int % 200 + 20}"
+    alert = conn["alerts"].insert_one({
+        "user_id": f"user_{uuid.uuid4().hex}", "ip_address": ip, "severity": "high", "description": "stuffing",
+        "timestamp": now - timedelta(hours=correlation.CORRELATION_WINDOW_HOURS + 24),
+        "last_seen": now - timedelta(minutes=5)}).inserted_id
+    incident = conn["incidents"].insert_one({
+        "user_id": f"user_{uuid.uuid4().hex}", "ip_address": ip, "risk_level": "critical",
+        "incident_type": "blocked_session", "timestamp": now}).inserted_id
+    stale = conn["incidents"].insert_one({
+        "user_id": f"user_{uuid.uuid4().hex}", "ip_address": ip, "risk_level": "high", "incident_type": "old",
+        "timestamp": now - timedelta(hours=correlation.CORRELATION_WINDOW_HOURS + 1)}).inserted_id
+
+    result = correlation.campaigns(limit=10_000)
+    campaign = _campaign_of(result, incident)
+    assert campaign["alert_ids"] == [str(alert)] and campaign["incident_ids"] == [str(incident)]
+    assert campaign["pattern"] == "shared_infrastructure" and len(campaign["users"]) == 2
+    assert _campaign_of(result, stale) is None   # no last_seen: windowed on timestamp
@@ -0,0 +1,72 @@
+"""Impossible travel: distance / speed between consecutive logins and its risk tiers."""
+
+import uuid
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import batch_risk
+import db
+import geoip
+
+NEW_YORK, LONDON, MOSCOW, BEIJING = "192.168.1.20", "172.16.0.20", "91.219.236.20", "103.47.132.20"
+
+
+def test_speed_tiers():
+    top = geoip.GEOIP_MAX_SPEED_KMH
+    far = geoip.GEOIP_TRAVEL_MIN_KM + 1000
+    cases = [
+        (geoip.GEOIP_TRAVEL_MIN_KM - 1, 100 * top, 0.0),   # GeoIP noise, however fast
+        (far, 0.5 * top, 0.0),
+        (far, 0.8 * top, 0.0),                              # airliner speeds are plausible
+        (far, 0.9 * top, 45.0),                             # unlikely: 30-60
+        (far, top, 60.0),
+        (far, 2 * top, 70.0),                               # impossible: 60-100
+        (far, 5 * top, 100.0),
+        (far, 50 * top, 100.0),
+    ]
+    for km, kmh, expected in cases:
+        assert geoip.risk(km, kmh)[0] == pytest.approx(expected)
+    km, kmh = np.array([c[0] for c in cases], float), np.array([c[1] for c in cases], float)
+    np.testing.assert_allclose(batch_risk._impossible_travel(km, kmh), [c[2] for c in cases])
+
+
+def _login(uid, ip, start):
+    sid = f"test_{uuid.uuid4().hex}"
+    db.get_db_connection()["sessions"].insert_one({"session_id": sid, "user_id": uid, "ip_address": ip,
+                                                   "start_time": start, "expires_at": start + timedelta(hours=8)})
+    return sid
+
+
+def test_travel_between_consecutive_logins():
+    uid, t0 = f"user_{uuid.uuid4().hex}", datetime.utcnow() - timedelta(days=2)
+    first = _login(uid, NEW_YORK, t0)
+    assert geoip.travel(uid, first, NEW_YORK, t0) == (0.0, 0.0)       # no previous login
+
+    # New York -> Moscow in an hour: impossible
+    hop = _login(uid, MOSCOW, t0 + timedelta(hours=1))
+    km, kmh = geoip.travel(uid, hop, MOSCOW, t0 + timedelta(hours=1))
+    assert 7400 < km < 7600 and kmh == pytest.approx(km)
+    assert geoip.risk(km, kmh)[0] == 100.0
+
+    # Moscow -> Beijing twelve hours later: a flight
+    later = t0 + timedelta(hours=13)
+    sid = _login(uid, BEIJING, later)
+    km, kmh = geoip.travel(uid, sid, BEIJING, later)
+    assert 5700 < km < 5900 and geoip.risk(km, kmh)[0] == 0.0
+
+    # Re-scoring a session compares it with the login before it, not with itself or later ones
+    ny_msk = geoip.haversine_km(geoip.coords(NEW_YORK), geoip.coords(MOSCOW))
+    assert geoip.travel(uid, hop, MOSCOW, t0 + timedelta(hours=1)) == pytest.approx((ny_msk, ny_msk))
+    assert geoip.travel(uid, None, "10.255.0.1", later + timedelta(hours=1))[1] > 0
+    assert geoip.travel(uid, None, "8.8.8.8", later) == (0.0, 0.0)     # not in the range table
+
+
+def test_unlikely_tier_between_offices():
+    uid, t0 = f"user_{uuid.uuid4().hex}", datetime.utcnow() - timedelta(days=1)
+    _login(uid, NEW_YORK, t0)
+    km = geoip.haversine_km(geoip.coords(NEW_YORK), geoip.coords(LONDON))
+    for hours, tier in ((8, 0.0), (km / (0.9 * geoip.GEOIP_MAX_SPEED_KMH), 45.0)):
+        start = t0 + timedelta(hours=hours)
+        assert geoip.risk(*geoip.travel(uid, None, LONDON, start))[0] == pytest.approx(tier, abs=1e-6)
@@ -0,0 +1,125 @@
+"""Outbox delivery against LocalSMTPSink: persistence, retry / backoff and the circuit breaker."""
+
+import socket
+import time
+
+import pytest
+
+import mail_queue
+
+
+def _closed_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _rows():
+    with mail_queue._db_lock:
+        return mail_queue._db().execute(
+            "SELECT id, status, attempts, next_attempt, last_error FROM outbox ORDER BY id").fetchall()
+
+
+def _make_due():
+    with mail_queue._db_lock:
+        mail_queue._db().execute("UPDATE outbox SET next_attempt = 0")
+
+
+def _restart():
+    """What a process restart leaves behind: only the SQLite file."""
+    mail_queue._pool.close()
+    mail_queue._conn.close()
+    mail_queue._conn = None
+
+
+@pytest.fixture
+def sink(tmp_path, monkeypatch):
+    monkeypatch.setattr(mail_queue, "MAIL_QUEUE_PATH", str(tmp_path / "outbox.sqlite3"))
+    monkeypatch.setattr(mail_queue, "_conn", None)
+    monkeypatch.setattr(mail_queue, "_breaker", mail_queue.CircuitBreaker(2, 0.3))
+    monkeypatch.setattr(mail_queue, "_pool", mail_queue.SMTPPool(2))
+    for name, value in (("MAIL_TRANSPORT", "smtp"), ("SMTP_SERVER", "127.0.0.1"), ("SMTP_STARTTLS", "0"),
+                        ("SMTP_USER", ""), ("SMTP_PASSWORD", ""), ("SMTP_TIMEOUT_SECONDS", "2")):
+        monkeypatch.setenv(name, value)
+    server = mail_queue.LocalSMTPSink().start()
+    monkeypatch.setenv("SMTP_PORT", str(server.port))
+    yield server
+    mail_queue.stop()
+    mail_queue._pool.close()
+    if mail_queue._conn is not None:
+        mail_queue._conn.close()
+    server.stop()
+
+
+def test_outbox_survives_restart(sink):
+    first = mail_queue.enqueue("a@example.com", "queued before restart", "body")
+    mail_queue.enqueue("b@example.com", "left mid-send", "body")
+    # Crash while the second message is claimed: it must go back to queued, not stay in 'sending'
+    assert len(mail_queue._claim(1)) == 1
+    _restart()
+    assert {r[1] for r in _rows()} == {"queued", "sending"}
+
+    mail_queue.start()
+    deadline = time.time() + 5
+    while len(sink.messages) < 2 and time.time() < deadline:
+        time.sleep(0.05)
+    assert sorted(rcpts[0] for _, rcpts, _ in sink.messages) == ["a@example.com", "b@example.com"]
+    assert _rows() == [] and first > 0
+
+
+def test_transient_failures_back_off_then_deliver(sink, monkeypatch):
+    monkeypatch.setenv("SMTP_PORT", str(_closed_port()))
+    mail_queue.enqueue("a@example.com", "retry me", "body")
+    base = mail_queue.MAIL_BACKOFF_BASE_SECONDS
+    for attempt in (1, 2):
+        _make_due()
+        before = time.time()
+        assert mail_queue.drain() == 1
+        mail_queue._breaker.success()   # keep the breaker out of this test
+        (_, status, attempts, next_attempt, error), = _rows()
+        assert (status, attempts) == ("queued", attempt) and error.startswith("connect:")
+        # Exponential backoff with +-20% jitter
+        delay = base * 2 ** (attempt - 1)
+        assert 0.8 * delay - 0.5 <= next_attempt - before <= 1.2 * delay + 0.5
+    assert mail_queue.drain() == 0   # not due yet
+
+    monkeypatch.setenv("SMTP_PORT", str(sink.port))
+    _make_due()
+    assert mail_queue.drain() == 1
+    assert [m[1] for m in sink.messages] == [["a@example.com"]] and _rows() == []
+
+
+def test_permanent_rejection_is_not_retried(sink):
+    sink.reject = lambda rcpt: "550 No such user"
+    mail_queue.enqueue("gone@example.com", "bounce", "body")
+    assert mail_queue.drain() == 1
+    (_, status, attempts, _, error), = _rows()
+    assert (status, attempts) == ("dead", 1) and "refused" in error
+    assert sink.messages == []
+
+
+def test_circuit_breaker_opens_and_half_opens(sink, monkeypatch):
+    breaker = mail_queue._breaker
+    monkeypatch.setenv("SMTP_PORT", str(_closed_port()))
+    for i in range(4):
+        mail_queue.enqueue(f"u{i}@example.com", "breaker", "body")
+
+    mail_queue.drain()
+    assert breaker.state == "open"
+    _make_due()
+    assert mail_queue.drain() == 0            # open: nothing is even claimed
+
+    # Half-open lets exactly one probe through; a failed probe re-opens at once
+    time.sleep(breaker.cooldown)
+    assert breaker.state == "half_open"
+    _make_due()
+    assert mail_queue.drain() == 1
+    assert breaker.state == "open"
+
+    # A successful probe closes the breaker and the backlog drains
+    monkeypatch.setenv("SMTP_PORT", str(sink.port))
+    time.sleep(breaker.cooldown)
+    _make_due()
+    assert mail_queue.drain() == 4
+    assert breaker.state == "closed"
+    assert len(sink.messages) == 4 and _rows() == []
@@ -0,0 +1,91 @@
+"""Cached session risk is served only while every scoring input is unchanged."""
+
+import asyncio
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import db
+import policy
+import risk_cache
+import risk_engine
+import shared_infra
+
+
+def _login(uid, ip, start, expires_at=None, revoked=False):
+    conn = db.get_db_connection()
+    if conn["users"].find_one({"_id": uid}) is None:
+        conn["users"].insert_one({"_id": uid, "name": uid, "role": "user", "risk_score": 0.0})
+    sid = f"test_{uuid.uuid4().hex}"
+    conn["sessions"].insert_one({"session_id": sid, "user_id": uid, "start_time": start,
+                                 "expires_at": expires_at or start + timedelta(hours=8), "revoked": revoked,
+                                 "device_fingerprint": "chrome-win", "ip_address": ip})
+    conn["session_behavior"].insert_one({"session_id": sid, "user_id": uid, "login_timestamp": start})
+    return sid
+
+
+def _shared(result):
+    return next(b["raw_risk"] for b in result["breakdown"] if b["factor"] == "shared_infrastructure")
+
+
+def test_cached_score_follows_shared_ip_fan_in(monkeypatch):
+    ip = f"198.51.100.{uuid.uuid4().int % 200 + 20}"
+    now = datetime.utcnow()
+    uid = f"user_{uuid.uuid4().hex}"
+    sid = _login(uid, ip, now)
+
+    first = asyncio.run(risk_engine.get_session_risk(uid, sid))
+    assert first["decision"] != "BLOCK" and _shared(first) == 0
+    assert asyncio.run(risk_engine.get_session_risk(uid, sid)) is first   # nothing changed: cache hit
+
+    # Other accounts logging in from the same IP change this session's score without touching it
+    for _ in range(shared_infra.SHARED_IP_MIN_USERS - 1):
+        _login(f"user_{uuid.uuid4().hex}", ip, now)
+    crowded = asyncio.run(risk_engine.get_session_risk(uid, sid))
+    assert _shared(crowded) == shared_infra.risk(shared_infra.SHARED_IP_MIN_USERS)[0] > 0
+
+    # So does the window sliding past every one of those logins
+    later = now.timestamp() + shared_infra.SHARED_INFRA_WINDOW_MINUTES * 60 + 60
+    monkeypatch.setattr(shared_infra, "_now", lambda: later)
+    assert _shared(asyncio.run(risk_engine.get_session_risk(uid, sid))) == 0
+
+
+def _evaluate(uid, sid):
+    return asyncio.run(risk_engine.evaluate_session_risk(uid, sid))
+
+
+def test_revoked_sessions_are_not_cached():
+    uid = f"user_{uuid.uuid4().hex}"
+    sid = _login(uid, "192.168.1.5", datetime.utcnow(), revoked=True)
+    assert _evaluate(uid, sid)["decision"] != "BLOCK"
+    assert risk_cache.lookup(uid, sid) is None
+
+
+def test_blocked_results_are_not_cached():
+    previous = policy.current()
+    policy.apply({"default": {"thresholds": {"allow": 0, "re_authenticate": 0.1}}})
+    try:
+        uid = f"user_{uuid.uuid4().hex}"
+        sid = _login(uid, "192.168.1.5", datetime.utcnow())
+        assert _evaluate(uid, sid)["decision"] == "BLOCK"
+        assert risk_cache.lookup(uid, sid) is None
+    finally:
+        policy.apply(previous.doc, source=previous.source)
+
+
+def test_expired_sessions_leave_and_cache_stays_capped(monkeypatch):
+    monkeypatch.setattr(risk_cache, "RISK_CACHE_MAX_ENTRIES", 3)
+    now = datetime.utcnow()
+    uid = f"user_{uuid.uuid4().hex}"
+    short = _login(uid, "192.168.1.5", now, expires_at=now + timedelta(seconds=0.3))
+    assert _evaluate(uid, short)["decision"] != "BLOCK"
+    assert risk_cache.lookup(uid, short) is not None
+    time.sleep(0.4)
+    assert risk_cache.lookup(uid, short) is None
+
+    sids = [_login(uid, "192.168.1.5", now) for _ in range(5)]
+    for sid in sids:
+        _evaluate(uid, sid)
+    # Least recently used first: only the last three remain
+    assert risk_cache.stats()["entries"] == 3
+    assert [risk_cache.lookup(uid, sid) is not None for sid in sids] == [False, False, True, True, True]
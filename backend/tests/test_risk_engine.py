@@ -0,0 +1,55 @@
+"""Component calculators against their vectorized batch_risk mirrors."""
+
+import numpy as np
+
+import batch_risk
+import policy
+import risk_engine
+
+
+def _row(**cols):
+    x = np.zeros(batch_risk.N_FEATURES)
+    x[[batch_risk.F_P95_ACTIONS, batch_risk.F_P99_ACTIONS, batch_risk.F_P95_DOWNLOADS, batch_risk.F_P99_DOWNLOADS]] = np.nan
+    x[batch_risk.F_POLICY] = policy.current().default.index
+    x[batch_risk.F_LOGIN_ATTEMPTS] = 1
+    for name, value in cols.items():
+        x[getattr(batch_risk, name)] = value
+    return x
+
+
+def _batch(name, **cols):
+    raw = batch_risk.component_matrix(_row(**cols)[None, :], policy.current().tables())
+    return raw[0, policy.COMPONENTS.index(name)]
+
+
+def test_zero_download_quantiles_floor_at_policy_normal():
+    # A cohort that never downloads: p95 = p99 = 0 must not make one download a spike
+    pol = policy.current().default
+    for downloads, expected in ((1, 0.0), (pol.max_downloads, 0.0)):
+        assert risk_engine.calc_download_spike(downloads, 0, pol, (0.0, 0.0))[0] == expected
+        assert _batch("download_spike", F_DOWNLOADS=downloads, F_P95_DOWNLOADS=0, F_P99_DOWNLOADS=0) == expected
+    over = pol.max_downloads * 3
+    risk, _ = risk_engine.calc_download_spike(over, 0, pol, (0.0, 0.0))
+    assert risk >= 60
+    assert _batch("download_spike", F_DOWNLOADS=over, F_P95_DOWNLOADS=0, F_P99_DOWNLOADS=0) == risk
+
+
+def test_degenerate_action_quantiles_use_mean_std_rule():
+    profile = {"avg_actions": 20, "std_actions": 10, "q_actions": (0.0, 0.0)}
+    for actions in (1, 35, 60):
+        scalar, _ = risk_engine.calc_behavioral_anomaly({"action_count": actions}, profile)
+        legacy, _ = risk_engine.calc_behavioral_anomaly({"action_count": actions}, dict(profile, q_actions=None))
+        assert scalar == legacy
+        assert np.isclose(_batch("behavioral_anomaly", F_ACTIONS=actions, F_AVG_ACTIONS=20, F_STD_ACTIONS=10,
+                                 F_P95_ACTIONS=0, F_P99_ACTIONS=0, F_AVG_DURATION=30), scalar)
+    assert risk_engine.calc_behavioral_anomaly({"action_count": 1}, profile)[0] == 0
+
+
+def test_weights_are_normalized_so_thresholds_keep_their_scale():
+    ps = policy.PolicySet({"roles": {"admin": {"weights": {"login_attempts": 1.0}}}}, version=0)
+    for pol in (ps.default, ps.select("admin")):
+        assert np.isclose(sum(pol.weights), 1.0)
+        # A uniform 50 across every component scores 50 (all warnings, no multiplier)
+        result = risk_engine.composite_risk({c: (50.0, "") for c in policy.COMPONENTS}, pol)
+        assert result["score"] == 50.0 and result["multiplier"] == 1.0
+    assert np.allclose(ps.tables()["weights"].sum(axis=1), 1.0)
@@ -0,0 +1,51 @@
+"""Cold spill segments: time-bounded decoding and the unlocked spill write."""
+
+import os
+import uuid
+from datetime import datetime, timedelta
+
+import db
+from segments import SpillSegment
+
+
+def test_bounded_query_decodes_only_its_range(tmp_path):
+    t0 = datetime(2024, 1, 1)
+    docs = [{"user_id": f"u{i % 7}", "timestamp": t0 + timedelta(minutes=i), "n": i} for i in range(1000)]
+    seg = SpillSegment.write(str(tmp_path), "audit_trail", "timestamp", docs)
+    try:
+        window = {"timestamp": {"$gte": t0 + timedelta(minutes=100), "$lt": t0 + timedelta(minutes=110)}}
+        assert [d["n"] for d in seg.docs(window)] == list(range(100, 111))   # superset; db applies $lt
+        assert seg.docs({"timestamp": {"$gt": t0 + timedelta(days=1)}}) == []
+        assert seg.docs() == docs and seg.count == 1000 and seg.nbytes == os.path.getsize(seg.path)
+    finally:
+        seg.drop()
+
+
+def _old_rows(marker, n=300):
+    old = datetime.utcnow() - timedelta(days=db.SPILL_HOT_HOURS / 24 + 5)
+    return [{"user_id": marker, "timestamp": old + timedelta(seconds=i), "n": i} for i in range(n)]
+
+
+def test_spill_keeps_rows_hot_when_they_change_mid_write(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "SPILL_DIR", str(tmp_path))
+    monkeypatch.setattr(db, "MEMORY_BUDGET_MB", 1e-6)
+    logs = db.get_db_connection()["audit_trail"]
+    marker = f"user_{uuid.uuid4().hex}"
+    logs.insert_many(_old_rows(marker))
+
+    write = SpillSegment.write
+
+    def racing_write(*args):
+        logs.update_one({"user_id": marker, "n": 0}, {"$set": {"edited": True}})   # takes _lock: it is free
+        return write(*args)
+
+    monkeypatch.setattr(SpillSegment, "write", racing_write)
+    db.enforce_memory_budget()   # other log collections may spill in the same pass
+    assert not any(f.name.startswith("audit_trail-") for f in tmp_path.iterdir())
+    assert sum(d.get("user_id") == marker for d in db._store["audit_trail"]) == 300
+
+    monkeypatch.setattr(SpillSegment, "write", write)
+    assert db.enforce_memory_budget() > 0
+    assert not any(d.get("user_id") == marker for d in db._store["audit_trail"])
+    assert logs.count_documents({"user_id": marker}) == 300
+    assert logs.find_one({"user_id": marker, "n": 0})["edited"] is True
@@ -0,0 +1,70 @@
+"""Shared-IP fan-in: distinct users per IP inside the sliding window."""
+
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import db
+import shared_infra
+
+
+@pytest.fixture
+def away_from_utc(monkeypatch):
+    # Naive UTC timestamps must round-trip whatever the server's local zone is
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def _ip():
+    return f"203.0.113.{uuid.uuid4().int % 200 + 20}"
+
+
+def _login(uid, ip, start):
+    db.get_db_connection()["sessions"].insert_one({
+        "session_id": f"test_{uuid.uuid4().hex}", "user_id": uid, "ip_address": ip,
+        "start_time": start, "expires_at": start + timedelta(hours=8), "revoked": False})
+
+
+def test_fan_in_counts_distinct_users_and_expires(away_from_utc, monkeypatch):
+    ip, now = _ip(), datetime.utcnow()
+    users = [f"user_{uuid.uuid4().hex}" for _ in range(shared_infra.SHARED_IP_MIN_USERS + 1)]
+    _login(users[0], ip, now - timedelta(minutes=5))
+    _login(users[0], ip, now)                       # the same user twice is still one
+    assert shared_infra.fan_in(users[0], ip) == 1
+    assert shared_infra.fan_in("someone_else", ip) == 2
+    for uid in users[1:]:
+        _login(uid, ip, now)
+    n = len(users)
+    assert shared_infra.fan_in(users[0], ip) == n
+    assert shared_infra.risk(shared_infra.SHARED_IP_MIN_USERS - 1)[0] == 0
+    assert shared_infra.risk(n)[0] == 30.0 + 15.0 * (n - shared_infra.SHARED_IP_MIN_USERS)
+
+    row = next(r for r in shared_infra.top_shared(500)["ips"] if r["ip"] == ip)
+    assert row["users"] == n and row["sessions"] == n + 1
+    assert datetime.fromisoformat(row["last_seen"]) == now
+
+    # Each login ages out on its own once the window slides past it
+    window = shared_infra.SHARED_INFRA_WINDOW_MINUTES * 60
+    monkeypatch.setattr(shared_infra, "_now", lambda: now.timestamp() + window - 60)
+    assert shared_infra.fan_in(users[0], ip) == n
+    monkeypatch.setattr(shared_infra, "_now", lambda: now.timestamp() + window + 1)
+    assert shared_infra.fan_in(users[0], ip) == 1
+    assert all(r["ip"] != ip for r in shared_infra.top_shared(500)["ips"])
+
+
+def test_trusted_and_placeholder_ips_never_count():
+    db.get_db_connection()["trusted_networks"].insert_one({"cidr": "203.0.113.0/24", "label": "office"})
+    try:
+        ip = _ip()
+        for _ in range(shared_infra.SHARED_IP_MIN_USERS + 2):
+            _login(f"user_{uuid.uuid4().hex}", ip, datetime.utcnow())
+            _login(f"user_{uuid.uuid4().hex}", "unknown", datetime.utcnow())
+        assert shared_infra.fan_in("probe", ip) == 1
+        assert shared_infra.fan_in("probe", "unknown") == 1
+    finally:
+        db.get_db_connection()["trusted_networks"].delete_one({"cidr": "203.0.113.0/24"})
@@ -0,0 +1,77 @@
+"""Login throttling: which counters reject, and which address they are keyed on."""
+
+import ipaddress
+import uuid
+
+import pytest
+
+import throttle
+
+
+def _ip():
+    return f"198.18.{uuid.uuid4().int % 250}.{uuid.uuid4().int % 250 + 1}"
+
+
+def _account():
+    return f"user-{uuid.uuid4().hex}@example.com"
+
+
+@pytest.fixture
+def proxies(monkeypatch):
+    monkeypatch.setattr(throttle, "_ANY_PROXY", False)
+    monkeypatch.setattr(throttle, "_PROXY_NETS", [ipaddress.ip_network("10.0.0.0/8")])
+
+
+def test_client_ip_only_trusts_forwarded_for_from_proxies(proxies, monkeypatch):
+    # Direct clients cannot choose their own key
+    assert throttle.client_ip("203.0.113.9", "1.2.3.4") == "203.0.113.9"
+    # Behind a trusted proxy chain, the nearest hop that is not a proxy
+    assert throttle.client_ip("10.0.0.2", "203.0.113.5") == "203.0.113.5"
+    assert throttle.client_ip("10.0.0.2", "1.2.3.4, 203.0.113.5, 10.1.1.1") == "203.0.113.5"
+    assert throttle.client_ip("10.0.0.2", None) == "10.0.0.2"
+    assert throttle.client_ip("10.0.0.2", "not-an-ip") == "10.0.0.2"
+    # "*": the peer is always our proxy, but what it was handed is not trusted
+    monkeypatch.setattr(throttle, "_ANY_PROXY", True)
+    assert throttle.client_ip("169.254.1.1", "1.2.3.4, 203.0.113.5") == "203.0.113.5"
+
+
+def test_pair_limit_rejects_only_that_pair():
+    ip, account = _ip(), _account()
+    for _ in range(throttle.THROTTLE_PAIR_LIMIT):
+        assert throttle.check(ip, account) == 0
+        throttle.record_failure(ip, account)
+    assert throttle.check(ip, account) > 0
+    assert throttle.check(ip, _account()) == 0
+    assert throttle.check(_ip(), account) == 0
+
+
+def test_ip_limit_rejects_the_source_for_every_account():
+    ip = _ip()
+    for _ in range(throttle.THROTTLE_IP_LIMIT):
+        throttle.record_failure(ip, _account())
+    assert throttle.check(ip, _account()) > 0
+    assert throttle.check(_ip(), _account()) == 0
+
+
+def test_account_failures_never_lock_out_the_owner():
+    account = _account()
+    for _ in range(throttle.THROTTLE_IP_LIMIT):
+        throttle.record_failure(_ip(), account)
+    assert throttle.check(_ip(), account) == 0
+    assert throttle.counts(_ip(), account)["account"] >= throttle.THROTTLE_IP_LIMIT - 1
+
+
+def test_login_behind_proxy_throttles_per_client(proxies):
+    from fastapi.testclient import TestClient
+
+    import main
+
+    client = TestClient(main.app, client=("10.0.0.2", 50000))
+    body = {"email": _account(), "password": "wrong"}
+    attacker, neighbour = {"X-Forwarded-For": _ip()}, {"X-Forwarded-For": _ip()}
+    for _ in range(throttle.THROTTLE_PAIR_LIMIT):
+        assert client.post("/api/auth/login", json=body, headers=attacker).status_code == 401
+    rejected = client.post("/api/auth/login", json=body, headers=attacker)
+    assert rejected.status_code == 429 and int(rejected.headers["Retry-After"]) > 0
+    # Another client behind the same proxy is on its own counters
+    assert client.post("/api/auth/login", json=body, headers=neighbour).status_code == 401
@@ -0,0 +1,219 @@
+"""
+Login Throttling & Brute-Force Detection
+========================================
+`login` used to know only the user's own failed_login_count, reset on
+success: no per-IP view, so a password spray (a few guesses against many
+accounts) was invisible, and every guess paid for a full password hash.
+
+Failed logins are now counted in sliding windows of
+THROTTLE_WINDOW_SECONDS under three keys — source IP, account (email or
+app username) and the (IP, account) pair:
+
+  - SlidingCounter is the two-bucket sliding-window estimate: the previous
+    fixed window's count weighted by how much of it still overlaps, plus
+    the current window's.  O(1) time and three numbers per key.
+  - Keys live in an LRU-ordered dict capped at THROTTLE_MAX_KEYS per
+    counter, so memory stays bounded however many addresses an attacker
+    rotates through; the least recently seen key is dropped first.
+  - check() runs before the password is verified and returns a
+    retry-after when the source IP or the (IP, account) pair is over its
+    limit (THROTTLE_IP_LIMIT, THROTTLE_PAIR_LIMIT), so blocked sources
+    cost no hashing.  The account counter never rejects: anyone can fail
+    logins for someone else's email, and a hard limit there would let
+    them lock the owner out from any address.
+  - counts() feeds the login_attempts risk component: the account's
+    failures from any IP raise the attempt count (the challenge path —
+    RE_AUTHENTICATE / BLOCK via the risk decision), and the IP's failures
+    against other accounts flag spraying once they reach
+    THROTTLE_SPRAY_MIN (see spray_risk and
+    risk_engine.calc_login_attempt_risk).
+
+A successful login clears its account and (IP, account) counters but not
+the IP's, so one good password does not launder a spray.
+
+The source IP is client_ip(): behind a load balancer or Cloud Run every
+request arrives from the proxy, which would put all users behind one IP
+counter.  When the direct peer is in TRUSTED_PROXIES (CIDRs, or "*" for
+"the peer is always our proxy"), the client is the nearest
+X-Forwarded-For entry that is not itself a trusted proxy; the header is
+ignored from any other peer, so clients cannot pick their own key.
+"""
+
+import heapq
+import ipaddress
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import db
+
+THROTTLE_WINDOW_SECONDS = float(os.getenv("THROTTLE_WINDOW_SECONDS", "900"))
+THROTTLE_IP_LIMIT = int(os.getenv("THROTTLE_IP_LIMIT", "50"))
+THROTTLE_PAIR_LIMIT = int(os.getenv("THROTTLE_PAIR_LIMIT", "5"))
+THROTTLE_MAX_KEYS = int(os.getenv("THROTTLE_MAX_KEYS", "50000"))
+THROTTLE_SPRAY_MIN = int(os.getenv("THROTTLE_SPRAY_MIN", "10"))
+TRUSTED_PROXIES = [p.strip() for p in os.getenv("TRUSTED_PROXIES", "").split(",") if p.strip()]
+
+_ANY_PROXY = "*" in TRUSTED_PROXIES
+_PROXY_NETS = [ipaddress.ip_network(p, strict=False) for p in TRUSTED_PROXIES if p != "*"]
+
+
+def _address(ip):
+    try:
+        return ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+
+
+def _is_proxy(addr):
+    return any(addr.version == net.version and addr in net for net in _PROXY_NETS)
+
+
+def client_ip(peer, forwarded_for=None):
+    """The address a request came from: `peer`, or the nearest X-Forwarded-For hop behind trusted proxies."""
+    addr = _address(peer) if peer else None
+    if not forwarded_for or addr is None or not (_ANY_PROXY or _is_proxy(addr)):
+        return peer
+    hops = [h.strip() for h in forwarded_for.split(",") if h.strip()]
+    while hops:
+        hop = _address(hops.pop())
+        if hop is None:
+            break
+        # With "*" only the direct peer is known to be ours: its X-Forwarded-For entry is the client
+        if _ANY_PROXY or not hops or not _is_proxy(hop):
+            return str(hop)
+    return peer
+
+
+class SlidingCounter:
+    """Approximate per-key event counts over a sliding window, at most `max_keys` keys."""
+
+    def __init__(self, window, max_keys):
+        self.window = window
+        self.max_keys = max_keys
+        self._keys = OrderedDict()     # key -> [window index, previous count, current count]
+        self.evicted = 0
+
+    def _view(self, key, now):
+        """(previous, current, window index) for `key` as of `now`, without touching it."""
+        idx = int(now // self.window)
+        slot = self._keys.get(key)
+        if slot is None or slot[0] < idx - 1:
+            return 0, 0, idx
+        if slot[0] == idx - 1:
+            return slot[2], 0, idx
+        return slot[1], slot[2], idx
+
+    def add(self, key, now, n=1):
+        prev, cur, idx = self._view(key, now)
+        if key in self._keys:
+            self._keys.move_to_end(key)
+        elif len(self._keys) >= self.max_keys:
+            self._keys.popitem(last=False)
+            self.evicted += 1
+        self._keys[key] = [idx, prev, cur + n]
+
+    def count(self, key, now):
+        prev, cur, idx = self._view(key, now)
+        return prev * (1 - (now - idx * self.window) / self.window) + cur
+
+    def retry_after(self, key, limit, now):
+        """Seconds until the estimate drops below `limit` (0 if already below)."""
+        prev, cur, idx = self._view(key, now)
+        if prev * (1 - (now - idx * self.window) / self.window) + cur < limit:
+            return 0
+        if cur >= limit:
+            # The current window alone is over: wait for it to become the previous one and decay
+            return math.ceil((idx + 1) * self.window - now + self.window * (1 - limit / cur)) + 1
+        # prev * (1 - t / window) + cur < limit  ->  t > window * (1 - (limit - cur) / prev)
+        t = self.window * (1 - (limit - cur) / prev)
+        return max(1, math.ceil(idx * self.window + t - now))
+
+    def reset(self, key):
+        self._keys.pop(key, None)
+
+    def top(self, n, now):
+        ranked = heapq.nlargest(n, ((self.count(k, now), k) for k in self._keys))
+        return [{"key": k if isinstance(k, str) else " / ".join(k), "failures": round(c, 1)} for c, k in ranked if c > 0]
+
+    def __len__(self):
+        return len(self._keys)
+
+
+_lock = threading.Lock()
+_by_ip = SlidingCounter(THROTTLE_WINDOW_SECONDS, THROTTLE_MAX_KEYS)
+_by_account = SlidingCounter(THROTTLE_WINDOW_SECONDS, THROTTLE_MAX_KEYS)
+_by_pair = SlidingCounter(THROTTLE_WINDOW_SECONDS, THROTTLE_MAX_KEYS)
+_stats = {"failures": 0, "rejected": 0}
+
+
+def _account(account):
+    return (account or "").strip().lower()
+
+
+def check(ip, account) -> int:
+    """0 to proceed, else seconds the source should wait (reject before hashing)."""
+    now = time.time()
+    account = _account(account)
+    with _lock:
+        wait = max(_by_pair.retry_after((ip, account), THROTTLE_PAIR_LIMIT, now),
+                   _by_ip.retry_after(ip, THROTTLE_IP_LIMIT, now))
+        if wait:
+            _stats["rejected"] += 1
+    return wait
+
+
+def record_failure(ip, account):
+    now = time.time()
+    account = _account(account)
+    with _lock:
+        _by_ip.add(ip, now)
+        _by_account.add(account, now)
+        _by_pair.add((ip, account), now)
+        _stats["failures"] += 1
+
+
+def record_success(ip, account):
+    account = _account(account)
+    with _lock:
+        _by_account.reset(account)
+        _by_pair.reset((ip, account))
+
+
+def counts(ip, account) -> dict:
+    """Windowed failure counts (rounded down) for one login; `other_accounts` is the IP's
+    failures against accounts other than this one."""
+    now = time.time()
+    account = _account(account)
+    with _lock:
+        from_ip, pair = _by_ip.count(ip, now), _by_pair.count((ip, account), now)
+        return {"ip": int(from_ip), "account": int(_by_account.count(account, now)), "pair": int(pair),
+                "other_accounts": int(max(0.0, from_ip - pair))}
+
+
+def spray_risk(source_failures) -> float:
+    """Raw 0-100 risk for THROTTLE_SPRAY_MIN+ failed logins from one IP (mirrored in batch_risk)."""
+    if source_failures < THROTTLE_SPRAY_MIN:
+        return 0.0
+    return min(100.0, 30.0 + 5.0 * (source_failures - THROTTLE_SPRAY_MIN))
+
+
+def status(top=10) -> dict:
+    now = time.time()
+    with _lock:
+        return dict(_stats, window_seconds=THROTTLE_WINDOW_SECONDS,
+                    limits={"ip": THROTTLE_IP_LIMIT, "pair": THROTTLE_PAIR_LIMIT},
+                    keys={"ip": len(_by_ip), "account": len(_by_account), "pair": len(_by_pair)},
+                    evicted=_by_ip.evicted + _by_account.evicted + _by_pair.evicted,
+                    top_ips=_by_ip.top(top, now), top_accounts=_by_account.top(top, now))
+
+
+def _memory_report():
+    with _lock:
+        n = len(_by_ip) + len(_by_account) + len(_by_pair)
+    return {"entries": n, "approx_bytes": n * 200}
+
+
+db.register_index("throttle", _memory_report)
@@ -0,0 +1,220 @@
+"""
+Evaluation Tracing
+==================
+Per-phase timing for evaluate_session_risk, so a latency spike can be
+pinned on the profile build, the risk context, component scoring,
+composite_risk, persistence or the alert e-mail instead of guessed at.
+
+A sampled call (TRACE_SAMPLE_RATE, 0-1) gets a Trace in a contextvar;
+span(name) blocks inside it record wall time, DB operations and documents
+scanned (via db.set_op_observer) for their phase.  Finished traces feed
+per-phase latency histograms (fixed log-spaced buckets, so percentiles are
+bucket upper bounds) and a short list of the slowest recent traces.
+
+With sampling off nothing is installed in db.py, and span() costs one
+contextvar read returning a shared no-op, so the request path pays close
+to nothing.  The rate can be changed at runtime via set_sample_rate().
+"""
+
+import bisect
+import contextvars
+import functools
+import os
+import random
+import threading
+import time
+from datetime import datetime
+
+import db
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_KEEP_SLOWEST = int(os.getenv("TRACE_KEEP_SLOWEST", "20"))
+
+# Histogram bucket upper bounds in milliseconds (last bucket is open-ended)
+BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_current = contextvars.ContextVar("risk_trace", default=None)
+_rng = random.Random()
+_lock = threading.Lock()
+_rate = 0.0
+_phases: dict = {}     # phase -> _Histogram
+_slowest: list = []    # [(total_ms, trace dict)], kept sorted, at most TRACE_KEEP_SLOWEST
+_traces = 0
+
+
+class Trace:
+    __slots__ = ("name", "started", "t0", "spans", "db_ops", "docs_scanned", "collections")
+
+    def __init__(self, name):
+        self.name = name
+        self.started = datetime.utcnow()
+        self.t0 = time.perf_counter()
+        self.spans = []
+        self.db_ops = 0
+        self.docs_scanned = 0
+        self.collections = {}
+
+    def to_dict(self, total_ms):
+        return {
+            "name": self.name, "started": self.started, "ms": round(total_ms, 3),
+            "db_ops": self.db_ops, "docs_scanned": self.docs_scanned,
+            "collections": dict(self.collections),
+            "spans": [{"name": n, "ms": round(ms, 3), "db_ops": ops, "docs_scanned": sc}
+                      for n, ms, ops, sc in self.spans],
+        }
+
+
+class _Span:
+    __slots__ = ("trace", "name", "t0", "ops", "scanned")
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        tr = self.trace
+        self.ops = tr.db_ops
+        self.scanned = tr.docs_scanned
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        tr = self.trace
+        tr.spans.append((self.name, (time.perf_counter() - self.t0) * 1000,
+                         tr.db_ops - self.ops, tr.docs_scanned - self.scanned))
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Histogram:
+    __slots__ = ("counts", "n", "total", "max", "db_ops", "docs_scanned")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.db_ops = 0
+        self.docs_scanned = 0
+
+    def add(self, ms, ops, scanned):
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.n += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+        self.db_ops += ops
+        self.docs_scanned += scanned
+
+    def percentile(self, q):
+        target = q * self.n
+        acc = 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if acc >= target and c:
+                return BUCKETS_MS[i] if i < len(BUCKETS_MS) else round(self.max, 3)
+        return 0.0
+
+    def summary(self):
+        n = self.n or 1
+        return {
+            "count": self.n, "mean_ms": round(self.total / n, 3), "max_ms": round(self.max, 3),
+            "p50_ms": self.percentile(0.5), "p95_ms": self.percentile(0.95), "p99_ms": self.percentile(0.99),
+            "avg_db_ops": round(self.db_ops / n, 2), "avg_docs_scanned": round(self.docs_scanned / n, 1),
+            "buckets": {(f"<={b}" if i < len(BUCKETS_MS) else f">{BUCKETS_MS[-1]}"): c
+                        for i, (b, c) in enumerate(zip(BUCKETS_MS + (None,), self.counts)) if c},
+        }
+
+
+# ─── Recording ───────────────────────────────────────────────────────
+
+def _on_db_op(collection, op, scanned):
+    tr = _current.get()
+    if tr is not None:
+        tr.db_ops += 1
+        tr.docs_scanned += scanned
+        key = f"{collection}.{op}"
+        tr.collections[key] = tr.collections.get(key, 0) + 1
+
+
+def span(name):
+    """Context manager timing one phase of the current trace (no-op when not sampled)."""
+    tr = _current.get()
+    if tr is None:
+        return _NO_SPAN
+    return _Span(tr, name)
+
+
+def _finish(tr):
+    global _traces
+    total_ms = (time.perf_counter() - tr.t0) * 1000
+    with _lock:
+        _traces += 1
+        _phases.setdefault("total", _Histogram()).add(total_ms, tr.db_ops, tr.docs_scanned)
+        for name, ms, ops, scanned in tr.spans:
+            _phases.setdefault(name, _Histogram()).add(ms, ops, scanned)
+        if len(_slowest) < TRACE_KEEP_SLOWEST or total_ms > _slowest[0][0]:
+            bisect.insort(_slowest, (total_ms, id(tr), tr.to_dict(total_ms)))
+            if len(_slowest) > TRACE_KEEP_SLOWEST:
+                _slowest.pop(0)
+
+
+def traced(name):
+    """Decorator for coroutines: sample and trace each call (nested calls join the outer trace)."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        async def run(*args, **kwargs):
+            if _rate <= 0 or _current.get() is not None or _rng.random() >= _rate:
+                return await fn(*args, **kwargs)
+            tr = Trace(name)
+            token = _current.set(tr)
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                _current.reset(token)
+                _finish(tr)
+        return run
+    return wrap
+
+
+# ─── Control / Reporting ─────────────────────────────────────────────
+
+def set_sample_rate(rate: float) -> float:
+    """Change the sampling rate (0 disables tracing and removes the DB hook)."""
+    global _rate
+    rate = min(1.0, max(0.0, float(rate)))
+    _rate = rate
+    db.set_op_observer(_on_db_op if rate > 0 else None)
+    return rate
+
+
+def reset():
+    global _traces
+    with _lock:
+        _phases.clear()
+        _slowest.clear()
+        _traces = 0
+
+
+def report() -> dict:
+    with _lock:
+        return {
+            "sample_rate": _rate, "traces": _traces,
+            "phases": {name: h.summary() for name, h in _phases.items()},
+            "slowest": [t for _, _, t in reversed(_slowest)],
+        }
+
+
+set_sample_rate(TRACE_SAMPLE_RATE)
@@ -14,6 +14,8 @@ from passlib.context import CryptContext
 import uuid
 import random
 
+import policy
+
 # Use pbkdf2_sha256 for maximum compatibility across platforms without C dependencies (like bcrypt)
 pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
 
@@ -46,8 +48,5 @@ def get_risk_level(score: float) -> str:
 
 
 def get_risk_decision(score: float) -> str:
-    if score <= 30:
-        return "ALLOW"
-    elif score <= 60:
-        return "RE_AUTHENTICATE"
-    return "BLOCK"
+    """Decision under the active risk policy's default cutoffs."""
+    return policy.current().default.decision(score)
@@ -42,7 +42,7 @@ gcloud run deploy zero-trust-backend `
   --image $BACKEND_IMAGE `
   --region $REGION `
   --platform managed `
-  --set-env-vars ENVIRONMENT=production,MONGODB_URI=$MONGO_URI,JWT_SECRET=$JWT_SEC `
+  --set-env-vars ENVIRONMENT=production,MONGODB_URI=$MONGO_URI,JWT_SECRET=$JWT_SEC,TRUSTED_PROXIES=* `
   --allow-unauthenticated `
   --project=$PROJECT_ID
 